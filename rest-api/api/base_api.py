@@ -1,15 +1,25 @@
+import httplib
+import json
 import logging
 
 import app_util
 
+from dao import database_factory
+from fhirclient.models.fhirabstractbase import FHIRValidationError
 from query import OrderBy, Query
-from flask import request, jsonify, url_for
+from flask import request, jsonify, url_for, Response, stream_with_context
 from flask.ext.restful import Resource
 from model.utils import to_client_participant_id
-from werkzeug.exceptions import BadRequest, NotFound
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound
 
 DEFAULT_MAX_RESULTS = 100
 MAX_MAX_RESULTS = 10000
+# Streamed (_format=ndjson) results are never held in memory, so pages can be much larger.
+MAX_MAX_STREAMING_RESULTS = 100000
+
+NDJSON_FORMAT = 'ndjson'
+# _includeTotal value that allows large totals to be estimated rather than counted.
+ESTIMATED_TOTAL = 'estimated'
 
 
 class BaseApi(Resource):
@@ -24,10 +34,20 @@ class BaseApi(Resource):
   for uniform authentication, e.g.:
     method_decorators = [app_util.auth_required_cron]
   """
+  # Whether GET requests may read from the replica database; see
+  # database_factory.read_replica_routing. Handlers whose reads must see the latest writes opt out.
+  read_from_replica = True
+
   def __init__(self, dao, get_returns_children=False):
     self.dao = dao
     self._get_returns_children = get_returns_children
 
+  def dispatch_request(self, *args, **kwargs):
+    if request.method == 'GET' and self.read_from_replica:
+      with database_factory.read_replica_routing():
+        return super(BaseApi, self).dispatch_request(*args, **kwargs)
+    return super(BaseApi, self).dispatch_request(*args, **kwargs)
+
   def get(self, id_=None, participant_id=None):
     """Handle a GET request.
 
@@ -38,6 +58,10 @@ class BaseApi(Resource):
     """
     if id_ is None:
       return self.list(participant_id)
+    # Child resources must be loaded to check that they belong to the participant.
+    etag = self._get_etag(id_) if participant_id is None else None
+    if etag and app_util.is_not_modified(etag):
+      return app_util.make_not_modified_response(etag)
     obj = self.dao.get_with_children(id_) if self._get_returns_children else self.dao.get(id_)
     if not obj:
       raise NotFound("%s with ID %s not found" % (self.dao.model_type.__name__, id_))
@@ -45,7 +69,17 @@ class BaseApi(Resource):
       if participant_id != obj.participantId:
         raise NotFound("%s with ID %s is not for participant with ID %s" %
                        (self.dao.model_type.__name__, id_, participant_id))
-    return self._make_response(obj)
+    response = self._make_response(obj)
+    if etag and isinstance(response, dict):
+      return response, 200, {'ETag': etag}
+    return response
+
+  def _get_etag(self, id_):
+    """Returns an ETag for the object with the specified ID, without loading all of it, so that GET
+    requests with a matching If-None-Match header can be answered with 304 Not Modified. Returns
+    None (the default) if the object doesn't exist or ETags aren't supported."""
+    #pylint: disable=unused-argument
+    return None
 
   def _make_response(self, obj):
     return self.dao.to_client_json(obj)
@@ -72,6 +106,74 @@ class BaseApi(Resource):
     result = self._do_insert(m)
     return self._make_response(result)
 
+  def _get_bundle(self, max_entries):
+    """Returns the Bundle in the request body, after checking it has a list of at most max_entries
+    entries."""
+    bundle = request.get_json(force=True)
+    if not isinstance(bundle, dict) or bundle.get('resourceType') != 'Bundle':
+      raise BadRequest('Expected a Bundle with a list of entries.')
+    entries = bundle.get('entry')
+    if not isinstance(entries, list):
+      raise BadRequest('Expected a Bundle with a list of entries.')
+    if len(entries) > max_entries:
+      raise BadRequest('Bundle has %d entries; the maximum is %d.' % (len(entries), max_entries))
+    return bundle
+
+  def _parse_bundle_entries(self, entries, parse):
+    """Parses each Bundle entry's resource with parse (a function of the resource JSON).
+
+    Returns the parsed objects, the indexes of their entries, and a list with, for each entry, the
+    BadRequest for its resource if it couldn't be parsed (or None).
+    """
+    objs = []
+    indexes = []
+    results = [None] * len(entries)
+    for i, entry in enumerate(entries):
+      resource = entry.get('resource') if isinstance(entry, dict) else None
+      if not isinstance(resource, dict):
+        results[i] = BadRequest('Entry %d has no resource.' % i)
+        continue
+      try:
+        objs.append(parse(resource))
+      except BadRequest as e:
+        results[i] = e
+        continue
+      except FHIRValidationError as e:
+        results[i] = BadRequest('Entry %d is not a valid %s: %s' %
+                                (i, self.dao.model_type.__name__, e))
+        continue
+      indexes.append(i)
+    return objs, indexes, results
+
+  def _make_batch_response(self, bundle_type, results):
+    """Returns a Bundle of the given type (e.g. batch-response) with an entry for each result: the
+    resource and a 200 status for an inserted object, or the status and an OperationOutcome for
+    an HTTPException."""
+    return {
+      'resourceType': 'Bundle',
+      'type': bundle_type,
+      'entry': [self._make_batch_entry(result) for result in results],
+    }
+
+  def _make_batch_entry(self, result):
+    if isinstance(result, HTTPException):
+      return {
+        'response': {
+          'status': str(result.code),
+          'outcome': {
+            'resourceType': 'OperationOutcome',
+            'issue': [{'severity': 'error', 'code': 'processing',
+                       'diagnostics': result.description}],
+          },
+        },
+      }
+    entry_response = {'status': str(httplib.OK)}
+    resource = self._make_response(result)
+    if isinstance(resource, tuple):
+      resource, _, headers = resource
+      entry_response['etag'] = headers['ETag']
+    return {'resource': resource, 'response': entry_response}
+
   def list(self, participant_id=None):
     """Handles a list request, as the default behavior when a GET has no id provided.
 
@@ -99,9 +201,38 @@ class BaseApi(Resource):
     logging.info('Returning response.')
     return response
 
+  def _stream_query(self):
+    """Run a query against the DAO, streaming the results back as newline-delimited JSON.
+
+    Rows are read through a server-side cursor and written out one at a time, so memory use
+    doesn't depend on the page size. Each line is a resource; if a pagination token is available,
+    a final line contains a "link" array like the one in the Bundle returned by _query().
+    """
+    logging.info('Preparing streaming query for %s.', self.dao.model_type)
+    query = self._make_query()
+    results = self.dao.query_streaming(query)
+    return Response(stream_with_context(self._make_ndjson(results)),
+                    mimetype=app_util.NDJSON_CONTENT_TYPE)
+
+  def _make_ndjson(self, results):
+    num_items = 0
+    for item in results.items:
+      yield json.dumps(self._make_response(item)) + '\n'
+      num_items += 1
+    if results.pagination_token:
+      link_type = 'next' if results.more_available else 'sync'
+      next_url = self._make_next_url(results.pagination_token)
+      yield json.dumps({'link': [{'relation': link_type, 'url': next_url}]}) + '\n'
+    logging.info('Streamed %d results.', num_items)
+
+  def _is_streaming_request(self):
+    return request.args.get('_format') == NDJSON_FORMAT
+
   def _make_query(self):
     field_filters = []
     max_results = DEFAULT_MAX_RESULTS
+    max_max_results = (MAX_MAX_STREAMING_RESULTS if self._is_streaming_request()
+                       else MAX_MAX_RESULTS)
     pagination_token = None
     order_by = None
     missing_id_list = ['awardee', 'organization', 'site']
@@ -118,50 +249,55 @@ class BaseApi(Resource):
         max_results = int(request.args['_count'])
         if max_results < 1:
           raise BadRequest("_count < 1")
-        if max_results > MAX_MAX_RESULTS:
-          raise BadRequest("_count exceeds {}".format(MAX_MAX_RESULTS))
+        if max_results > max_max_results:
+          raise BadRequest("_count exceeds {}".format(max_max_results))
       elif key == '_token':
         pagination_token = value
       elif key == '_sort' or key == '_sort:asc':
         order_by = OrderBy(value, True)
       elif key == '_sort:desc':
         order_by = OrderBy(value, False)
+      elif key == '_format' or key == '_elements':
+        continue
       else:
         field_filter = self.dao.make_query_filter(key, value)
         if field_filter:
           field_filters.append(field_filter)
     return Query(field_filters, order_by, max_results, pagination_token,
-                 include_total=include_total, offset=offset)
+                 include_total=include_total, offset=offset,
+                 estimate_total=include_total == ESTIMATED_TOTAL)
 
-  def _make_bundle(self, results, id_field, participant_id):
+  def _make_next_url(self, pagination_token):
     import main
+    query_params = request.args.copy()
+    query_params['_token'] = pagination_token
+    return main.api.url_for(self.__class__, _external=True, **query_params)
+
+  def _make_bundle(self, results, id_field, participant_id):
     bundle_dict = {"resourceType": "Bundle", "type": "searchset"}
     if results.pagination_token:
-      query_params = request.args.copy()
-      query_params['_token'] = results.pagination_token
-
-      next_url = main.api.url_for(self.__class__, _external=True, **query_params)
+      next_url = self._make_next_url(results.pagination_token)
       bundle_dict['link'] = [{"relation": "next", "url": next_url}]
     entries = []
     for item in results.items:
-      json = self._make_response(item)
-      full_url = self._make_resource_url(json, id_field, participant_id)
+      resource_json = self._make_response(item)
+      full_url = self._make_resource_url(resource_json, id_field, participant_id)
       entries.append({"fullUrl": full_url,
-                     "resource": json})
+                     "resource": resource_json})
     bundle_dict['entry'] = entries
     if results.total is not None:
       bundle_dict['total'] = results.total
     return bundle_dict
 
-  def _make_resource_url(self, json, id_field, participant_id):
+  def _make_resource_url(self, resource_json, id_field, participant_id):
     import main
     if participant_id:
       return main.api.url_for(self.__class__,
-                              id_=json[id_field],
+                              id_=resource_json[id_field],
                               p_id=to_client_participant_id(participant_id),
                               _external=True)
     else:
-      return main.api.url_for(self.__class__, p_id=json[id_field],
+      return main.api.url_for(self.__class__, p_id=resource_json[id_field],
                               _external=True)
 
 class UpdatableApi(BaseApi):
@@ -169,6 +305,9 @@ class UpdatableApi(BaseApi):
 
   To be used with UpdatableDao for model objects with a version field.
   """
+  # Versions returned by GET are used in If-Match headers for PUT, so they must not be stale.
+  read_from_replica = False
+
   def _get_model_to_update(self, resource, id_, expected_version, participant_id=None):
     # Children of participants accept a participant_id parameter to from_client_json; others don't.
     if participant_id is not None:
@@ -179,6 +318,10 @@ class UpdatableApi(BaseApi):
       return self.dao.from_client_json(
           resource, id_=id_, expected_version=expected_version, client_id=app_util.get_oauth_id())
 
+  def _get_etag(self, id_):
+    version = self.dao.get_version(id_)
+    return _make_etag(version) if version is not None else None
+
   def _make_response(self, obj):
     result = super(UpdatableApi, self)._make_response(obj)
     etag = _make_etag(obj.version)
@@ -244,12 +387,14 @@ def get_sync_results_for_request(dao, max_results):
   count_str = request.args.get('_count')
   count = int(count_str) if count_str else max_results
 
-  results = dao.query(Query([], OrderBy('logPositionId', True),
-                            count, token, always_return_token=True))
-  return make_sync_results_for_request(dao, results)
+  with database_factory.read_replica_routing():
+    results = dao.query(Query([], OrderBy('logPositionId', True),
+                              count, token, always_return_token=True))
+    return make_sync_results_for_request(dao, results)
 
 
-def make_sync_results_for_request(dao, results):
+def make_sync_results_for_request(dao, results, to_client_json=None):
+  to_client_json = to_client_json or dao.to_client_json
   bundle_dict = {'resourceType': 'Bundle', 'type': 'history'}
   if results.pagination_token:
     query_params = request.args.copy()
@@ -259,6 +404,6 @@ def make_sync_results_for_request(dao, results):
     bundle_dict['link'] = [{'relation': link_type, 'url': next_url}]
   entries = []
   for item in results.items:
-    entries.append({'resource': dao.to_client_json(item)})
+    entries.append({'resource': to_client_json(item)})
   bundle_dict['entry'] = entries
   return jsonify(bundle_dict)
@@ -3,7 +3,7 @@ import datetime
 import json
 
 from api_util import HEALTHPRO
-from dao.metrics_dao import MetricsBucketDao
+from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao
 from flask import request
 from flask.ext.restful import Resource
 from werkzeug.exceptions import BadRequest
@@ -35,9 +35,15 @@ class MetricsApi(Resource):
       if date_diff > DAYS_LIMIT:
         raise BadRequest("Difference between start date and end date "\
           "should not be greater than %s days" % DAYS_LIMIT)
+      # Buckets only change when a new metrics version starts serving.
+      version = MetricsVersionDao().get_serving_version()
+      etag = app_util.make_strong_etag(
+          (version.metricsVersionId if version else None, start_date, end_date))
+      if app_util.is_not_modified(etag):
+        return app_util.make_not_modified_response(etag)
       buckets = dao.get_active_buckets(start_date, end_date)
       if buckets is None:
-        return []
-      return [dao.to_client_json(bucket) for bucket in buckets]
+        return [], 200, {'ETag': etag}
+      return [dao.to_client_json(bucket) for bucket in buckets], 200, {'ETag': etag}
     else:
       raise BadRequest("Request data is empty")
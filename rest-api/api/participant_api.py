@@ -4,6 +4,10 @@ from api.base_api import UpdatableApi
 from api_util import PTC, PTC_AND_HEALTHPRO
 from dao.participant_dao import ParticipantDao
 
+# Maximum number of participants in one Participant/$batch request.
+MAX_BATCH_SIZE = 5000
+
+
 class ParticipantApi(UpdatableApi):
   def __init__(self):
     super(ParticipantApi, self).__init__(ParticipantDao())
@@ -19,3 +23,25 @@ class ParticipantApi(UpdatableApi):
   @app_util.auth_required(PTC)
   def put(self, p_id):
     return super(ParticipantApi, self).put(p_id)
+
+
+class ParticipantBatchApi(UpdatableApi):
+  """Creates participants in bulk.
+
+  Takes a Bundle whose entries each have a Participant resource (as for POST Participant), and
+  returns a batch-response Bundle with an entry for each, in the same order: the participant (as
+  POST Participant would return it) and a "200" status, or the error status and an
+  OperationOutcome if it couldn't be created. Entries that fail don't affect the others.
+  """
+  def __init__(self):
+    super(ParticipantBatchApi, self).__init__(ParticipantDao())
+
+  @app_util.auth_required(PTC)
+  def post(self):
+    entries = self._get_bundle(MAX_BATCH_SIZE)['entry']
+    client_id = app_util.get_oauth_id()
+    participants, indexes, results = self._parse_bundle_entries(
+        entries, lambda resource: self.dao.from_client_json(resource, client_id=client_id))
+    for i, result in zip(indexes, self.dao.insert_batch(participants)):
+      results[i] = result
+    return self._make_batch_response('batch-response', results)
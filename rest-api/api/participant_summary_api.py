@@ -1,14 +1,16 @@
 from api.base_api import BaseApi, make_sync_results_for_request
 from api_util import PTC_HEALTHPRO_AWARDEE, AWARDEE, DEV_MAIL
-from app_util import auth_required, get_validated_user_info
+from app_util import auth_required, get_validated_user_info, make_strong_etag
 from dao.participant_summary_dao import ParticipantSummaryDao
 from flask import request
+from query import OrderBy
 from werkzeug.exceptions import Forbidden, InternalServerError
 
 
 class ParticipantSummaryApi(BaseApi):
   def __init__(self):
     super(ParticipantSummaryApi, self).__init__(ParticipantSummaryDao())
+    self._elements = None
 
   @auth_required(PTC_HEALTHPRO_AWARDEE)
   def get(self, p_id=None):
@@ -35,18 +37,37 @@ class ParticipantSummaryApi(BaseApi):
         requested_awardee = request.args.get('awardee')
         if requested_awardee != auth_awardee:
           raise Forbidden
+      if self._is_streaming_request():
+        return self._stream_query()
       return super(ParticipantSummaryApi, self)._query('participantId')
 
   def _make_query(self):
     query = super(ParticipantSummaryApi, self)._make_query()
+    elements = request.args.get('_elements')
+    if elements:
+      # Only select the requested columns, and format results straight from the rows.
+      self._elements = [element.strip() for element in elements.split(',') if element.strip()]
+      query.elements = self._elements
     if self._is_last_modified_sync():
       query.always_return_token = True
+      if not query.order_by:
+        # Without an explicit sort, sync on log position, which has no duplicates between pages.
+        query.order_by = OrderBy('logPositionId', True)
 
     return query
 
+  def _get_etag(self, id_):
+    etag_values = self.dao.get_etag_values(id_)
+    return make_strong_etag(etag_values) if etag_values else None
+
+  def _make_response(self, obj):
+    if self._elements:
+      return self.dao.to_client_json_from_row(obj, self._elements)
+    return super(ParticipantSummaryApi, self)._make_response(obj)
+
   def _make_bundle(self, results, id_field, participant_id):
     if self._is_last_modified_sync():
-      return make_sync_results_for_request(self.dao, results)
+      return make_sync_results_for_request(self.dao, results, self._make_response)
     return super(ParticipantSummaryApi, self)._make_bundle(results, id_field, participant_id)
 
   def _is_last_modified_sync(self):
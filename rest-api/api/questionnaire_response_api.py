@@ -3,6 +3,14 @@ import app_util
 from api.base_api import BaseApi
 from api_util import PTC
 from dao.questionnaire_response_dao import QuestionnaireResponseDao
+from model.utils import from_client_participant_id
+from werkzeug.exceptions import BadRequest
+
+# Maximum number of responses in one QuestionnaireResponse bundle.
+MAX_BUNDLE_SIZE = 500
+
+_PATIENT_PREFIX = 'Patient/'
+
 
 class QuestionnaireResponseApi(BaseApi):
   def __init__(self):
@@ -16,3 +24,38 @@ class QuestionnaireResponseApi(BaseApi):
   @app_util.auth_required(PTC)
   def post(self, p_id):
     return super(QuestionnaireResponseApi, self).post(participant_id=p_id)
+
+
+class QuestionnaireResponseBundleApi(BaseApi):
+  """Inserts many questionnaire responses, for one or more participants, at once.
+
+  Takes a transaction (or batch) Bundle whose entries each have a QuestionnaireResponse resource
+  (as for POST Participant/:pid/QuestionnaireResponse; the participant comes from its subject).
+  Responses for the same participant are applied in order, with the participant's summary written
+  once. Returns a transaction-response (or batch-response) Bundle with an entry for each response,
+  in the same order: the response and a "200" status, or the error status and an
+  OperationOutcome if it was rejected. Rejected responses don't affect the others.
+  """
+  def __init__(self):
+    super(QuestionnaireResponseBundleApi, self).__init__(QuestionnaireResponseDao())
+
+  @app_util.auth_required(PTC)
+  def post(self):
+    bundle = self._get_bundle(MAX_BUNDLE_SIZE)
+    entries = bundle['entry']
+    response_type = 'batch-response' if bundle.get('type') == 'batch' else 'transaction-response'
+    client_id = app_util.get_oauth_id()
+    questionnaire_responses, indexes, results = self._parse_bundle_entries(
+        entries, lambda resource: self.dao.from_client_json(
+            resource, participant_id=_get_participant_id(resource), client_id=client_id))
+    for i, result in zip(indexes, self.dao.insert_bundle(questionnaire_responses)):
+      results[i] = result
+    return self._make_batch_response(response_type, results)
+
+
+def _get_participant_id(resource):
+  subject = resource.get('subject')
+  reference = subject.get('reference') if isinstance(subject, dict) else None
+  if not isinstance(reference, basestring) or not reference.startswith(_PATIENT_PREFIX):
+    raise BadRequest('QuestionnaireResponse.subject.reference must be Patient/<participant ID>.')
+  return from_client_participant_id(reference[len(_PATIENT_PREFIX):])
@@ -1,4 +1,5 @@
 import email.utils
+import hashlib
 import logging
 import pytz
 import time
@@ -7,15 +8,19 @@ import netaddr
 from google.appengine.api import app_identity
 from google.appengine.api import oauth
 
-from flask import request
+from flask import request, Response
 from werkzeug.exceptions import Forbidden, Unauthorized
+from werkzeug.http import unquote_etag
 
 import clock
 import config
+from dao import request_scope
+from model import database
 
 
 _GMT = pytz.timezone('GMT')
 SCOPE = 'https://www.googleapis.com/auth/userinfo.email'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
 
 
 def handle_database_disconnect(err):
@@ -155,12 +160,15 @@ def enforce_appid_whitelisted(request_app_id, whitelisted_appids):
 def add_headers(response):
   """Add uniform headers to all API responses.
 
-  All responses are JSON, so we tag them as such at the app level to provide uniform protection
-  against content-sniffing-based attacks.
+  All responses are JSON (or newline-delimited JSON, for streamed results), so we tag them as such
+  at the app level to provide uniform protection against content-sniffing-based attacks.
   """
   response.headers['Content-Disposition'] = 'attachment; filename="f.txt"'
   response.headers['X-Content-Type-Options'] = 'nosniff'
-  response.headers['Content-Type'] = 'application/json; charset=utf-8'  # override to add charset
+  if response.mimetype == NDJSON_CONTENT_TYPE:
+    response.headers['Content-Type'] = NDJSON_CONTENT_TYPE + '; charset=utf-8'
+  else:
+    response.headers['Content-Type'] = 'application/json; charset=utf-8'  # override to add charset
   response.headers['Date'] = email.utils.formatdate(
       time.mktime(pytz.utc.localize(clock.CLOCK.now()).astimezone(_GMT).timetuple()),
       usegmt=True)
@@ -171,9 +179,46 @@ def add_headers(response):
   return response
 
 
+def make_strong_etag(values):
+  """Returns a strong ETag for a response determined by the given values."""
+  return '"%s"' % hashlib.sha1(repr(tuple(values))).hexdigest()
+
+
+def is_not_modified(etag):
+  """Returns True if the request's If-None-Match header matches the ETag (weakly, as for GET)."""
+  return request.if_none_match.contains_weak(unquote_etag(etag)[0])
+
+
+def make_not_modified_response(etag):
+  return Response(status=304, headers={'ETag': etag})
+
+
 def request_logging():
-  """Some uniform logging of request characteristics before any checks are applied."""
+  """Some uniform logging of request characteristics before any checks are applied, and starts
+  collecting database statistics for log_query_stats."""
   logging.info('Request protocol: HTTPS={}'.format(request.environ.get('HTTPS')))
+  database.start_query_stats(config.getSetting(config.SLOW_QUERY_THRESHOLD_MS, None))
+  request_scope.start_request()
+
+
+def log_query_stats(response):
+  """Logs the number of SQL statements run for the request, how long they took, and the slowest
+  ones. Outside of production, the summary is also returned in a Server-Timing header.
+
+  Results that are streamed back run queries after this, and they are not included.
+  """
+  saved_queries = request_scope.end_request(request.endpoint)
+  if saved_queries:
+    logging.info('Lookups served without a query: %s', dict(saved_queries))
+  stats = database.stop_query_stats()
+  if stats is None:
+    return response
+  slowest = ['%.1fms: %s' % (time_ms, statement) for time_ms, statement in stats.get_slowest()]
+  logging.info('Database: %s. Slowest:\n%s', stats.summary(), '\n'.join(slowest))
+  if config.getSettingJson(config.ALLOW_NONPROD_REQUESTS, False):
+    response.headers['Server-Timing'] = 'db;desc="%d statements";dur=%.1f' % (
+        stats.statement_count, stats.total_time_ms)
+  return response
 
 
 def auth_required(role_whitelist):
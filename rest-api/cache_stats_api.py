@@ -0,0 +1,22 @@
+"""Admin API reporting in-memory cache (singleton) statistics.
+
+Statistics are kept per App Engine instance, since each instance has its own caches. The
+response also includes, under savedQueriesByEndpoint, the lookups that DAOs answered from
+request-scoped state instead of querying the database.
+"""
+
+from flask.ext.restful import Resource
+
+import singletons
+from dao import request_scope
+from config_api import auth_required_config_admin
+
+
+class CacheStatsApi(Resource):
+  """Api handler for retrieving hit, miss and rebuild counters for this instance's caches."""
+  method_decorators = [auth_required_config_admin]
+
+  def get(self):
+    stats = singletons.get_stats()
+    stats['savedQueriesByEndpoint'] = request_scope.get_saved_query_counts()
+    return stats
@@ -0,0 +1,87 @@
+"""Looks up files in Google Cloud Storage.
+
+Paths are absolute GCS paths, starting with /$BUCKET/. Code that only needs to know whether files
+exist goes through get_files(), so that tests (and local servers) can substitute LocalFiles, which
+stands in for buckets with directories on the local filesystem.
+"""
+import os
+import threading
+from datetime import timedelta
+
+import clock
+from cloudstorage import cloudstorage_api
+
+FILE = 'file'
+DIRECTORY = 'directory'
+# Maximum number of paths an ExistingFileCache holds.
+_MAX_CACHED_PATHS = 10000
+
+
+class CloudStorageFiles(object):
+  """Looks up files in Google Cloud Storage."""
+
+  def get_type(self, path):
+    """Returns FILE or DIRECTORY for an existing path, or None if nothing exists there."""
+    try:
+      gcs_stat = cloudstorage_api.stat(path)
+    except cloudstorage_api.errors.NotFoundError:
+      return None
+    return DIRECTORY if gcs_stat.is_dir else FILE
+
+
+class LocalFiles(object):
+  """Looks up files under a local directory, which has a subdirectory for each bucket."""
+
+  def __init__(self, root_dir):
+    self.root_dir = root_dir
+
+  def get_local_path(self, path):
+    return os.path.join(self.root_dir, *path.lstrip('/').split('/'))
+
+  def get_type(self, path):
+    local_path = self.get_local_path(path)
+    if os.path.isdir(local_path):
+      return DIRECTORY
+    if os.path.isfile(local_path):
+      return FILE
+    return None
+
+
+class ExistingFileCache(object):
+  """Remembers paths found to exist, for a limited time. Safe to use from multiple threads."""
+
+  def __init__(self):
+    self._expirations = {}
+    self._lock = threading.Lock()
+
+  def contains(self, path):
+    with self._lock:
+      expiration = self._expirations.get(path)
+    return expiration is not None and expiration > clock.CLOCK.now()
+
+  def add(self, path, ttl_seconds):
+    now = clock.CLOCK.now()
+    with self._lock:
+      if len(self._expirations) >= _MAX_CACHED_PATHS:
+        self._expirations = {cached_path: expiration
+                             for cached_path, expiration in self._expirations.iteritems()
+                             if expiration > now}
+        if len(self._expirations) >= _MAX_CACHED_PATHS:
+          self._expirations.clear()
+      self._expirations[path] = now + timedelta(seconds=ttl_seconds)
+
+
+_files = CloudStorageFiles()
+
+
+def get_files():
+  return _files
+
+
+def set_files(files):
+  """Replaces the file lookup used by get_files(), e.g. with LocalFiles. Returns the previous
+  one, so that it can be restored."""
+  global _files
+  previous_files = _files
+  _files = files
+  return previous_files
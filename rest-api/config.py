@@ -18,6 +18,8 @@ CONFIG_SINGLETON_KEY = 'current_config'
 DB_CONFIG_KEY = 'db_config'
 
 LAST_MODIFIED_BUFFER_SECONDS = 60
+# Log positions newer than this aren't returned by syncs, to let earlier positions' writes commit.
+LOG_POSITION_SYNC_HOLDBACK_SECONDS = 60
 CONFIG_CACHE_TTL_SECONDS = 60
 BIOBANK_ID_PREFIX = 'biobank_id_prefix'
 METRICS_SHARDS = 'metrics_shards'
@@ -33,6 +35,28 @@ BASELINE_PPI_QUESTIONNAIRE_FIELDS = 'baseline_ppi_questionnaire_fields'
 PPI_QUESTIONNAIRE_FIELDS = 'ppi_questionnaire_fields'
 BASELINE_SAMPLE_TEST_CODES = 'baseline_sample_test_codes'
 DNA_SAMPLE_TEST_CODES = 'dna_sample_test_codes'
+# How far (in seconds) the read replica may lag behind the primary and still serve read-only
+# requests. If unset, all requests read from the primary.
+READ_REPLICA_MAX_STALENESS_SECONDS = 'read_replica_max_staleness_seconds'
+# SQL statements slower than this (in milliseconds) are logged with their parameters and EXPLAIN
+# plan. If unset, slow queries aren't logged.
+SLOW_QUERY_THRESHOLD_MS = 'slow_query_threshold_ms'
+# SQLAlchemy pool settings (pool_size, max_overflow, pool_timeout, pool_recycle) by database pool
+# name (primary, backup, generic, server_cursor), e.g. {"primary": {"pool_size": 10}}.
+DB_POOL_SETTINGS = 'db_pool_settings'
+# How many random IDs each server keeps reserved (in the id_reservation table) for each kind of ID
+# assigned on insert, so that inserts don't have to retry on collisions. If unset or 0, IDs are
+# picked at insert time instead.
+RANDOM_ID_POOL_SIZE = 'random_id_pool_size'
+# How long (in seconds) to remember that a signed consent PDF exists in GCS, so that responses
+# referring to it again don't check again. If unset, an hour; if 0, existence isn't cached.
+CONSENT_PDF_CACHE_TTL_SECONDS = 'consent_pdf_cache_ttl_seconds'
+# If true, whether signed consent PDFs exist is checked in a background task after the response is
+# stored (which logs an error for missing files), instead of rejecting the response.
+CONSENT_PDF_DEFERRED_CHECK = 'consent_pdf_deferred_check'
+# If true, the latest deadlock from SHOW ENGINE INNODB STATUS is logged when a transaction fails
+# with a deadlock. (The database user needs the PROCESS privilege.)
+LOG_INNODB_STATUS_ON_DEADLOCK = 'log_innodb_status_on_deadlock'
 
 # Allow requests which are never permitted in production. These include fake
 # timestamps for reuqests, unauthenticated requests to create fake data, etc.
@@ -56,10 +80,14 @@ SERVICE_ACCOUNTS_WITH_LONG_LIVED_KEYS = "service_accounts_with_long_lived_keys"
 
 # Overrides for testing scenarios
 CONFIG_OVERRIDES = {}
+# Incremented whenever CONFIG_OVERRIDES changes, so that snapshots are rebuilt.
+_overrides_version = 0
 
 def override_setting(key, value):
   """Overrides a config setting. Used in tests."""
+  global _overrides_version
   CONFIG_OVERRIDES[key] = value
+  _overrides_version += 1
 
 def store_current_config(config_json):
   conf_ndb_key = ndb.Key(Configuration, CONFIG_SINGLETON_KEY)
@@ -213,3 +241,90 @@ def get_config():
                          lambda: load(CONFIG_SINGLETON_KEY),
                          cache_ttl_seconds=CONFIG_CACHE_TTL_SECONDS)
   return model.configuration
+
+
+class ConfigSnapshot(object):
+  """An immutable view of the configuration as of a particular version, with values derived from it.
+
+  Values are computed the first time they are used, and then kept for as long as the snapshot is
+  current; a new snapshot is made whenever the configuration is stored or reloaded (or, in tests,
+  overridden). Use get_snapshot() on hot paths instead of calling getSettingList repeatedly.
+  """
+  def __init__(self, configuration, overrides):
+    self._configuration = configuration
+    self._overrides = dict(overrides)
+    self._derived = {}
+
+  def get_json(self, key, default=_NO_DEFAULT):
+    """Like getSettingJson, for this snapshot."""
+    config_values = self._overrides.get(key)
+    if config_values is not None:
+      return config_values
+    config_values = self._configuration.get(key, default)
+    if config_values == _NO_DEFAULT:
+      raise MissingConfigException('Config key "{}" has no values.'.format(key))
+    return config_values
+
+  def get_tuple(self, key, default=_NO_DEFAULT):
+    """Like getSettingList for this snapshot, but returning a tuple."""
+    config_json = self.get_json(key, default)
+    if isinstance(config_json, (list, tuple)):
+      return tuple(config_json)
+    raise InvalidConfigException(
+        'Config key {} is a {} instead of a list'.format(key, type(config_json)))
+
+  def get_derived(self, name, builder):
+    """Returns builder(self), computed once per snapshot. Builders should return immutable values,
+    since the result is shared by all threads."""
+    try:
+      return self._derived[name]
+    except KeyError:
+      # Concurrent callers may both build the value; either result can be kept.
+      return self._derived.setdefault(name, builder(self))
+
+  @property
+  def baseline_ppi_questionnaire_fields(self):
+    return self.get_derived(BASELINE_PPI_QUESTIONNAIRE_FIELDS,
+                            lambda s: s.get_tuple(BASELINE_PPI_QUESTIONNAIRE_FIELDS, []))
+
+  @property
+  def baseline_ppi_questionnaire_field_set(self):
+    return self.get_derived('baseline_ppi_questionnaire_field_set',
+                            lambda s: frozenset(s.baseline_ppi_questionnaire_fields))
+
+  @property
+  def num_baseline_ppi_modules(self):
+    return len(self.baseline_ppi_questionnaire_fields)
+
+  @property
+  def ppi_questionnaire_fields(self):
+    return self.get_derived(PPI_QUESTIONNAIRE_FIELDS,
+                            lambda s: s.get_tuple(PPI_QUESTIONNAIRE_FIELDS, []))
+
+  @property
+  def baseline_sample_test_codes(self):
+    return self.get_derived(BASELINE_SAMPLE_TEST_CODES,
+                            lambda s: s.get_tuple(BASELINE_SAMPLE_TEST_CODES))
+
+  @property
+  def dna_sample_test_codes(self):
+    return self.get_derived(DNA_SAMPLE_TEST_CODES, lambda s: s.get_tuple(DNA_SAMPLE_TEST_CODES))
+
+
+# (config model, CONFIG_OVERRIDES, overrides version, snapshot) for the current snapshot; replaced
+# as a whole, so readers always see a consistent snapshot.
+_current_snapshot = (None, None, None, None)
+
+def get_snapshot():
+  """Returns the ConfigSnapshot for the current configuration."""
+  global _current_snapshot
+  model = singletons.get(singletons.MAIN_CONFIG_INDEX,
+                         lambda: load(CONFIG_SINGLETON_KEY),
+                         cache_ttl_seconds=CONFIG_CACHE_TTL_SECONDS)
+  snapshot_model, overrides, overrides_version, snapshot = _current_snapshot
+  if (snapshot_model is model and overrides is CONFIG_OVERRIDES and
+      overrides_version == _overrides_version):
+    return snapshot
+  snapshot = ConfigSnapshot(model.configuration, CONFIG_OVERRIDES)
+  _current_snapshot = (model, CONFIG_OVERRIDES, _overrides_version, snapshot)
+  return snapshot
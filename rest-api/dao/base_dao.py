@@ -4,23 +4,45 @@ import json
 import logging
 import datetime
 import random
+import threading
+
+import clock
+import singletons
 
 from fhirclient.models.domainresource import DomainResource
 from fhirclient.models.fhirabstractbase import FHIRValidationError
 from protorpc import messages
-from query import Operator, PropertyType, FieldFilter, Results
-from sqlalchemy import or_, and_
+from query import Operator, PropertyType, FieldFilter, Results, StreamingResults
+from sqlalchemy import or_, and_, tuple_, UniqueConstraint
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest, NotFound, PreconditionFailed, ServiceUnavailable
 
 import api_util
 import dao.database_factory
+from dao.database_utils import estimate_row_count
 from model.utils import get_property_type
 
 # Maximum number of times we will attempt to insert an entity with a random ID before
 # giving up.
 MAX_INSERT_ATTEMPTS = 20
 
+# Number of rows fetched from the database at a time when streaming query results.
+STREAMING_BATCH_SIZE = 500
+
+# Whether to paginate with row value comparisons, e.g. (last_name, participant_id) > ('Smith', 12),
+# where the database supports them. Exposed for benchmarking.
+ROW_VALUE_PAGINATION = True
+
+# How long totals for _includeTotal queries are reused for later queries with the same filters.
+TOTAL_CACHE_TTL_SECONDS = 300
+# Maximum number of distinct filter sets to cache totals for.
+TOTAL_CACHE_MAX_SIZE = 1000
+# Estimated totals smaller than this are replaced with an exact count, which is cheap at that size.
+MIN_ESTIMATED_TOTAL = 10000
+
+# Sort orders that _check_order_by_index has already checked for a matching index.
+_checked_order_by_indexes = set()
+
 # Range of possible values for random IDs.
 _MIN_ID = 100000000
 _MAX_ID = 999999999
@@ -45,9 +67,19 @@ class BaseDao(object):
   order_by_ending is a list of field names to always order by (in ascending order, possibly after
   another sort field) when query() is invoked. It should always end in the primary key.
   If not specified, query() is not supported.
+
+  DAOs using the default database read from the replica instead while handling read-only requests
+  (see database_factory.read_replica_routing).
+
+  reserved_id_source, if set, is a function of (model type, field name) that returns an ID
+  reserved for an insert with random IDs (see _insert_with_random_id), or None to pick one at
+  random.
   """
-  def __init__(self, model_type, backup=False, order_by_ending=None, db=None):
+  def __init__(self, model_type, backup=False, order_by_ending=None, db=None,
+               reserved_id_source=None):
     self.model_type = model_type
+    self._reserved_id_source = reserved_id_source
+    self._routes_reads = not db and not backup
     if not db:
       if backup:
         db = dao.database_factory.get_backup_database()
@@ -57,7 +89,10 @@ class BaseDao(object):
     self.order_by_ending = order_by_ending
 
   def session(self):
-    return self._database.session()
+    name = type(self).__name__
+    if self._routes_reads and dao.database_factory.is_read_replica_routing():
+      return dao.database_factory.get_read_database().session(name=name)
+    return self._database.session(name=name)
 
   def _validate_model(self, session, obj):
     """Override to validate a model before any db write (insert or update)."""
@@ -164,7 +199,7 @@ class BaseDao(object):
 
       total = None
       if query_def.include_total:
-        total = self._count_query(session, query_def)
+        total = self._get_total(session, query_def)
 
       if not items:
         return Results([], total=total)
@@ -172,14 +207,45 @@ class BaseDao(object):
     if len(items) > query_def.max_results:
       # Items, pagination token, and more are available
       page = items[0:query_def.max_results]
-      token = self._make_pagination_token(items[query_def.max_results - 1].asdict(), field_names)
+      token = self._make_pagination_token(_asdict(items[query_def.max_results - 1]), field_names)
       return Results(page, token, more_available=True, total=total)
     else:
-      token = (self._make_pagination_token(items[-1].asdict(), field_names)
+      token = (self._make_pagination_token(_asdict(items[-1]), field_names)
                if query_def.always_return_token
                else None)
       return Results(items, token, more_available=False, total=total)
 
+  def query_streaming(self, query_def, database=None):
+    """Like query(), but returns StreamingResults whose items are read from the database lazily,
+    so memory use stays flat no matter how large max_results is.
+
+    database defaults to the server-side cursor database. Totals are not supported.
+    """
+    if not self.order_by_ending:
+      raise BadRequest("Can't query on type %s -- no order by ending speciifed" % self.model_type)
+    if query_def.include_total:
+      raise BadRequest("Can't include total when streaming results.")
+    results = StreamingResults()
+    results.items = self._stream_items(
+        query_def, database or dao.database_factory.get_server_cursor_database(), results)
+    return results
+
+  def _stream_items(self, query_def, database, results):
+    with database.session() as session:
+      query, field_names = self._make_query(session, query_def)
+      last_item = None
+      num_items = 0
+      for item in query.yield_per(STREAMING_BATCH_SIZE):
+        if num_items == query_def.max_results:
+          # We fetched one extra row; more results are available after this page.
+          results.more_available = True
+          break
+        num_items += 1
+        last_item = item
+        yield item
+      if last_item and (results.more_available or query_def.always_return_token):
+        results.pagination_token = self._make_pagination_token(_asdict(last_item), field_names)
+
   def _make_pagination_token(self, item_dict, field_names):
     vals = [item_dict.get(field_name) for field_name in field_names]
     vals_json = json.dumps(vals, default=json_serial)
@@ -197,6 +263,50 @@ class BaseDao(object):
     query = self._set_filters(query, query_def.field_filters)
     return query.count()
 
+  def _estimate_count_query(self, session, query_def):
+    """Estimates the total from index statistics, counting exactly if the estimate is small or
+    unavailable."""
+    query = self._initialize_query(session, query_def)
+    query = self._set_filters(query, query_def.field_filters)
+    estimate = estimate_row_count(session, query)
+    if estimate is None or estimate < MIN_ESTIMATED_TOTAL:
+      return query.count()
+    return estimate
+
+  def _get_total(self, session, query_def):
+    """Returns the total for a query. For DAOs with a write high-water mark, the total from an
+    earlier query (e.g. for a previous page) with the same filters is reused unless it has expired
+    or the high-water mark has moved; otherwise the total is computed for every query."""
+    high_water_mark = self._get_write_high_water_mark(session)
+    if high_water_mark is None:
+      return self._compute_total(session, query_def)
+    cache = singletons.get(singletons.TOTAL_CACHE_INDEX, _TotalCache,
+                           max_size=TOTAL_CACHE_MAX_SIZE)
+    key = self._get_total_cache_key(query_def)
+    total = cache.get(key, high_water_mark)
+    if total is None:
+      total = self._compute_total(session, query_def)
+      cache.put(key, high_water_mark, total)
+    return total
+
+  def _compute_total(self, session, query_def):
+    if query_def.estimate_total:
+      return self._estimate_count_query(session, query_def)
+    return self._count_query(session, query_def)
+
+  def _get_total_cache_key(self, query_def):
+    """Returns the key for a query's cached total. Subclasses whose queries add conditions that
+    change over time (not only with writes) should add them to the key."""
+    return (self.model_type.__name__, bool(query_def.estimate_total),
+            _get_filters_key(query_def.field_filters))
+
+  def _get_write_high_water_mark(self, session):
+    """Returns a value that changes whenever the table is written, used to invalidate cached
+    totals, or None if there isn't one, in which case totals aren't cached. Subclasses should
+    override this if they can."""
+    #pylint: disable=unused-argument
+    return None
+
   def _make_query(self, session, query_def):
     query = self._initialize_query(session, query_def)
     query = self._set_filters(query, query_def.field_filters)
@@ -207,16 +317,50 @@ class BaseDao(object):
       query = self._add_order_by(query, query_def.order_by, order_by_field_names, order_by_fields)
       first_descending = not query_def.order_by.ascending
     query = self._add_order_by_ending(query, order_by_field_names, order_by_fields)
+    self._check_order_by_index(query_def.field_filters, order_by_fields)
     if query_def.pagination_token:
       # Add a query filter based on the pagination token.
       query = self._add_pagination_filter(query, query_def, order_by_fields,
                                           first_descending)
+    if query_def.elements:
+      fields = self._get_projection_fields(query_def.elements)
+      # Pagination tokens are made from the order by fields, so they must be selected too.
+      selected = set(f.key for f in fields)
+      fields.extend(f for f in order_by_fields if f.key not in selected)
+      query = query.with_entities(*fields)
     # Return one more than max_results, so that we know if there are more results.
     query = query.limit(query_def.max_results + 1)
     if query_def.offset:
       query = query.offset(query_def.offset)
     return query, order_by_field_names
 
+  def _get_projection_fields(self, elements):
+    """Returns the model fields to select for a query that only returns the named elements.
+    Subclasses whose client JSON doesn't map directly onto model fields should override this."""
+    fields = []
+    for element in elements:
+      f = getattr(self.model_type, element, None)
+      if f is None:
+        raise BadRequest('No field named %r found on %r.' % (element, self.model_type))
+      fields.append(f)
+    return fields
+
+  def _check_order_by_index(self, field_filters, fields):
+    """Logs a warning (once per sort order and set of equality filters) if no index matches the
+    sort order, since the database will then have to sort every matching row to return a page."""
+    columns = _get_column_names(fields)
+    equality_columns = frozenset(_get_column_names(
+        [getattr(self.model_type, field_filter.field_name, None) for field_filter in field_filters
+         if field_filter.operator == Operator.EQUALS]))
+    key = (self.model_type.__name__, columns, equality_columns)
+    if key in _checked_order_by_indexes:
+      return
+    _checked_order_by_indexes.add(key)
+    if not _has_index_for_order(self.model_type.__table__, columns, equality_columns):
+      logging.warning('No index on %s matches the sort order (%s) with filters on (%s).',
+                      self.model_type.__tablename__, ', '.join(columns),
+                      ', '.join(sorted(equality_columns)))
+
   def _set_filters(self, query, filters):
     for field_filter in filters:
       try:
@@ -244,8 +388,12 @@ class BaseDao(object):
     """Adds a pagination filter for the decoded values in the pagination token based on
     the sort order."""
     decoded_vals = self._decode_token(query_def, fields)
-    # SQLite does not support tuple comparisons, so make an or-of-ands statements that is
-    # equivalent.
+    if (ROW_VALUE_PAGINATION and query.session.bind.dialect.name != 'sqlite'
+        and None not in decoded_vals):
+      return query.filter(_make_row_value_pagination_filter(fields, decoded_vals,
+                                                            first_descending))
+    # SQLite does not support tuple comparisons (and tuple comparisons don't handle NULLs the way
+    # we need), so make an or-of-ands statements that is equivalent.
     or_clauses = []
     if first_descending:
       if decoded_vals[0] is not None:
@@ -313,14 +461,24 @@ class BaseDao(object):
   def _get_random_id(self):
     return random.randint(_MIN_ID, _MAX_ID)
 
+  def _get_reserved_or_random_id(self, field):
+    """Returns an ID for the field from reserved_id_source if it has one, or a random one
+    otherwise."""
+    reserved_id = None
+    if self._reserved_id_source:
+      reserved_id = self._reserved_id_source(self.model_type, field)
+    return self._get_random_id() if reserved_id is None else reserved_id
+
   def _insert_with_random_id(self, obj, fields):
     """Attempts to insert an entity with randomly assigned ID(s) repeatedly until success
-    or a maximum number of attempts are performed."""
+    or a maximum number of attempts are performed.
+
+    With reserved IDs (see reserved_id_source), the first attempt should succeed."""
     all_tried_ids = []
     for _ in range(0, MAX_INSERT_ATTEMPTS):
       tried_ids = {}
       for field in fields:
-        rand_id = self._get_random_id()
+        rand_id = self._get_reserved_or_random_id(field)
         tried_ids[field] = rand_id
         setattr(obj, field, rand_id)
       all_tried_ids.append(tried_ids)
@@ -420,6 +578,18 @@ class UpdatableDao(BaseDao):
     """Perform the update of the specified object. Subclasses can override to alter things."""
     session.merge(obj)
 
+  def get_version(self, obj_id):
+    """Returns the version of the object with the specified ID without loading the rest of it, or
+    None if not found."""
+    primary_key = self.model_type.__mapper__.primary_key
+    if len(primary_key) != 1:
+      obj = self.get(obj_id)
+      return obj.version if obj else None
+    with self.session() as session:
+      return (session.query(self.model_type.version)
+              .filter(primary_key[0] == obj_id)
+              .scalar())
+
   def get_for_update(self, session, obj_id):
     return self.get_with_session(session, obj_id, for_update=True)
 
@@ -438,6 +608,91 @@ class UpdatableDao(BaseDao):
       return self.update_with_session(session, obj)
 
 
+def _asdict(item):
+  """Returns a dict of field values for a model object or a row from a projected query."""
+  if isinstance(item, tuple):
+    return item._asdict()
+  return item.asdict()
+
+
+def _make_row_value_pagination_filter(fields, decoded_vals, first_descending):
+  """Returns a filter equivalent to the or-of-ands in _add_pagination_filter (for non-NULL token
+  values) as a row value comparison, which MySQL can use to range scan an index on the sort
+  order."""
+  if not first_descending:
+    return tuple_(*fields) > tuple(decoded_vals)
+  or_clauses = [fields[0] < decoded_vals[0], fields[0].is_(None)]
+  if len(fields) > 1:
+    or_clauses.append(and_(fields[0] == decoded_vals[0],
+                           tuple_(*fields[1:]) > tuple(decoded_vals[1:])))
+  return or_(*or_clauses)
+
+
+def _get_column_names(fields):
+  """Returns the names of the columns for model attributes, skipping anything that isn't a
+  column."""
+  names = []
+  for field in fields:
+    columns = getattr(getattr(field, 'property', None), 'columns', None)
+    if columns:
+      names.append(columns[0].name)
+  return tuple(names)
+
+
+def _has_index_for_order(table, columns, equality_columns):
+  """Returns True if an index on the table can return rows in the order of the given columns
+  once rows are restricted by equality on equality_columns."""
+  primary_key = [column.name for column in table.primary_key.columns]
+  candidates = [primary_key]
+  candidates.extend([column.name for column in index.columns] for index in table.indexes)
+  candidates.extend([column.name for column in constraint.columns]
+                    for constraint in table.constraints if isinstance(constraint, UniqueConstraint))
+  # MySQL indexes foreign key columns automatically.
+  candidates.extend(list(constraint.column_keys) for constraint in table.foreign_key_constraints)
+  sort_columns = [column for column in columns if column not in equality_columns]
+  for index_columns in candidates:
+    # InnoDB secondary indexes implicitly end with the primary key.
+    index_columns = index_columns + [column for column in primary_key
+                                     if column not in index_columns]
+    while index_columns and index_columns[0] in equality_columns:
+      index_columns = index_columns[1:]
+    if index_columns[:len(sort_columns)] == sort_columns:
+      return True
+  return False
+
+
+def _get_filters_key(field_filters):
+  """Returns a hashable key for a set of filters, independent of their order."""
+  return tuple(sorted((field_filter.field_name, str(field_filter.operator),
+                       repr(field_filter.value))
+                      for field_filter in field_filters))
+
+
+class _TotalCache(object):
+  """Totals for _includeTotal queries, keyed by model and filters."""
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._entries = {}
+    self._lock = threading.Lock()
+
+  def get(self, key, high_water_mark):
+    with self._lock:
+      entry = self._entries.get(key)
+    if entry is None:
+      return None
+    total, entry_high_water_mark, expiration_time = entry
+    if entry_high_water_mark != high_water_mark or expiration_time < clock.CLOCK.now():
+      return None
+    return total
+
+  def put(self, key, high_water_mark, total):
+    expiration_time = clock.CLOCK.now() + datetime.timedelta(seconds=TOTAL_CACHE_TTL_SECONDS)
+    with self._lock:
+      if len(self._entries) >= self._max_size and key not in self._entries:
+        self._entries.clear()
+      self._entries[key] = (total, high_water_mark, expiration_time)
+
+
 def json_serial(obj):
   """JSON serializer for objects not serializable by default json code"""
   if isinstance(obj, datetime.datetime) or isinstance(obj, datetime.date):
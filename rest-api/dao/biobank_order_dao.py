@@ -1,7 +1,9 @@
 import clock
 from api_util import get_site_id_by_site_value as get_site
 from code_constants import BIOBANK_TESTS_SET, SITE_ID_SYSTEM, HEALTHPRO_USERNAME_SYSTEM
+from dao import request_scope
 from dao.base_dao import UpdatableDao, FhirMixin, FhirProperty
+from dao.database_utils import get_log_position_write_mark
 from dao.participant_dao import ParticipantDao, raise_if_withdrawn
 from dao.participant_summary_dao import ParticipantSummaryDao
 from dao.site_dao import SiteDao
@@ -92,6 +94,10 @@ class BiobankOrderDao(UpdatableDao):
   def get_id(self, obj):
     return obj.biobankOrderId
 
+  def _get_write_high_water_mark(self, session):
+    # Every insert and update gets a new log position.
+    return get_log_position_write_mark(session, BiobankOrder.logPositionId)
+
   def _order_as_dict(self, order):
     result = order.asdict(follow={'identifiers': {}, 'samples': {}})
     del result['created']
@@ -122,7 +128,7 @@ class BiobankOrderDao(UpdatableDao):
         raise Conflict('Order with ID %s already exists' % obj.biobankOrderId)
     self._update_participant_summary(session, obj)
     inserted_obj = super(BiobankOrderDao, self).insert_with_session(session, obj)
-    ParticipantDao().add_missing_hpo_from_site(
+    request_scope.get_dao(ParticipantDao).add_missing_hpo_from_site(
         session, inserted_obj.participantId, inserted_obj.collectedSiteId)
     self._update_history(session, obj)
     return inserted_obj
@@ -130,7 +136,8 @@ class BiobankOrderDao(UpdatableDao):
   def _validate_model(self, session, obj):
     if obj.participantId is None:
       raise BadRequest('participantId is required')
-    participant_summary = ParticipantSummaryDao().get_with_session(session, obj.participantId)
+    participant_summary = request_scope.get_dao(ParticipantSummaryDao).get_with_session(
+        session, obj.participantId)
     if not participant_summary:
       raise BadRequest("Can't submit order for participant %s without consent" % obj.participantId)
     raise_if_withdrawn(participant_summary)
@@ -154,7 +161,7 @@ class BiobankOrderDao(UpdatableDao):
   def get_with_session(self, session, obj_id, **kwargs):
     result = super(BiobankOrderDao, self).get_with_session(session, obj_id, **kwargs)
     if result:
-      ParticipantDao().validate_participant_reference(session, result)
+      request_scope.get_dao(ParticipantDao).validate_participant_reference(session, result)
     return result
 
   def get_with_children_in_session(self, session, obj_id, for_update=False):
@@ -199,16 +206,16 @@ class BiobankOrderDao(UpdatableDao):
     return (OrderStatus.CREATED, order.created)
 
   def _update_participant_summary(self, session, obj):
-    participant_summary_dao = ParticipantSummaryDao()
+    participant_summary_dao = request_scope.get_dao(ParticipantSummaryDao)
     participant_summary = participant_summary_dao.get_for_update(session, obj.participantId)
     if not participant_summary:
       raise BadRequest("Can't submit biospecimens for participant %s without consent" %
                        obj.participantId)
     raise_if_withdrawn(participant_summary)
-    self._set_participant_summary_fields(obj, participant_summary)
+    self.set_participant_summary_fields(obj, participant_summary)
     participant_summary_dao.update_enrollment_status(participant_summary)
 
-  def _set_participant_summary_fields(self, obj, participant_summary):
+  def set_participant_summary_fields(self, obj, participant_summary):
     participant_summary.biospecimenStatus = OrderStatus.FINALIZED
     participant_summary.biospecimenOrderTime = obj.created
     participant_summary.biospecimenSourceSiteId = obj.sourceSiteId
@@ -216,6 +223,7 @@ class BiobankOrderDao(UpdatableDao):
     participant_summary.biospecimenProcessedSiteId = obj.processedSiteId
     participant_summary.biospecimenFinalizedSiteId = obj.finalizedSiteId
     participant_summary.lastModified = clock.CLOCK.now()
+    participant_summary.logPosition = LogPosition()
 
     for sample in obj.samples:
       status_field = 'sampleOrderStatus' + sample.test
@@ -225,16 +233,20 @@ class BiobankOrderDao(UpdatableDao):
 
   def _get_non_cancelled_biobank_orders(self, session, participantId):
     # look up latest order without cancelled status
-    return session.query(BiobankOrder).filter(BiobankOrder.participantId ==
-                                              participantId).filter(or_(BiobankOrder.orderStatus !=
-                                                                    BiobankOrderStatus.CANCELLED,
-                                                                    BiobankOrder.orderStatus == None
-                                                                    )).order_by(
-      BiobankOrder.created).all()
+    return self.get_non_cancelled_orders_query(session).filter(
+        BiobankOrder.participantId == participantId).all()
+
+  @staticmethod
+  def get_non_cancelled_orders_query(session):
+    """Returns a query for orders that aren't cancelled, oldest first."""
+    return session.query(BiobankOrder).filter(or_(BiobankOrder.orderStatus !=
+                                                  BiobankOrderStatus.CANCELLED,
+                                                  BiobankOrder.orderStatus == None
+                                                  )).order_by(BiobankOrder.created)
 
   def _refresh_participant_summary(self, session, obj):
     # called when cancelled/restored
-    participant_summary_dao = ParticipantSummaryDao()
+    participant_summary_dao = request_scope.get_dao(ParticipantSummaryDao)
     participant_summary = participant_summary_dao.get_for_update(session, obj.participantId)
     non_cancelled_orders = self._get_non_cancelled_biobank_orders(session, obj.participantId)
     participant_summary.biospecimenStatus = OrderStatus.UNSET
@@ -245,6 +257,7 @@ class BiobankOrderDao(UpdatableDao):
     participant_summary.biospecimenFinalizedSiteId = None
 
     participant_summary.lastModified = clock.CLOCK.now()
+    participant_summary.logPosition = LogPosition()
     for sample in obj.samples:
       status_field = 'sampleOrderStatus' + sample.test
       setattr(participant_summary, status_field, OrderStatus.UNSET)
@@ -252,7 +265,7 @@ class BiobankOrderDao(UpdatableDao):
 
     if len(non_cancelled_orders) > 0:
       for order in non_cancelled_orders:
-        self._set_participant_summary_fields(order, participant_summary)
+        self.set_participant_summary_fields(order, participant_summary)
     participant_summary_dao.update_enrollment_status(participant_summary)
 
   def _parse_handling_info(self, handling_info):
@@ -261,7 +274,7 @@ class BiobankOrderDao(UpdatableDao):
     if handling_info.site:
       if handling_info.site.system != SITE_ID_SYSTEM:
         raise BadRequest('Invalid site system: %s' % handling_info.site.system)
-      site = SiteDao().get_by_google_group(handling_info.site.value)
+      site = request_scope.get_dao(SiteDao).get_by_google_group(handling_info.site.value)
       if not site:
         raise BadRequest('Unrecognized site: %s' % handling_info.site.value)
       site_id = site.siteId
@@ -276,7 +289,7 @@ class BiobankOrderDao(UpdatableDao):
       return None
     info = _FhirBiobankOrderHandlingInfo()
     if site_id:
-      site = SiteDao().get(site_id)
+      site = request_scope.get_dao(SiteDao).get(site_id)
       info.site = Identifier()
       info.site.system = SITE_ID_SYSTEM
       info.site.value = site.googleGroup
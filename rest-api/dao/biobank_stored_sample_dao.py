@@ -30,4 +30,4 @@ class BiobankStoredSampleDao(BaseDao):
           session.merge(sample)
           written += 1
       return written
-    return self._database.autoretry(upsert)
+    return self._database.autoretry(upsert, name=type(self).__name__)
@@ -1,41 +1,110 @@
+import datetime
+import threading
+
+import clock
 from base_dao import UpdatableDao
+from dao.cache_generation_dao import CacheGenerationDao
+from sqlalchemy import or_
 from sqlalchemy.orm.session import make_transient
 
 import singletons
 
+# Delta refreshes re-fetch entities modified this long before the previous refresh, to pick up
+# writes that committed late or were stamped by a server with a slightly different clock.
+DELTA_REFRESH_OVERLAP_SECONDS = 120
+# TTL for CacheAllDao subclasses. Writes on other servers are picked up by checking the generation,
+# so this only bounds how long a write that skipped the generation could go unnoticed.
+CACHE_TTL_SECONDS = 6 * 3600
+# How often each server checks whether another server has written a cached table.
+GENERATION_CHECK_INTERVAL_SECONDS = 5
+
+
 class EntityCache(object):
   """A cache of entities of a particular type, indexed by ID (in id_to_entity) and optionally other
    fields (in index_maps).
+
+   refresh_time is when entities were last fetched for the cache; entities modified since then
+   may be missing or out of date. generation is the table's CacheGeneration as of refresh_time,
+   and generation_check_time when it was last compared with the database.
    """
-  def __init__(self, dao, entities, index_field_keys):
+  def __init__(self, dao, entities, index_field_keys, refresh_time=None, generation=0):
     """Constructor taking the DAO, all the entities in the database for this type, and a list of
     field names or tuples of field names to index the entities by."""
     self.id_to_entity = {}
-    if index_field_keys:
-      self.index_maps = {index_field_key: {} for index_field_key in index_field_keys}
+    self.index_field_keys = index_field_keys or []
+    self.index_maps = {index_field_key: {} for index_field_key in self.index_field_keys}
+    self.refresh_time = refresh_time
+    self.generation = generation
+    self.generation_check_time = refresh_time
+    self.refresh_lock = threading.Lock()
+    # Entities written by this server since the last refresh.
+    self._written_entities = []
+    self._written_entities_lock = threading.Lock()
     for entity in entities:
-      make_transient(entity)
-      self.id_to_entity[dao.get_id(entity)] = entity
-      if index_field_keys:
-        for index_field_key in index_field_keys:
-          if type(index_field_key) is tuple:
-            key = tuple(getattr(entity, index_field) for index_field in index_field_key)
-          else:
-            key = getattr(entity, index_field_key)
-          self.index_maps[index_field_key][key] = entity
+      self._add(dao, entity)
+
+  def _add(self, dao, entity):
+    make_transient(entity)
+    self.id_to_entity[dao.get_id(entity)] = entity
+    for index_field_key in self.index_field_keys:
+      self.index_maps[index_field_key][_get_index_key(entity, index_field_key)] = entity
+
+  def update(self, dao, entities):
+    """Adds or replaces entities in the cache, in place. Returns a list of (old entity or None,
+    new entity) pairs."""
+    replaced = []
+    for entity in entities:
+      old_entity = self.id_to_entity.get(dao.get_id(entity))
+      if old_entity is not None:
+        for index_field_key in self.index_field_keys:
+          index_map = self.index_maps[index_field_key]
+          key = _get_index_key(old_entity, index_field_key)
+          if index_map.get(key) is old_entity:
+            del index_map[key]
+      self._add(dao, entity)
+      replaced.append((old_entity, entity))
+    return replaced
+
+  def add_written_entity(self, entity):
+    with self._written_entities_lock:
+      self._written_entities.append(entity)
+
+  def has_written_entities(self):
+    return bool(self._written_entities)
+
+  def take_written_entities(self):
+    with self._written_entities_lock:
+      written_entities = self._written_entities
+      self._written_entities = []
+    return written_entities
+
+
+def _get_index_key(entity, index_field_key):
+  if type(index_field_key) is tuple:
+    return tuple(getattr(entity, index_field) for index_field in index_field_key)
+  return getattr(entity, index_field_key)
+
 
 class CacheAllDao(UpdatableDao):
-  """A DAO that loads all values from the database and caches them in memory for some period of time
-  when the cache is empty and is being used.
+  """A DAO that loads all values from the database and caches them in memory.
   Used for tables that have relatively few rows and updates and high read usage.
 
-  Updates to rows will invalidate the entire cache on the server where the update occurs, but not
-  on other servers.
+  Everything is loaded once; after that, the cache fetches only the entities modified since it
+  was last refreshed (using their lastModified field, which this DAO sets on every write) and
+  patches them in place. That happens every cache_ttl_seconds, or sooner if the table's
+  CacheGeneration (incremented with every write, on any server) has changed; servers check it
+  every GENERATION_CHECK_INTERVAL_SECONDS. Entities written on this server are re-fetched by ID on
+  the next read. Call _invalidate_cache to force a full reload (e.g. after rows have been written
+  without this DAO, or deleted).
+
+  Unlike other DAOs, these always read from the primary database, even while handling read-only
+  requests: a delta refresh only looks back DELTA_REFRESH_OVERLAP_SECONDS, so rows that hadn't
+  reached a lagging replica when it ran would be missed until the next full reload.
 
   cache_index is an index from singletons (e.g. CODE_CACHE_INDEX) provided by subclasses
   to specify a key for the cache. (This is faster than hashing the type name.)
 
-  cache_ttl_seconds is the TTL for entries in the cache in seconds.
+  cache_ttl_seconds is the longest time to wait between delta refreshes, in seconds.
 
   index_field_keys is an optional list for secondary indexes; elements in it can either by
   individual field names or tuples of field names. Cached objects will be keyed by those fields.
@@ -46,17 +115,81 @@ class CacheAllDao(UpdatableDao):
   def __init__(self, model_type, cache_index, cache_ttl_seconds, index_field_keys=None,
                order_by_ending=None):
     super(CacheAllDao, self).__init__(model_type, order_by_ending=order_by_ending)
+    self._routes_reads = False
     self.index_field_keys = index_field_keys
     self.cache_index = cache_index
     self.cache_ttl_seconds = cache_ttl_seconds
+    self.cache_generation_dao = CacheGenerationDao()
+
+  def _get_cache_name(self):
+    return self.model_type.__tablename__
 
   def _load_cache(self):
+    refresh_time = clock.CLOCK.now()
+    # Read the generation first, so that writes made while loading trigger another refresh.
+    generation = self.cache_generation_dao.get_generation(self._get_cache_name())
     with self.session() as session:
       all_entities = session.query(self.model_type).all()
-    return EntityCache(self, all_entities, self.index_field_keys)
+    return EntityCache(self, all_entities, self.index_field_keys, refresh_time, generation)
+
+  def _refresh_cache(self, cache, full_refresh):
+    """Fetches entities written on this server and, if full_refresh is set, entities modified since
+    the cache was last refreshed, and patches them into the cache. Returns a list of (old entity
+    or None, new entity) pairs."""
+    refresh_time = clock.CLOCK.now()
+    written_entities = {}
+    for entity in cache.take_written_entities():
+      obj_id = self.get_id(entity)
+      if obj_id is not None:
+        written_entities[obj_id] = entity
+    conditions = []
+    if written_entities:
+      primary_key = self.model_type.__mapper__.primary_key[0]
+      conditions.append(primary_key.in_(written_entities.keys()))
+    if full_refresh:
+      since = cache.refresh_time - datetime.timedelta(seconds=DELTA_REFRESH_OVERLAP_SECONDS)
+      conditions.append(self.model_type.lastModified >= since)
+    if not conditions:
+      return []
+    with self.session() as session:
+      entities = session.query(self.model_type).filter(or_(*conditions)).all()
+    if not full_refresh:
+      # Writes that haven't been committed yet aren't visible here; check them again next time.
+      # (The next full refresh picks them up by lastModified once they are.) MySQL DATETIMEs
+      # drop fractional seconds, so compare to the second.
+      fetched = {self.get_id(entity): entity for entity in entities}
+      for obj_id, written_entity in written_entities.iteritems():
+        entity = fetched.get(obj_id)
+        if (entity is None or
+            entity.lastModified < written_entity.lastModified.replace(microsecond=0)):
+          cache.add_written_entity(written_entity)
+    replaced = cache.update(self, entities)
+    if full_refresh:
+      cache.refresh_time = refresh_time
+    return replaced
 
   def _get_cache(self):
-    return singletons.get(self.cache_index, (lambda: self._load_cache()), self.cache_ttl_seconds)
+    cache = singletons.get(self.cache_index, (lambda: self._load_cache()))
+    now = clock.CLOCK.now()
+    expired = cache.refresh_time + datetime.timedelta(seconds=self.cache_ttl_seconds) < now
+    check_generation = (cache.generation_check_time +
+                        datetime.timedelta(seconds=GENERATION_CHECK_INTERVAL_SECONDS) < now)
+    # Only one thread refreshes the cache at a time; others carry on with the current entities.
+    if ((expired or check_generation or cache.has_written_entities()) and
+        cache.refresh_lock.acquire(False)):
+      try:
+        full_refresh = expired
+        generation = None
+        if expired or check_generation:
+          generation = self.cache_generation_dao.get_generation(self._get_cache_name())
+          cache.generation_check_time = now
+          full_refresh = expired or generation != cache.generation
+        self._refresh_cache(cache, full_refresh)
+        if full_refresh:
+          cache.generation = generation
+      finally:
+        cache.refresh_lock.release()
+    return cache
 
   def get_with_session(self, session, obj_id, **kwargs):
     #pylint: disable=unused-argument
@@ -68,16 +201,26 @@ class CacheAllDao(UpdatableDao):
     return self._get_cache().id_to_entity.get(obj_id)
 
   def _invalidate_cache(self):
+    """Discards the cache, so that everything is reloaded when it's next used."""
     singletons.invalidate(self.cache_index)
 
+  def _mark_written(self, obj):
+    cache = singletons.get_existing(self.cache_index)
+    if cache:
+      cache.add_written_entity(obj)
+
   def insert_with_session(self, session, obj):
+    obj.lastModified = clock.CLOCK.now()
+    self.cache_generation_dao.increment_with_session(session, self._get_cache_name())
     created_obj = super(CacheAllDao, self).insert_with_session(session, obj)
-    self._invalidate_cache()
+    self._mark_written(obj)
     return created_obj
 
-  def update_with_session(self, session, obj):
-    super(CacheAllDao, self).update_with_session(session, obj)
-    self._invalidate_cache()
+  def _do_update(self, session, obj, existing_obj):
+    obj.lastModified = clock.CLOCK.now()
+    self.cache_generation_dao.increment_with_session(session, self._get_cache_name())
+    super(CacheAllDao, self)._do_update(session, obj, existing_obj)
+    self._mark_written(obj)
 
   def get_with_ids(self, ids):
     if ids is None:
@@ -0,0 +1,55 @@
+import logging
+
+from dao.base_dao import BaseDao
+from model.cache_generation import CacheGeneration
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Key in session.info for the names of caches whose generation the session has already incremented.
+_INCREMENTED_KEY = 'incremented_cache_generations'
+
+
+class CacheGenerationDao(BaseDao):
+  def __init__(self):
+    super(CacheGenerationDao, self).__init__(CacheGeneration)
+    self._routes_reads = False
+
+  def get_id(self, obj):
+    return obj.name
+
+  def get_generation(self, name):
+    """Returns the current generation for the named cache (0 if it has never been written)."""
+    with self.session() as session:
+      generation = (session.query(CacheGeneration.generation)
+                    .filter(CacheGeneration.name == name)
+                    .scalar())
+    return generation or 0
+
+  def increment_with_session(self, session, name):
+    """Increments the generation for the named cache when the session is committed. Only the first
+    call for each name in a transaction writes anything."""
+    incremented = session.info.setdefault(_INCREMENTED_KEY, set())
+    if name in incremented:
+      return
+    updated_count = (session.query(CacheGeneration)
+                     .filter(CacheGeneration.name == name)
+                     .update({CacheGeneration.generation: CacheGeneration.generation + 1},
+                             synchronize_session=False))
+    if not updated_count:
+      # Each cache's row is created by a migration.
+      logging.error('No cache_generation row for %s; other servers will not see writes to it '
+                    'until their caches expire.', name)
+      return
+    incremented.add(name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session):
+  session.info.pop(_INCREMENTED_KEY, None)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_soft_rollback(session, previous_transaction):
+  #pylint: disable=unused-argument
+  # The increments were rolled back, so a retry must make them again.
+  session.info.pop(_INCREMENTED_KEY, None)
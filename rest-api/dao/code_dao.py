@@ -2,8 +2,9 @@ import clock
 import logging
 import traceback
 
+from dao import history_writer
 from dao.base_dao import BaseDao
-from dao.cache_all_dao import CacheAllDao
+from dao.cache_all_dao import CacheAllDao, CACHE_TTL_SECONDS
 from model.code import CodeBook, Code, CodeHistory, CodeType
 from werkzeug.exceptions import BadRequest
 from singletons import CODE_CACHE_INDEX
@@ -107,7 +108,8 @@ SYSTEM_AND_VALUE = ('system', 'value')
 
 class CodeDao(CacheAllDao):
   def __init__(self):
-    super(CodeDao, self).__init__(Code, cache_index=CODE_CACHE_INDEX, cache_ttl_seconds=600,
+    super(CodeDao, self).__init__(Code, cache_index=CODE_CACHE_INDEX,
+                                  cache_ttl_seconds=CACHE_TTL_SECONDS,
                                   index_field_keys=[SYSTEM_AND_VALUE])
 
   def _load_cache(self):
@@ -120,10 +122,22 @@ class CodeDao(CacheAllDao):
           code.parent = parent
     return result
 
+  def _refresh_cache(self, cache, full_refresh):
+    replaced = super(CodeDao, self)._refresh_cache(cache, full_refresh)
+    # Move the links between cached codes from the replaced codes to their new versions. (The
+    # children / parent backref keeps both sides of each link in step.)
+    for old_code, code in replaced:
+      if old_code is not None:
+        for child in list(old_code.children):
+          child.parent = code
+        old_code.parent = None
+    for _, code in replaced:
+      if code.parentId is not None:
+        code.parent = cache.id_to_entity.get(code.parentId)
+    return replaced
+
   def _add_history(self, session, obj):
-    history = CodeHistory()
-    history.fromdict(obj.asdict(), allow_pk=True)
-    session.add(history)
+    history_writer.add_row(session, CodeHistory, obj)
 
   def insert_with_session(self, session, obj):
     obj.created = clock.CLOCK.now()
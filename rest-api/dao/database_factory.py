@@ -1,7 +1,11 @@
+import contextlib
+import logging
 import os
+import threading
 
 from MySQLdb.cursors import SSCursor
 from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import SQLAlchemyError
 
 from model.database import Database
 import singletons
@@ -10,13 +14,32 @@ import singletons
 DB_CONNECTION_STRING = os.getenv('DB_CONNECTION_STRING')
 # Exposed for testing.
 SCHEMA_TRANSLATE_MAP = None
+# How often to re-check whether the read replica is reachable and within the staleness bound.
+READ_REPLICA_STATUS_TTL_SECONDS = 30
+
+# Names of the database connection pools, as used in config.DB_POOL_SETTINGS.
+PRIMARY_POOL = 'primary'
+BACKUP_POOL = 'backup'
+GENERIC_POOL = 'generic'
+SERVER_CURSOR_POOL = 'server_cursor'
+# create_engine arguments which may be set per pool in config.DB_POOL_SETTINGS.
+POOL_SETTINGS = ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle')
+
+# Whether the current thread is handling a read-only request; see read_replica_routing().
+_request_routing = threading.local()
+# Singleton indexes for the database of each pool, used to report pool statistics.
+_POOL_INDEXES = ((PRIMARY_POOL, singletons.SQL_DATABASE_INDEX),
+                 (BACKUP_POOL, singletons.BACKUP_SQL_DATABASE_INDEX),
+                 (GENERIC_POOL, singletons.GENERIC_SQL_DATABASE_INDEX),
+                 (SERVER_CURSOR_POOL, singletons.SERVER_CURSOR_SQL_DATABASE_INDEX))
 
 
 class _SqlDatabase(Database):
-  def __init__(self, db_name, backup=False, instance_name=None, **kwargs):
+  def __init__(self, db_name, backup=False, instance_name=None, pool_name=None, **kwargs):
     url = make_url(get_db_connection_string(backup, instance_name))
     if url.drivername != "sqlite" and not url.database:
       url.database = db_name
+    kwargs.update(_get_pool_settings(pool_name))
     super(_SqlDatabase, self).__init__(url, **kwargs)
 
 
@@ -25,15 +48,94 @@ class _BackupSqlDatabase(_SqlDatabase):
     super(_BackupSqlDatabase, self).__init__(db_name, backup=True, **kwargs)
 
 
+def _get_pool_settings(pool_name):
+  """Returns the create_engine pool arguments configured for the named pool."""
+  if DB_CONNECTION_STRING or not pool_name:
+    # Command line tools and tests use SQLAlchemy's defaults.
+    return {}
+  # Only import "config" on demand; see get_db_connection_string.
+  import config
+  settings = config.getSettingJson(config.DB_POOL_SETTINGS, {}).get(pool_name, {})
+  for key in settings:
+    if key not in POOL_SETTINGS:
+      logging.warning('Ignoring unknown setting %r for database pool %r.', key, pool_name)
+  return {key: value for key, value in settings.iteritems() if key in POOL_SETTINGS}
+
 
 def get_database():
   """Returns a singleton _SqlDatabase which USEs the rdr DB."""
-  return singletons.get(singletons.SQL_DATABASE_INDEX, _SqlDatabase, db_name='rdr')
+  return singletons.get(singletons.SQL_DATABASE_INDEX, _SqlDatabase, db_name='rdr',
+                        pool_name=PRIMARY_POOL)
 
 
 def get_backup_database():
   """Returns a singleton _BackupSqlDatabase which USEs the rdr failover DB."""
-  return singletons.get(singletons.BACKUP_SQL_DATABASE_INDEX, _BackupSqlDatabase, db_name='rdr')
+  return singletons.get(singletons.BACKUP_SQL_DATABASE_INDEX, _BackupSqlDatabase, db_name='rdr',
+                        pool_name=BACKUP_POOL)
+
+
+def get_pool_stats():
+  """Returns connection pool statistics for each database this instance has used, by pool name."""
+  result = {}
+  for pool_name, index in _POOL_INDEXES:
+    database = singletons.get_existing(index)
+    if database:
+      result[pool_name] = database.get_pool_stats()
+  return result
+
+
+def get_read_database():
+  """Returns the database read-only requests should read from: the replica (backup) database, if
+  read replica routing is configured and the replica is reachable and within the staleness bound,
+  otherwise the primary database."""
+  if get_db_connection_string().startswith('sqlite'):
+    # SQLite doesn't have replicas; use the normal database during tests.
+    return get_database()
+  # Only import "config" on demand; see get_db_connection_string.
+  import config
+  max_staleness_seconds = config.getSetting(config.READ_REPLICA_MAX_STALENESS_SECONDS, None)
+  if max_staleness_seconds is None:
+    return get_database()
+  status = singletons.get(singletons.READ_REPLICA_STATUS_INDEX, _ReadReplicaStatus,
+                          cache_ttl_seconds=READ_REPLICA_STATUS_TTL_SECONDS,
+                          max_staleness_seconds=max_staleness_seconds)
+  return get_backup_database() if status.usable else get_database()
+
+
+@contextlib.contextmanager
+def read_replica_routing():
+  """Routes reads by DAOs that use the default database to get_read_database() for the duration
+  of a read-only request handler."""
+  previous = is_read_replica_routing()
+  _request_routing.read_only = True
+  try:
+    yield
+  finally:
+    _request_routing.read_only = previous
+
+
+def is_read_replica_routing():
+  return getattr(_request_routing, 'read_only', False)
+
+
+class _ReadReplicaStatus(object):
+  """Whether the read replica can serve reads, checked once when constructed."""
+  def __init__(self, max_staleness_seconds):
+    self.usable = False
+    try:
+      with get_backup_database().session() as session:
+        replica_status = session.execute('SHOW SLAVE STATUS').first()
+    except SQLAlchemyError:
+      logging.warning('Read replica is unavailable; reading from the primary.', exc_info=True)
+      return
+    # No replica status means the backup database isn't replicating, so it can't be stale.
+    if replica_status is not None:
+      lag_seconds = replica_status['Seconds_Behind_Master']
+      if lag_seconds is None or lag_seconds > max_staleness_seconds:
+        logging.warning('Read replica is %s seconds behind (limit %d); reading from the primary.',
+                        lag_seconds, max_staleness_seconds)
+        return
+    self.usable = True
 
 
 def get_generic_database():
@@ -47,9 +149,16 @@ def get_generic_database():
   return singletons.get(singletons.GENERIC_SQL_DATABASE_INDEX,
                         _SqlDatabase,
                         db_name=None,
+                        pool_name=GENERIC_POOL,
                         execution_options={'schema_translate_map': SCHEMA_TRANSLATE_MAP})
 
 
+def get_server_cursor_database():
+  """Returns a singleton database which uses a server-side cursor (see
+  make_server_cursor_database), for request handlers that stream large result sets."""
+  return singletons.get(singletons.SERVER_CURSOR_SQL_DATABASE_INDEX, make_server_cursor_database)
+
+
 def get_db_connection_string(backup=False, instance_name=None):
   if DB_CONNECTION_STRING:
     return DB_CONNECTION_STRING
@@ -78,6 +187,7 @@ def make_server_cursor_database(backup=False, instance_name=None):
     return get_database()
   else:
     if backup:
-      return _BackupSqlDatabase('rdr', connect_args={'cursorclass': SSCursor})
-    return _SqlDatabase('rdr', instance_name=instance_name,
+      return _BackupSqlDatabase('rdr', pool_name=SERVER_CURSOR_POOL,
+                                connect_args={'cursorclass': SSCursor})
+    return _SqlDatabase('rdr', instance_name=instance_name, pool_name=SERVER_CURSOR_POOL,
                         connect_args={'cursorclass': SSCursor})
@@ -4,6 +4,10 @@ import re
 
 from dao.database_factory import get_database
 from datetime import datetime
+from model.log_position import LogPosition
+from sqlalchemy import func, or_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
 
 _DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
 # MySQL uses %i for minutes
@@ -57,3 +61,53 @@ def replace_null_safe_equals(sql):
   if _is_sqlite():
     return re.sub(_NULL_SAFE_PATTERN, r"is", sql)
   return sql
+
+def insert_log_position(session):
+  """Inserts a new LogPosition and returns its ID, for bulk SQL updates to tables that are synced
+  by log position."""
+  log_position = LogPosition()
+  session.add(log_position)
+  session.flush()
+  return log_position.logPositionId
+
+
+def get_settled_log_position(session, cutoff):
+  """Returns the highest log position allocated before cutoff (or 0 if there isn't one). Syncs
+  only return positions up to this one, since transactions that allocated lower positions after
+  cutoff may not have committed yet."""
+  # Scans back from the newest position, so only positions allocated after cutoff are read.
+  settled = (session.query(LogPosition.logPositionId)
+             .filter(or_(LogPosition.created == None, LogPosition.created < cutoff))
+             .order_by(LogPosition.logPositionId.desc())
+             .limit(1)
+             .scalar())
+  return settled or 0
+
+def get_log_position_write_mark(session, log_position_column):
+  """Returns a value that changes whenever a row of log_position_column's table is inserted,
+  deleted or given a new log position. Unlike the highest log position, it also changes when a
+  transaction that allocated a lower position commits after one that allocated a higher one."""
+  # Each write replaces a row's position with a higher one, so the sum grows with every insert and
+  # update whatever order they commit in; the count catches deletes.
+  count, position_sum = session.query(func.count(), func.sum(log_position_column)).one()
+  return count, position_sum
+
+class _Explain(Executable, ClauseElement):
+  """An EXPLAIN of a SELECT statement; its bind parameters are processed as for the statement."""
+  def __init__(self, statement):
+    self.statement = statement
+
+@compiles(_Explain)
+def _compile_explain(element, compiler, **kwargs):
+  return 'EXPLAIN ' + compiler.process(element.statement, **kwargs)
+
+def estimate_row_count(session, query):
+  """Returns the optimizer's estimate of the number of rows a single-table query returns, based on
+  index statistics, or None if the database can't estimate it (e.g. SQLite)."""
+  if _is_sqlite():
+    return None
+  plan = session.execute(_Explain(query.statement)).first()
+  if plan is None or plan['rows'] is None:
+    return None
+  filtered = plan['filtered'] if 'filtered' in plan.keys() and plan['filtered'] else 100
+  return int(plan['rows'] * filtered / 100)
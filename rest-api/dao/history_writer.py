@@ -0,0 +1,71 @@
+"""Writes history rows in bulk when a session commits.
+
+DAOs that keep a history of changes (participants, questionnaires and codes) queue their history
+rows here rather than adding an ORM object for each one. The values are copied from the source
+object's column attributes when the row is queued; when the session commits, pending ORM changes
+are flushed and then each table's queued rows are written with one multi-row Core insert, in the
+order the tables were first queued (so that e.g. questionnaire_history rows go in before the
+questionnaire_concept rows that refer to them). Rows queued in a session that rolls back are
+dropped.
+"""
+import collections
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Key in session.info for rows waiting to be inserted, by table.
+_PENDING_ROWS_KEY = 'pending_history_rows'
+
+# (column name, source attribute key) pairs to copy, by (model type, source type, excluded keys).
+_column_pairs = {}
+_column_pairs_lock = threading.Lock()
+
+
+def _get_column_pairs(model_type, source_type, exclude):
+  cache_key = (model_type, source_type, exclude)
+  pairs = _column_pairs.get(cache_key)
+  if pairs is None:
+    source_keys = set(prop.key for prop in source_type.__mapper__.column_attrs)
+    pairs = tuple((prop.columns[0].name, prop.key)
+                  for prop in model_type.__mapper__.column_attrs
+                  if prop.key in source_keys and prop.key not in exclude)
+    with _column_pairs_lock:
+      _column_pairs[cache_key] = pairs
+  return pairs
+
+
+def add_row(session, model_type, obj, exclude=(), **values):
+  """Queues a row for model_type's table, to be inserted when the session commits.
+
+  The row gets the current values of obj's column attributes that model_type also has (other than
+  the attribute keys in exclude), with values (by attribute key) overriding them.
+  """
+  row = {column_name: getattr(obj, key)
+         for column_name, key in _get_column_pairs(model_type, type(obj), tuple(exclude))}
+  for key, value in values.iteritems():
+    row[getattr(model_type, key).property.columns[0].name] = value
+  pending_rows = session.info.setdefault(_PENDING_ROWS_KEY, collections.OrderedDict())
+  pending_rows.setdefault(model_type.__table__, []).append(row)
+
+
+def flush_rows(session):
+  """Flushes the session, then inserts the rows queued in it. This happens automatically on
+  commit; call it directly only if the rows need to be queried before then."""
+  pending_rows = session.info.pop(_PENDING_ROWS_KEY, None)
+  if not pending_rows:
+    return
+  session.flush()
+  for table, rows in pending_rows.iteritems():
+    session.execute(table.insert(), rows)
+
+
+@event.listens_for(Session, 'before_commit')
+def _before_commit(session):
+  flush_rows(session)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_soft_rollback(session, previous_transaction):
+  #pylint: disable=unused-argument
+  session.info.pop(_PENDING_ROWS_KEY, None)
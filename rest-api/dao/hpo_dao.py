@@ -1,5 +1,5 @@
 from code_constants import UNSET
-from dao.cache_all_dao import CacheAllDao
+from dao.cache_all_dao import CacheAllDao, CACHE_TTL_SECONDS
 from dao.base_dao import FhirMixin, FhirProperty
 from dao.organization_dao import _FhirOrganization, OrganizationDao
 from model.hpo import HPO
@@ -24,7 +24,7 @@ class HPODao(CacheAllDao):
 
   def __init__(self):
     super(HPODao, self).__init__(HPO, cache_index=HPO_CACHE_INDEX,
-                                 cache_ttl_seconds=600, index_field_keys=['name'],
+                                 cache_ttl_seconds=CACHE_TTL_SECONDS, index_field_keys=['name'],
                                  order_by_ending=_ORDER_BY_ENDING)
 
   def _validate_update(self, session, obj, existing_obj):
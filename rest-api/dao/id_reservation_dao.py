@@ -0,0 +1,165 @@
+"""Reserves random IDs ahead of the inserts that use them.
+
+Entities with random IDs (participants, questionnaire responses, etc.) are otherwise inserted with
+an ID picked at insert time, and retried with a new ID if it turns out to be taken. When
+config.RANDOM_ID_POOL_SIZE is set, each server instead keeps a pool of IDs for each ID space that
+it has already checked are unused and recorded in the id_reservation table, so inserts take one
+attempt. DAOs get reserved IDs by passing get_reserved_id to BaseDao as their reserved_id_source.
+"""
+import datetime
+import logging
+import threading
+
+import clock
+import config
+import singletons
+from dao.base_dao import BaseDao
+from model.id_reservation import IdReservation
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import ServiceUnavailable
+
+# Maximum number of IDs reserved in one transaction.
+RESERVATION_BATCH_SIZE = 500
+# Number of times to retry a batch that collides with one reserved by another server.
+MAX_RESERVE_ATTEMPTS = 5
+# How long reservations are kept. By then the ID is normally used, and _remove_unavailable finds
+# it in its own table; an ID that's still unused may be reserved again, and if both are used, the
+# second insert retries with a new ID.
+RESERVATION_EXPIRY = datetime.timedelta(days=1)
+
+
+def get_id_space(model_type, field):
+  """Returns the name of the ID space for a model field, e.g. "participant.participant_id"."""
+  column = getattr(model_type, field).property.columns[0]
+  return '%s.%s' % (model_type.__tablename__, column.name)
+
+
+class IdReservationDao(BaseDao):
+
+  def __init__(self):
+    super(IdReservationDao, self).__init__(IdReservation)
+
+  def get_id(self, obj):
+    return [obj.idSpace, obj.reservedId]
+
+  def reserve_ids(self, model_type, field, count):
+    """Reserves count random IDs for a field of model_type that aren't used in its table and
+    haven't been reserved before. Returns them as a list.
+
+    Bulk inserts can use this to claim a block of IDs up front.
+    """
+    id_space = get_id_space(model_type, field)
+    column = getattr(model_type, field)
+    self._delete_expired(id_space)
+    reserved_ids = []
+    failed_attempts = 0
+    while len(reserved_ids) < count:
+      candidates = set()
+      batch_size = min(count - len(reserved_ids), RESERVATION_BATCH_SIZE)
+      while len(candidates) < batch_size:
+        candidates.add(self._get_random_id())
+      try:
+        with self.session() as session:
+          self._remove_unavailable(session, id_space, column, candidates)
+          if candidates:
+            now = clock.CLOCK.now()
+            session.execute(IdReservation.__table__.insert(),
+                            [{'id_space': id_space, 'reserved_id': candidate, 'reserved': now}
+                             for candidate in candidates])
+      except IntegrityError:
+        # Another server reserved one of the same IDs at the same time; try a new batch.
+        failed_attempts += 1
+        if failed_attempts >= MAX_RESERVE_ATTEMPTS:
+          raise ServiceUnavailable('Giving up after %d reservation attempts.' % failed_attempts)
+        logging.warning('Collision reserving IDs for %s; retrying.', id_space)
+        continue
+      reserved_ids.extend(candidates)
+    return reserved_ids
+
+  def _delete_expired(self, id_space):
+    """Deletes an ID space's reservations older than RESERVATION_EXPIRY, so that the table only
+    holds recent reservations rather than one row for every entity ever inserted."""
+    expired = clock.CLOCK.now() - RESERVATION_EXPIRY
+    with self.session() as session:
+      session.execute(IdReservation.__table__.delete()
+                      .where(IdReservation.idSpace == id_space)
+                      .where(IdReservation.reserved < expired))
+
+  @staticmethod
+  def _remove_unavailable(session, id_space, column, candidates):
+    """Removes IDs that are already used or reserved from candidates."""
+    used = session.query(column).filter(column.in_(candidates)).all()
+    reserved = (session.query(IdReservation.reservedId)
+                .filter(IdReservation.idSpace == id_space)
+                .filter(IdReservation.reservedId.in_(candidates))
+                .all())
+    candidates.difference_update(row[0] for row in used + reserved)
+
+
+class _IdPool(object):
+  """IDs reserved by this server for one ID space, waiting to be used."""
+  def __init__(self, model_type, field):
+    self._model_type = model_type
+    self._field = field
+    self._ids = []
+    self._lock = threading.Lock()
+    self._refilling = False
+
+  def take(self, pool_size):
+    """Returns a reserved ID. If fewer than half of pool_size are left, the caller refills the pool
+    first, while other threads keep taking IDs from it (or, if it's empty, reserve their own)."""
+    with self._lock:
+      refill_count = pool_size - len(self._ids)
+      refill = not self._refilling and len(self._ids) < pool_size / 2
+      if refill:
+        self._refilling = True
+    if refill:
+      self._refill(refill_count)
+    with self._lock:
+      reserved_id = self._ids.pop() if self._ids else None
+    if reserved_id is None:
+      # The pool is empty while another thread refills it, or the refill failed.
+      reserved_id = IdReservationDao().reserve_ids(self._model_type, self._field, 1)[0]
+    return reserved_id
+
+  def _refill(self, count):
+    try:
+      new_ids = IdReservationDao().reserve_ids(self._model_type, self._field, count)
+    except Exception:  # pylint: disable=broad-except
+      logging.warning('Reserving IDs for %s failed.', get_id_space(self._model_type, self._field),
+                      exc_info=True)
+      new_ids = []
+    with self._lock:
+      self._ids.extend(new_ids)
+      self._refilling = False
+
+
+class _IdPools(object):
+  """This server's _IdPools, by ID space."""
+  def __init__(self):
+    self._pools = {}
+    self._lock = threading.Lock()
+
+  def get_pool(self, model_type, field):
+    id_space = get_id_space(model_type, field)
+    with self._lock:
+      pool = self._pools.get(id_space)
+      if pool is None:
+        pool = self._pools[id_space] = _IdPool(model_type, field)
+      return pool
+
+
+def get_reserved_id(model_type, field):
+  """Returns a reserved, unused ID for a field of model_type from this server's pool, or None if
+  the pool is disabled (config.RANDOM_ID_POOL_SIZE is unset or 0) or reserving an ID failed."""
+  pool_size = config.getSetting(config.RANDOM_ID_POOL_SIZE, 0)
+  if not pool_size:
+    return None
+  pools = singletons.get(singletons.ID_RESERVATION_POOL_INDEX, _IdPools)
+  try:
+    return pools.get_pool(model_type, field).take(pool_size)
+  except Exception:  # pylint: disable=broad-except
+    # Fall back to picking an ID at insert time.
+    logging.warning('Reserving an ID for %s failed.', get_id_space(model_type, field),
+                    exc_info=True)
+    return None
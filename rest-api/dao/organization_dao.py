@@ -1,5 +1,6 @@
 import clock
-from dao.cache_all_dao import CacheAllDao
+from dao.cache_all_dao import CacheAllDao, CACHE_TTL_SECONDS
+from dao.database_utils import insert_log_position
 from dao.site_dao import _FhirSite, SiteDao
 from model.organization import Organization
 from singletons import ORGANIZATION_CACHE_INDEX
@@ -20,7 +21,8 @@ class _FhirOrganization(FhirMixin, BackboneElement):
 class OrganizationDao(CacheAllDao):
   def __init__(self):
     super(OrganizationDao, self).__init__(Organization, cache_index=ORGANIZATION_CACHE_INDEX,
-                                 cache_ttl_seconds=600, index_field_keys=['externalId'])
+                                 cache_ttl_seconds=CACHE_TTL_SECONDS,
+                                 index_field_keys=['externalId'])
 
   def _validate_update(self, session, obj, existing_obj):
     # Organizations aren't versioned; suppress the normal check here.
@@ -45,7 +47,8 @@ class OrganizationDao(CacheAllDao):
       participant_summary_sql = """
             UPDATE participant_summary
             SET hpo_id = :hpo_id,
-                last_modified = :now
+                last_modified = :now,
+                log_position_id = :log_position_id
             WHERE organization_id = :org_id;
             """
 
@@ -56,7 +59,8 @@ class OrganizationDao(CacheAllDao):
             WHERE organization_id = :org_id;
             """
       params = {'hpo_id': new_hpo_id, 'provider_link': provider_link, 'org_id':
-                existing_obj.organizationId, 'now': clock.CLOCK.now()}
+                existing_obj.organizationId, 'now': clock.CLOCK.now(),
+                'log_position_id': insert_log_position(session)}
 
       session.execute(participant_sql, params)
       session.execute(participant_summary_sql, params)
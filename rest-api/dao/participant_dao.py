@@ -1,23 +1,50 @@
 import json
+import logging
 
 import clock
 from api_util import format_json_enum, parse_json_enum, format_json_date, format_json_hpo, \
   format_json_org, format_json_site, get_site_id_from_google_group, get_awardee_id_from_name, \
   get_organization_id_from_external_id
 from code_constants import UNSET
+from dao import history_writer, request_scope
 from dao.base_dao import BaseDao, UpdatableDao
 from dao.hpo_dao import HPODao
+from dao.id_reservation_dao import IdReservationDao, get_reserved_id
 from dao.organization_dao import OrganizationDao
 from dao.site_dao import SiteDao
 from model.config_utils import to_client_biobank_id
+from model.log_position import LogPosition
 from model.participant import Participant, ParticipantHistory
 from model.participant_summary import ParticipantSummary
 from model.utils import to_client_participant_id
 from participant_enums import UNSET_HPO_ID, WithdrawalStatus, SuspensionStatus, EnrollmentStatus, \
   make_primary_provider_link_for_id, WithdrawalReason
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.orm import joinedload
 from sqlalchemy.orm.session import make_transient
-from werkzeug.exceptions import BadRequest, Forbidden
+from werkzeug.exceptions import BadRequest, Forbidden, HTTPException, InternalServerError
+
+# Maximum number of participants inserted in one transaction by insert_batch.
+BATCH_INSERT_CHUNK_SIZE = 500
+
+# Key in session.info for participants (with their summaries) locked by get_for_update, by ID.
+_LOCKED_PARTICIPANTS_KEY = 'locked_participants'
+
+
+def _get_locked_participants(session):
+  return session.info.setdefault(_LOCKED_PARTICIPANTS_KEY, {})
+
+
+def get_locked_participant(session, participant_id):
+  """Returns the participant if ParticipantDao.get_for_update has already loaded (and locked) it,
+  along with its summary, in this session; otherwise None."""
+  return _get_locked_participants(session).get(participant_id)
+
+
+def _to_participant_row(obj):
+  """Returns the column values of a Participant (or ParticipantHistory) for a Core insert."""
+  return {prop.columns[0].name: getattr(obj, prop.key)
+          for prop in Participant.__mapper__.column_attrs}
 
 
 class ParticipantHistoryDao(BaseDao):
@@ -42,7 +69,7 @@ class ParticipantHistoryDao(BaseDao):
 
 class ParticipantDao(UpdatableDao):
   def __init__(self):
-    super(ParticipantDao, self).__init__(Participant)
+    super(ParticipantDao, self).__init__(Participant, reserved_id_source=get_reserved_id)
 
     self.hpo_dao = HPODao()
     self.organization_dao = OrganizationDao()
@@ -51,19 +78,20 @@ class ParticipantDao(UpdatableDao):
   def get_id(self, obj):
     return obj.participantId
 
-  def insert_with_session(self, session, obj):
+  def _prepare_insert(self, obj, now):
     obj.hpoId = self._get_hpo_id(obj)
     obj.version = 1
-    obj.signUpTime = clock.CLOCK.now().replace(microsecond=0)
+    obj.signUpTime = now
     obj.lastModified = obj.signUpTime
     if obj.withdrawalStatus is None:
       obj.withdrawalStatus = WithdrawalStatus.NOT_WITHDRAWN
     if obj.suspensionStatus is None:
       obj.suspensionStatus = SuspensionStatus.NOT_SUSPENDED
+
+  def insert_with_session(self, session, obj):
+    self._prepare_insert(obj, clock.CLOCK.now().replace(microsecond=0))
     super(ParticipantDao, self).insert_with_session(session, obj)
-    history = ParticipantHistory()
-    history.fromdict(obj.asdict(), allow_pk=True)
-    session.add(history)
+    history_writer.add_row(session, ParticipantHistory, obj)
     return obj
 
   def insert(self, obj):
@@ -73,6 +101,106 @@ class ParticipantDao(UpdatableDao):
     assert not obj.biobankId
     return self._insert_with_random_id(obj, ('participantId', 'biobankId'))
 
+  def insert_batch(self, participants):
+    """Inserts new participants, BATCH_INSERT_CHUNK_SIZE at a time, with one multi-row insert each
+    for participant and participant_history rows per chunk.
+
+    Returns a list with, for each participant, the inserted participant (or, as with insert(), the
+    existing participant with the same external ID) or the HTTPException that kept it from being
+    inserted. Each chunk is committed separately, so a chunk that fails with a database error
+    gets an InternalServerError for its participants without affecting the others.
+    """
+    results = []
+    for start in range(0, len(participants), BATCH_INSERT_CHUNK_SIZE):
+      results.extend(self._insert_chunk(participants[start:start + BATCH_INSERT_CHUNK_SIZE]))
+    return results
+
+  def _insert_chunk(self, participants):
+    results = [None] * len(participants)
+    now = clock.CLOCK.now().replace(microsecond=0)
+    prepared = []
+    for i, obj in enumerate(participants):
+      try:
+        self._prepare_insert(obj, now)
+      except BadRequest as e:
+        results[i] = e
+        continue
+      prepared.append((i, obj))
+    try:
+      self._insert_prepared(prepared, results)
+    except DBAPIError as e:
+      logging.error('Inserting a chunk of %d participants failed.', len(prepared), exc_info=True)
+      error = InternalServerError('Storing the participant failed: %s' % e.orig)
+      for i, _ in prepared:
+        if results[i] is None:
+          results[i] = error
+    return results
+
+  def _insert_prepared(self, prepared, results):
+    """Inserts a chunk's prepared (index, participant) pairs, setting results."""
+    # Participants with an external ID that's already used (in the database or earlier in the
+    # batch) resolve to the participant that has it.
+    by_external_id = {}
+    external_ids = {obj.externalId for _, obj in prepared if obj.externalId is not None}
+    if external_ids:
+      with self.session() as session:
+        by_external_id = {participant.externalId: participant
+                          for participant in (session.query(Participant)
+                                              .filter(Participant.externalId.in_(external_ids)))}
+    new = []
+    # (index, index of the earlier participant in the chunk with the same external ID) pairs, which
+    # get the same result as it once it's inserted.
+    duplicates = []
+    new_by_external_id = {}
+    for i, obj in prepared:
+      if obj.externalId is not None:
+        if obj.externalId in by_external_id:
+          results[i] = by_external_id[obj.externalId]
+          continue
+        if obj.externalId in new_by_external_id:
+          duplicates.append((i, new_by_external_id[obj.externalId]))
+          continue
+        new_by_external_id[obj.externalId] = i
+      new.append((i, obj))
+    if not new:
+      return
+    self._insert_new(new, results)
+    for i, earlier_index in duplicates:
+      results[i] = results[earlier_index]
+
+  def _insert_new(self, new, results):
+    """Inserts (index, participant) pairs for new participants, setting results."""
+    id_reservation_dao = IdReservationDao()
+    participant_ids = id_reservation_dao.reserve_ids(Participant, 'participantId', len(new))
+    biobank_ids = id_reservation_dao.reserve_ids(Participant, 'biobankId', len(new))
+    for (_, obj), participant_id, biobank_id in zip(new, participant_ids, biobank_ids):
+      obj.participantId = participant_id
+      obj.biobankId = biobank_id
+    rows = [_to_participant_row(obj) for _, obj in new]
+    def insert_rows(session):
+      session.execute(Participant.__table__.insert(), rows)
+      session.execute(ParticipantHistory.__table__.insert(), rows)
+    try:
+      self._database.autoretry(insert_rows, name=type(self).__name__)
+    except IntegrityError as e:
+      # E.g. an ID taken by an insert that didn't reserve it, or an external ID inserted since we
+      # checked. Insert the chunk one at a time, so the retries and errors are per participant.
+      logging.warning('Batch insert of %d participants failed (%s); inserting one at a time.',
+                      len(rows), e.message)
+      for i, obj in new:
+        obj.participantId = None
+        obj.biobankId = None
+        try:
+          results[i] = self.insert(obj)
+        except HTTPException as error:
+          results[i] = error
+        except DBAPIError as error:
+          logging.error('Inserting participant %d of the chunk failed.', i, exc_info=True)
+          results[i] = InternalServerError('Storing the participant failed: %s' % error.orig)
+      return
+    for i, obj in new:
+      results[i] = obj
+
   def _check_if_external_id_exists(self, obj):
     with self.session() as session:
       return session.query(Participant).filter_by(externalId=obj.externalId).first()
@@ -80,9 +208,7 @@ class ParticipantDao(UpdatableDao):
   def _update_history(self, session, obj, existing_obj):
     # Increment the version and add a new history entry.
     obj.version = existing_obj.version + 1
-    history = ParticipantHistory()
-    history.fromdict(obj.asdict(), allow_pk=True)
-    session.add(history)
+    history_writer.add_row(session, ParticipantHistory, obj)
 
   def _validate_update(self, session, obj, existing_obj):
     # Withdrawal and suspension have default values assigned on insert, so they should always have
@@ -102,14 +228,26 @@ class ParticipantDao(UpdatableDao):
       raise Forbidden('Participant %d has withdrawn, cannot unwithdraw' % obj.participantId)
 
   def get_for_update(self, session, obj_id):
+    # The row lock is held until the session ends, so each participant only needs to be fetched
+    # once per session.
+    locked_participants = _get_locked_participants(session)
+    participant = locked_participants.get(obj_id)
+    if participant is not None:
+      request_scope.record_saved_query('participant')
+      return participant
     # Fetch the participant summary at the same time as the participant, as we are potentially
     # updating both.
-    return self.get_with_session(session, obj_id, for_update=True,
-                                 options=joinedload(Participant.participantSummary))
+    participant = self.get_with_session(session, obj_id, for_update=True,
+                                        options=joinedload(Participant.participantSummary))
+    if participant is not None:
+      locked_participants[obj_id] = participant
+    return participant
 
   def _do_update(self, session, obj, existing_obj):
     """Updates the associated ParticipantSummary, and extracts HPO ID from the provider link
       or set pairing at another level (site/organization/awardee) with parent/child enforcement."""
+    # existing_obj may be made transient below, so don't hand it out again.
+    _get_locked_participants(session).pop(obj.participantId, None)
     obj.lastModified = clock.CLOCK.now()
     obj.signUpTime = existing_obj.signUpTime
     obj.biobankId = existing_obj.biobankId
@@ -191,6 +329,7 @@ class ParticipantDao(UpdatableDao):
       summary.suspensionStatus = obj.suspensionStatus
       summary.suspensionTime = obj.suspensionTime
       summary.lastModified = clock.CLOCK.now()
+      summary.logPosition = LogPosition()
       make_transient(summary)
       make_transient(obj)
       obj.participantSummary = summary
@@ -323,7 +462,7 @@ class ParticipantDao(UpdatableDao):
   def add_missing_hpo_from_site(self, session, participant_id, site_id):
     if site_id is None:
       raise BadRequest('No site ID given for auto-pairing participant.')
-    site = SiteDao().get_with_session(session, site_id)
+    site = self.site_dao.get_with_session(session, site_id)
     if site is None:
       raise BadRequest('Invalid siteId reference %r.' % site_id)
 
@@ -340,6 +479,7 @@ class ParticipantDao(UpdatableDao):
     if participant.participantSummary is None:
       raise RuntimeError('No ParticipantSummary available for P%d.' % participant_id)
     participant.participantSummary.hpoId = site.hpoId
+    participant.participantSummary.logPosition = LogPosition()
     participant.lastModified = clock.CLOCK.now()
     # Update the version and add history row
     self._do_update(session, participant, participant)
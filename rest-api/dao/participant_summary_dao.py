@@ -1,18 +1,21 @@
+import collections
 import datetime
 import threading
 import re
 import clock
 import config
-from api_util import format_json_date, format_json_enum, format_json_code, format_json_hpo, \
-  format_json_org, format_json_site
-from code_constants import PPI_SYSTEM, UNSET, BIOBANK_TESTS
+from code_constants import PPI_SYSTEM, UNSET, UNMAPPED, BIOBANK_TESTS
+from dao import request_scope
 from dao.base_dao import UpdatableDao
 from dao.code_dao import CodeDao
-from dao.database_utils import get_sql_and_params_for_array, replace_null_safe_equals
+from dao.database_utils import get_sql_and_params_for_array, replace_null_safe_equals, \
+  insert_log_position, get_settled_log_position, get_log_position_write_mark
 from dao.hpo_dao import HPODao
 from dao.organization_dao import OrganizationDao
+from dao.participant_dao import get_locked_participant
 from dao.site_dao import SiteDao
 from model.config_utils import to_client_biobank_id
+from model.log_position import LogPosition
 from model.participant_summary import ParticipantSummary, WITHDRAWN_PARTICIPANT_FIELDS, \
   WITHDRAWN_PARTICIPANT_VISIBILITY_TIME, SUSPENDED_PARTICIPANT_FIELDS
 from model.utils import to_client_participant_id, get_property_type
@@ -32,10 +35,22 @@ _SITE_FIELDS = ('physicalMeasurementsCreatedSite', 'physicalMeasurementsFinalize
                 'biospecimenSourceSite', 'biospecimenCollectedSite',
                 'biospecimenProcessedSite', 'biospecimenFinalizedSite', 'site')
 
+# Fields used internally that are never returned to clients.
+_NON_CLIENT_FIELDS = ('logPositionId',)
+# Fields selected for every _elements query, since they determine what may be returned (and
+# participantId identifies the resource).
+_PROJECTION_REQUIRED_FIELDS = ('participantId', 'hpoId', 'withdrawalStatus', 'withdrawalTime',
+                               'suspensionStatus', 'dateOfBirth')
+# Client JSON keys that are computed from other fields, rather than written from a column.
+_DERIVED_ELEMENTS = ('ageRange', 'awardee', 'recontactMethod')
+# Maximum number of distinct _elements plans to keep compiled.
+_MAX_ELEMENTS_PLANS = 100
 # Lazy caches of property names for client JSON conversion.
 _DATE_FIELDS = set()
 _ENUM_FIELDS = set()
 _CODE_FIELDS = set()
+# Lazily compiled _ClientJsonPlan for client JSON conversion.
+_client_json_plan = None
 _fields_lock = threading.RLock()
 
 # Query used to update the enrollment status for all participant summaries after
@@ -91,20 +106,20 @@ AND biobank_stored_sample.test = %(sample_param_ref)s)
 
 """
 
-def _get_sample_sql_and_params(now):
-  """Gets SQL and params needed to update status and time fields on the participant summary for
-  each biobank sample.
+def _get_sample_sql_and_params():
+  """Gets SQL and params (apart from now and log_position_id) needed to update status and time
+  fields on the participant summary for each biobank sample.
   """
   sql = """
   UPDATE
     participant_summary
   SET
-    last_modified = :now
+    last_modified = :now,
+    log_position_id = :log_position_id
   """
   params = {
       'received': int(SampleStatus.RECEIVED),
       'unset': int(SampleStatus.UNSET),
-      'now': now
   }
   where_sql = ''
   for i in range(0, len(BIOBANK_TESTS)):
@@ -117,13 +132,13 @@ def _get_sample_sql_and_params(now):
       where_sql += ' or '
     where_sql += _WHERE_SQL % {"test": lower_test, "sample_param_ref": sample_param_ref}
 
-  sql += ' WHERE ' + where_sql
+  # Parenthesized so that participant filters can be added with AND.
+  sql += ' WHERE (' + where_sql + ')'
 
   return sql, params
 
-def _get_baseline_sql_and_params():
-  tests_sql, params = get_sql_and_params_for_array(
-      config.getSettingList(config.BASELINE_SAMPLE_TEST_CODES), 'baseline')
+def _get_baseline_sql_and_params(snapshot):
+  tests_sql, params = get_sql_and_params_for_array(snapshot.baseline_sample_test_codes, 'baseline')
   return (
       """
       (
@@ -140,9 +155,8 @@ def _get_baseline_sql_and_params():
       params
   )
 
-def _get_dna_isolates_sql_and_params():
-  tests_sql, params = get_sql_and_params_for_array(
-      config.getSettingList(config.DNA_SAMPLE_TEST_CODES), 'dna')
+def _get_dna_isolates_sql_and_params(snapshot):
+  tests_sql, params = get_sql_and_params_for_array(snapshot.dna_sample_test_codes, 'dna')
   params.update({
       'received': int(SampleStatus.RECEIVED),
       'unset': int(SampleStatus.UNSET)
@@ -160,16 +174,16 @@ def _get_dna_isolates_sql_and_params():
       params
   )
 
-def _get_sample_status_time_sql_and_params():
+def _get_sample_status_time_sql(snapshot):
   """Gets SQL that to update enrollmentStatusCoreStoredSampleTime field
   on the participant summary.
   """
 
-  dns_test_list = config.getSettingList(config.DNA_SAMPLE_TEST_CODES)
+  dns_test_list = snapshot.dna_sample_test_codes
 
   status_time_sql = '%s' % ','.join(["""COALESCE(sample_status_%s_time, '3000-01-01')""" % item
                                      for item in dns_test_list])
-  baseline_ppi_module_fields = config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS, [])
+  baseline_ppi_module_fields = snapshot.baseline_ppi_questionnaire_fields
 
   baseline_ppi_module_sql = '%s' % ','.join(["""%s_time""" % re.sub('(?<!^)(?=[A-Z])', '_', item)
                                             .lower() for item in baseline_ppi_module_fields])
@@ -208,6 +222,49 @@ def _get_sample_status_time_sql_and_params():
 
   return sql
 
+# SQL and params (apart from now, log_position_id and participant_id) for the statements run by
+# update_from_biobank_stored_samples.
+_BiobankUpdateSql = collections.namedtuple('_BiobankUpdateSql', [
+    'sample_sql', 'sample_params', 'counts_sql', 'counts_params', 'enrollment_status_params',
+    'sample_status_time_sql'])
+
+def _build_biobank_update_sql(snapshot):
+  """Renders the SQL for update_from_biobank_stored_samples; computed once per config snapshot."""
+  sample_sql, sample_params = _get_sample_sql_and_params()
+  baseline_tests_sql, baseline_tests_params = _get_baseline_sql_and_params(snapshot)
+  dna_tests_sql, dna_tests_params = _get_dna_isolates_sql_and_params(snapshot)
+  counts_sql = """
+    UPDATE
+      participant_summary
+    SET
+      num_baseline_samples_arrived = {baseline_tests_sql},
+      samples_to_isolate_dna = {dna_tests_sql},
+      last_modified = :now,
+      log_position_id = :log_position_id
+    WHERE
+      (num_baseline_samples_arrived != {baseline_tests_sql} OR
+       samples_to_isolate_dna != {dna_tests_sql})
+    """.format(
+           baseline_tests_sql=baseline_tests_sql,
+           dna_tests_sql=dna_tests_sql)
+  counts_params = dict(baseline_tests_params)
+  counts_params.update(dna_tests_params)
+  enrollment_status_params = {'submitted': int(QuestionnaireStatus.SUBMITTED),
+                              'unset': int(QuestionnaireStatus.UNSET),
+                              'num_baseline_ppi_modules': snapshot.num_baseline_ppi_modules,
+                              'completed': int(PhysicalMeasurementsStatus.COMPLETED),
+                              'received': int(SampleStatus.RECEIVED),
+                              'full_participant': int(EnrollmentStatus.FULL_PARTICIPANT),
+                              'member': int(EnrollmentStatus.MEMBER),
+                              'interested': int(EnrollmentStatus.INTERESTED)}
+  return _BiobankUpdateSql(sample_sql, sample_params, counts_sql, counts_params,
+                           enrollment_status_params, _get_sample_status_time_sql(snapshot))
+
+def _get_dna_sample_time_keys(snapshot, field_name_prefix):
+  return snapshot.get_derived(
+      ('dna_sample_time_keys', field_name_prefix),
+      lambda s: frozenset(field_name_prefix + '%sTime' % test for test in s.dna_sample_test_codes))
+
 class ParticipantSummaryDao(UpdatableDao):
 
   def __init__(self):
@@ -221,6 +278,54 @@ class ParticipantSummaryDao(UpdatableDao):
   def get_id(self, obj):
     return obj.participantId
 
+  def insert_with_session(self, session, obj):
+    obj.logPosition = LogPosition()
+    return super(ParticipantSummaryDao, self).insert_with_session(session, obj)
+
+  def _do_update(self, session, obj, existing_obj):
+    obj.logPosition = LogPosition()
+    super(ParticipantSummaryDao, self)._do_update(session, obj, existing_obj)
+
+  def get_for_update(self, session, obj_id):
+    # ParticipantDao.get_for_update locks the summary along with the participant.
+    participant = get_locked_participant(session, obj_id)
+    if participant is not None and participant.participantSummary is not None:
+      request_scope.record_saved_query('participantSummary')
+      return participant.participantSummary
+    return super(ParticipantSummaryDao, self).get_for_update(session, obj_id)
+
+  def _get_write_high_water_mark(self, session):
+    # Every participant summary write gets a new log position.
+    return get_log_position_write_mark(session, ParticipantSummary.logPositionId)
+
+  def _get_total_cache_key(self, query_def):
+    key = super(ParticipantSummaryDao, self)._get_total_cache_key(query_def)
+    if (not self._has_withdrawn_filter(query_def)
+        and self._get_non_withdrawn_filter_field(query_def)):
+      # _initialize_query hides participants withdrawn before a cutoff that moves with the clock.
+      withdrawn_visible_start = clock.CLOCK.now() - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME
+      return key + (withdrawn_visible_start.date(),)
+    return key
+
+  def get_etag_values(self, participant_id):
+    """Returns values which change whenever the client JSON for the participant's summary may
+    change, without loading the whole summary, or None if there's no summary."""
+    with self.session() as session:
+      row = (session.query(ParticipantSummary.logPositionId, ParticipantSummary.lastModified,
+                           ParticipantSummary.withdrawalStatus, ParticipantSummary.withdrawalTime)
+             .filter(ParticipantSummary.participantId == participant_id)
+             .first())
+    if row is None:
+      return None
+    log_position_id, last_modified, withdrawal_status, withdrawal_time = row
+    now = clock.CLOCK.now()
+    # Withdrawn participants' fields are cleared once they've been withdrawn for long enough, and
+    # age ranges change on birthdays, neither of which involves a write.
+    withdrawn_hidden = (withdrawal_status == WithdrawalStatus.NO_USE and
+                        (withdrawal_time is None or
+                         withdrawal_time < now - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME))
+    return log_position_id, last_modified, withdrawn_hidden, now.date()
+
   def get_by_email(self, email):
     with self.session() as session:
       return session.query(ParticipantSummary).filter(ParticipantSummary.email == email).all()
@@ -275,7 +380,24 @@ class ParticipantSummaryDao(UpdatableDao):
       return _WITHDRAWN_ORDER_BY_ENDING
     return self.order_by_ending
 
+  def _add_order_by_ending(self, query, field_names, fields):
+    if field_names == ['logPositionId']:
+      # Rows written by the same bulk update share a log position; break ties on participant ID
+      # alone so that syncs remain an index range scan.
+      field_names.append('participantId')
+      fields.append(ParticipantSummary.participantId)
+      return query.order_by(ParticipantSummary.participantId)
+    return super(ParticipantSummaryDao, self)._add_order_by_ending(query, field_names, fields)
+
   def _add_order_by(self, query, order_by, field_names, fields):
+    if order_by.field_name == 'logPositionId':
+      # A lower log position can commit after a higher one has been synced past; only return
+      # positions allocated long enough ago that their transactions have committed. (Totals
+      # aren't held back, as they don't go through here.)
+      cutoff = clock.CLOCK.now() - datetime.timedelta(
+          seconds=config.LOG_POSITION_SYNC_HOLDBACK_SECONDS)
+      query = query.filter(ParticipantSummary.logPositionId <=
+                           get_settled_log_position(query.session, cutoff))
     if order_by.field_name in _CODE_FILTER_FIELDS:
       return super(ParticipantSummaryDao, self)._add_order_by(query,
                                                               OrderBy(order_by.field_name + 'Id',
@@ -318,42 +440,32 @@ class ParticipantSummaryDao(UpdatableDao):
 
   def update_from_biobank_stored_samples(self, participant_id=None):
     """Rewrites sample-related summary data. Call this after updating BiobankStoredSamples.
-    If participant_id is provided, only that participant will have their summary updated."""
+    If participant_id is provided, only that participant will have their summary updated.
+
+    The updates are recomputed from scratch, so the transaction is retried if it deadlocks with
+    (or times out waiting for) concurrent participant summary updates."""
+    self._database.autoretry(
+        lambda session: self.update_from_biobank_stored_samples_with_session(
+            session, participant_id=participant_id),
+        name=type(self).__name__)
+
+  def update_from_biobank_stored_samples_with_session(self, session, participant_id=None,
+                                                      participant_id_range=None):
+    """Rewrites sample-related summary data in an existing session. If participant_id_range (a
+    pair of first and last IDs) is provided, only summaries for participants with IDs in that
+    range are updated."""
     now = clock.CLOCK.now()
-    sample_sql, sample_params = _get_sample_sql_and_params(now)
-
-    baseline_tests_sql, baseline_tests_params = _get_baseline_sql_and_params()
-    dna_tests_sql, dna_tests_params = _get_dna_isolates_sql_and_params()
-
-    sample_status_time_sql = _get_sample_status_time_sql_and_params()
-    sample_status_time_params = {}
-
-    counts_sql = """
-    UPDATE
-      participant_summary
-    SET
-      num_baseline_samples_arrived = {baseline_tests_sql},
-      samples_to_isolate_dna = {dna_tests_sql},
-      last_modified = :now
-    WHERE
-      num_baseline_samples_arrived != {baseline_tests_sql} OR
-      samples_to_isolate_dna != {dna_tests_sql}
-    """.format(
-           baseline_tests_sql=baseline_tests_sql,
-           dna_tests_sql=dna_tests_sql)
-    counts_params = {'now': now}
-    counts_params.update(baseline_tests_params)
-    counts_params.update(dna_tests_params)
-
+    update_sql = config.get_snapshot().get_derived('biobank_update_sql',
+                                                   _build_biobank_update_sql)
+    # The params are shared with other requests, so copy them before adding to them.
+    sample_sql = update_sql.sample_sql
+    sample_params = dict(update_sql.sample_params, now=now)
+    counts_sql = update_sql.counts_sql
+    counts_params = dict(update_sql.counts_params, now=now)
     enrollment_status_sql = _ENROLLMENT_STATUS_SQL
-    enrollment_status_params = {'submitted': int(QuestionnaireStatus.SUBMITTED),
-                                'unset': int(QuestionnaireStatus.UNSET),
-                                'num_baseline_ppi_modules': self._get_num_baseline_ppi_modules(),
-                                'completed': int(PhysicalMeasurementsStatus.COMPLETED),
-                                'received': int(SampleStatus.RECEIVED),
-                                'full_participant': int(EnrollmentStatus.FULL_PARTICIPANT),
-                                'member': int(EnrollmentStatus.MEMBER),
-                                'interested': int(EnrollmentStatus.INTERESTED)}
+    enrollment_status_params = dict(update_sql.enrollment_status_params)
+    sample_status_time_sql = update_sql.sample_status_time_sql
+    sample_status_time_params = {}
 
     # If participant_id is provided, add the participant ID filter to all update statements.
     if participant_id:
@@ -365,17 +477,31 @@ class ParticipantSummaryDao(UpdatableDao):
       enrollment_status_params['participant_id'] = participant_id
       sample_status_time_sql += ' AND a.participant_id = :participant_id'
       sample_status_time_params['participant_id'] = participant_id
+    elif participant_id_range:
+      range_params = {'first_participant_id': participant_id_range[0],
+                      'last_participant_id': participant_id_range[1]}
+      range_sql = ' participant_id BETWEEN :first_participant_id AND :last_participant_id'
+      sample_sql += ' AND' + range_sql
+      sample_params.update(range_params)
+      counts_sql += ' AND' + range_sql
+      counts_params.update(range_params)
+      enrollment_status_sql += ' WHERE' + range_sql
+      enrollment_status_params.update(range_params)
+      sample_status_time_sql += ' AND a.' + range_sql.lstrip()
+      sample_status_time_params.update(range_params)
 
     sample_sql = replace_null_safe_equals(sample_sql)
     counts_sql = replace_null_safe_equals(counts_sql)
-    with self.session() as session:
-      session.execute(sample_sql, sample_params)
-      session.execute(counts_sql, counts_params)
-      session.execute(enrollment_status_sql, enrollment_status_params)
-      session.execute(sample_status_time_sql, sample_status_time_params)
+    log_position_id = insert_log_position(session)
+    sample_params['log_position_id'] = log_position_id
+    counts_params['log_position_id'] = log_position_id
+    session.execute(sample_sql, sample_params)
+    session.execute(counts_sql, counts_params)
+    session.execute(enrollment_status_sql, enrollment_status_params)
+    session.execute(sample_status_time_sql, sample_status_time_params)
 
   def _get_num_baseline_ppi_modules(self):
-    return len(config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS))
+    return config.get_snapshot().num_baseline_ppi_modules
 
   def update_enrollment_status(self, summary):
     """Updates the enrollment status field on the provided participant summary to
@@ -457,8 +583,7 @@ class ParticipantSummaryDao(UpdatableDao):
 
   def calculate_max_core_sample_time(self, participant_summary, field_name_prefix='sampleStatus'):
 
-    keys = [field_name_prefix + '%sTime' % test
-            for test in config.getSettingList(config.DNA_SAMPLE_TEST_CODES)]
+    keys = _get_dna_sample_time_keys(config.get_snapshot(), field_name_prefix)
     sample_time_list = \
       [v for k, v in participant_summary if k in keys and v is not None]
 
@@ -475,54 +600,64 @@ class ParticipantSummaryDao(UpdatableDao):
       return None
 
   def to_client_json(self, model):
-    result = model.asdict()
+    plan = _get_client_json_plan()
+    return self._values_to_client_json(plan,
+                                       [getattr(model, field_name)
+                                        for field_name in plan.field_names])
+
+  def to_client_json_from_row(self, row, elements=None):
+    """Converts a raw result row (selecting get_client_json_fields(), in order) to client JSON,
+    without building a ParticipantSummary.
+
+    If elements is set, the row is from a query made with Query.elements, and only those elements
+    (and participantId) are returned.
+    """
+    plan = _get_client_json_plan()
+    if elements:
+      plan = plan.for_elements(elements)
+    return self._values_to_client_json(plan, row)
+
+  @staticmethod
+  def get_client_json_fields():
+    """Returns the ParticipantSummary fields to select for to_client_json_from_row()."""
+    return _get_client_json_plan().fields
+
+  def _get_projection_fields(self, elements):
+    return list(_get_client_json_plan().for_elements(elements).fields)
+
+  def _values_to_client_json(self, plan, values):
+    now = clock.CLOCK.now()
+    withdrawn = values[plan.withdrawal_status_index] == WithdrawalStatus.NO_USE
+    suspended = values[plan.suspension_status_index] == SuspensionStatus.NO_CONTACT
+    withdrawal_time = values[plan.withdrawal_time_index]
+    result = {}
     # Participants that withdrew more than 48 hours ago should have fields other than
     # WITHDRAWN_PARTICIPANT_FIELDS cleared.
-    if (model.withdrawalStatus == WithdrawalStatus.NO_USE and
-        (model.withdrawalTime is None or
-         model.withdrawalTime < clock.CLOCK.now() - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME)):
-      result = {k: result.get(k) for k in WITHDRAWN_PARTICIPANT_FIELDS}
-
-    elif model.withdrawalStatus != WithdrawalStatus.NO_USE and \
-      model.suspensionStatus == SuspensionStatus.NO_CONTACT:
-      for i in SUSPENDED_PARTICIPANT_FIELDS:
-        result[i] = UNSET
-
-    result['participantId'] = to_client_participant_id(model.participantId)
-    biobank_id = result.get('biobankId')
-    if biobank_id:
-      result['biobankId'] = to_client_biobank_id(biobank_id)
-    date_of_birth = result.get('dateOfBirth')
+    if withdrawn and (withdrawal_time is None or
+                      withdrawal_time < now - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME):
+      columns = plan.withdrawn_columns
+      for output_key in plan.withdrawn_unset_keys:
+        result[output_key] = UNSET
+    else:
+      columns = plan.indexed_columns
+    for i, column in columns:
+      value = column.format_value(self, values[i])
+      if value is not None:
+        result[column.output_key] = value
+
+    if not withdrawn and suspended:
+      for field_name in SUSPENDED_PARTICIPANT_FIELDS:
+        result[field_name] = UNSET
+    date_of_birth = values[plan.date_of_birth_index]
     if date_of_birth:
-      result['ageRange'] = get_bucketed_age(date_of_birth, clock.CLOCK.now())
+      result['ageRange'] = get_bucketed_age(date_of_birth, now)
     else:
       result['ageRange'] = UNSET
-
-    if result.get('primaryLanguage') is None:
-      result['primaryLanguage'] = UNSET
-
-    if 'organizationId' in result:
-      result['organization'] = result['organizationId']
-      del result['organizationId']
-      format_json_org(result, self.organization_dao, 'organization')
-
-    format_json_hpo(result, self.hpo_dao, 'hpoId')
     result['awardee'] = result['hpoId']
-    _initialize_field_type_sets()
-    for fieldname in _DATE_FIELDS:
-      format_json_date(result, fieldname)
-    for fieldname in _CODE_FIELDS:
-      format_json_code(result, self.code_dao, fieldname)
-    for fieldname in _ENUM_FIELDS:
-      format_json_enum(result, fieldname)
-    for fieldname in _SITE_FIELDS:
-      format_json_site(result, self.site_dao, fieldname)
-    if (model.withdrawalStatus == WithdrawalStatus.NO_USE or
-        model.suspensionStatus == SuspensionStatus.NO_CONTACT):
+    if withdrawn or suspended:
       result['recontactMethod'] = 'NO_CONTACT'
-    # Strip None values.
-    result = {k: v for k, v in result.iteritems() if v is not None}
-
+    if plan.output_keys is not None:
+      return {key: value for key, value in result.iteritems() if key in plan.output_keys}
     return result
 
   def _decode_token(self, query_def, fields):
@@ -539,16 +674,145 @@ class ParticipantSummaryDao(UpdatableDao):
     return decoded_vals
 
 
+# How one ParticipantSummary column is written to client JSON. format_value takes the DAO and the
+# column value, and returns the JSON value (or None to leave output_key out of the result).
+_ClientJsonColumn = collections.namedtuple('_ClientJsonColumn',
+                                           ('field_name', 'output_key', 'format_value'))
+
+
+def _format_value(dao, value):  # pylint: disable=unused-argument
+  return value
+
+
+def _format_value_or_unset(dao, value):  # pylint: disable=unused-argument
+  return UNSET if value is None else value
+
+
+def _format_participant_id(dao, value):  # pylint: disable=unused-argument
+  return to_client_participant_id(value)
+
+
+def _format_biobank_id(dao, value):  # pylint: disable=unused-argument
+  return to_client_biobank_id(value) if value else value
+
+
+def _format_date(dao, value):  # pylint: disable=unused-argument
+  return None if value is None else value.isoformat()
+
+
+def _format_enum(dao, value):  # pylint: disable=unused-argument
+  return UNSET if value is None else str(value)
+
+
+def _format_code(dao, value):
+  if not value:
+    return UNSET
+  code = dao.code_dao.get(value)
+  return code.value if code.mapped else UNMAPPED
+
+
+def _format_hpo(dao, value):
+  return dao.hpo_dao.get(value).name if value else UNSET
+
+
+def _format_organization(dao, value):
+  return dao.organization_dao.get(value).externalId if value else UNSET
+
+
+def _format_site(dao, value):
+  return UNSET if value is None else dao.site_dao.get(value).googleGroup
+
+
+# Formatters which write UNSET when there is no value, rather than leaving the field out.
+_UNSET_FORMATTERS = (_format_value_or_unset, _format_enum, _format_code, _format_hpo,
+                     _format_organization, _format_site)
+
+
+class _ClientJsonPlan(object):
+  """Instructions for converting participant summary values to client JSON, compiled once from
+  the ParticipantSummary mapper.
+
+  columns lists a _ClientJsonColumn for each field in field_names / fields (in the same order),
+  so that values can come either from a model object or from a raw result row. If output_keys is
+  set, only those keys are kept in the result.
+  """
+  def __init__(self, columns, output_keys=None):
+    self.columns = columns
+    self.output_keys = output_keys
+    self.field_names = [column.field_name for column in columns]
+    self.fields = [getattr(ParticipantSummary, field_name) for field_name in self.field_names]
+    self.indexed_columns = list(enumerate(columns))
+    self.withdrawn_columns = [(i, column) for i, column in self.indexed_columns
+                              if column.field_name in WITHDRAWN_PARTICIPANT_FIELDS]
+    # Fields that aren't returned for withdrawn participants, but are present as UNSET.
+    self.withdrawn_unset_keys = [column.output_key for column in columns
+                                 if column.field_name not in WITHDRAWN_PARTICIPANT_FIELDS
+                                 and column.format_value in _UNSET_FORMATTERS]
+    self.withdrawal_status_index = self.field_names.index('withdrawalStatus')
+    self.withdrawal_time_index = self.field_names.index('withdrawalTime')
+    self.suspension_status_index = self.field_names.index('suspensionStatus')
+    self.date_of_birth_index = self.field_names.index('dateOfBirth')
+    self._element_plans = {}
+
+  def for_elements(self, elements):
+    """Returns a plan for a query selecting only the named client JSON elements."""
+    output_keys = frozenset(elements) | frozenset(['participantId'])
+    plan = self._element_plans.get(output_keys)
+    if plan is None:
+      valid_keys = set(column.output_key for column in self.columns) | set(_DERIVED_ELEMENTS)
+      invalid_keys = output_keys - valid_keys
+      if invalid_keys:
+        raise BadRequest('Invalid _elements: %s.' % ', '.join(sorted(invalid_keys)))
+      plan = _ClientJsonPlan([column for column in self.columns
+                              if column.output_key in output_keys
+                              or column.field_name in _PROJECTION_REQUIRED_FIELDS],
+                             output_keys)
+      if len(self._element_plans) >= _MAX_ELEMENTS_PLANS:
+        self._element_plans.clear()
+      self._element_plans[output_keys] = plan
+    return plan
+
+
+def _get_client_json_plan():
+  if _client_json_plan is None:
+    _initialize_field_type_sets()
+  return _client_json_plan
+
+
+def _make_client_json_column(field_name):
+  if field_name == 'participantId':
+    return _ClientJsonColumn(field_name, field_name, _format_participant_id)
+  if field_name == 'biobankId':
+    return _ClientJsonColumn(field_name, field_name, _format_biobank_id)
+  if field_name == 'hpoId':
+    return _ClientJsonColumn(field_name, field_name, _format_hpo)
+  if field_name == 'organizationId':
+    return _ClientJsonColumn(field_name, 'organization', _format_organization)
+  if field_name == 'primaryLanguage':
+    return _ClientJsonColumn(field_name, field_name, _format_value_or_unset)
+  field_without_id = field_name[0:len(field_name) - 2]
+  if field_name.endswith('Id') and field_without_id in _SITE_FIELDS:
+    return _ClientJsonColumn(field_name, field_without_id, _format_site)
+  if field_name in _DATE_FIELDS:
+    return _ClientJsonColumn(field_name, field_name, _format_date)
+  if field_name in _ENUM_FIELDS:
+    return _ClientJsonColumn(field_name, field_name, _format_enum)
+  if field_name in _CODE_FIELDS:
+    return _ClientJsonColumn(field_name, field_without_id, _format_code)
+  return _ClientJsonColumn(field_name, field_name, _format_value)
+
+
 def _initialize_field_type_sets():
-  """Using reflection, populate _DATE_FIELDS, _ENUM_FIELDS, and _CODE_FIELDS, which are
-  used when formatting JSON from participant summaries.
+  """Using reflection, populate _DATE_FIELDS, _ENUM_FIELDS, and _CODE_FIELDS, and compile
+  _client_json_plan from them; these are used when formatting JSON from participant summaries.
 
   We call this lazily to avoid having issues with the code getting executed while SQLAlchemy
   is still initializing itself. Locking ensures we only run throught the code once.
   """
+  global _client_json_plan
   with _fields_lock:
     # Return if this is already initialized.
-    if _DATE_FIELDS:
+    if _client_json_plan is not None:
       return
     for prop_name in dir(ParticipantSummary):
       if prop_name.startswith("_"):
@@ -569,3 +833,7 @@ def _initialize_field_type_sets():
               if fk._get_colspec() == 'code.code_id':
                 _CODE_FIELDS.add(prop_name)
                 break
+    _client_json_plan = _ClientJsonPlan(
+        [_make_client_json_column(column_property.key)
+         for column_property in ParticipantSummary.__mapper__.column_attrs
+         if column_property.key not in _NON_CLIENT_FIELDS])
@@ -0,0 +1,32 @@
+import clock
+from dao.base_dao import BaseDao
+from model.participant_summary_rebuild import ParticipantSummaryRebuildShard
+
+
+class ParticipantSummaryRebuildShardDao(BaseDao):
+
+  def __init__(self):
+    super(ParticipantSummaryRebuildShardDao, self).__init__(ParticipantSummaryRebuildShard)
+
+  def get_id(self, obj):
+    return [obj.jobId, obj.shard]
+
+  def create_job(self, job_id, id_ranges, batch_size, dry_run):
+    """Inserts a shard for each (start ID, end ID) pair in id_ranges, and returns them."""
+    now = clock.CLOCK.now()
+    shards = [ParticipantSummaryRebuildShard(jobId=job_id, shard=shard, startId=start_id,
+                                             endId=end_id, nextId=start_id, batchSize=batch_size,
+                                             dryRun=dry_run, checked=0, changed=0, skipped=0,
+                                             errors=0, started=now, updated=now)
+              for shard, (start_id, end_id) in enumerate(id_ranges)]
+    with self.session() as session:
+      for shard in shards:
+        self.insert_with_session(session, shard)
+    return shards
+
+  def get_job_shards(self, job_id):
+    with self.session() as session:
+      return (session.query(ParticipantSummaryRebuildShard)
+              .filter(ParticipantSummaryRebuildShard.jobId == job_id)
+              .order_by(ParticipantSummaryRebuildShard.shard)
+              .all())
@@ -5,7 +5,10 @@ import clock
 import fhirclient.models.observation
 from api_util import parse_date
 from concepts import Concept
+from dao import request_scope
 from dao.base_dao import UpdatableDao
+from dao.database_utils import get_log_position_write_mark
+from dao.id_reservation_dao import get_reserved_id
 from dao.participant_dao import ParticipantDao, raise_if_withdrawn
 from dao.participant_summary_dao import ParticipantSummaryDao
 from dao.site_dao import SiteDao
@@ -37,15 +40,20 @@ class PhysicalMeasurementsDao(UpdatableDao):
 
   def __init__(self):
     super(PhysicalMeasurementsDao, self).__init__(PhysicalMeasurements,
-                                                  order_by_ending=['logPositionId'])
+                                                  order_by_ending=['logPositionId'],
+                                                  reserved_id_source=get_reserved_id)
 
   def get_id(self, obj):
     return obj.physicalMeasurementsId
 
+  def _get_write_high_water_mark(self, session):
+    # Every insert, cancellation and restoration gets a new log position.
+    return get_log_position_write_mark(session, PhysicalMeasurements.logPositionId)
+
   def get_with_session(self, session, obj_id, **kwargs):
     result = super(PhysicalMeasurementsDao, self).get_with_session(session, obj_id, **kwargs)
     if result:
-      ParticipantDao().validate_participant_reference(session, result)
+      request_scope.get_dao(ParticipantDao).validate_participant_reference(session, result)
     return result
 
   def get_with_children(self, physical_measurements_id, for_update=False):
@@ -204,7 +212,7 @@ class PhysicalMeasurementsDao(UpdatableDao):
     # who have subsequently withdrawn; for all requests that do specify a participant ID,
     # make sure the participant exists and is not withdrawn.
     if participant_id:
-      ParticipantDao().validate_participant_id(session, participant_id)
+      request_scope.get_dao(ParticipantDao).validate_participant_id(session, participant_id)
     return super(PhysicalMeasurementsDao, self)._initialize_query(session, query_def)
 
   def _measurements_as_dict(self, measurements):
@@ -268,7 +276,7 @@ class PhysicalMeasurementsDao(UpdatableDao):
     inserted_obj = super(PhysicalMeasurementsDao, self).insert_with_session(session, obj)
     if not is_amendment:  # Amendments aren't expected to have site ID extensions.
       if participant_summary.biospecimenCollectedSiteId is None:
-        ParticipantDao().add_missing_hpo_from_site(
+        request_scope.get_dao(ParticipantDao).add_missing_hpo_from_site(
             session, inserted_obj.participantId, inserted_obj.finalizedSiteId)
 
     # Flush to assign an ID to the measurements, as the client doesn't provide one.
@@ -282,8 +290,8 @@ class PhysicalMeasurementsDao(UpdatableDao):
     participant_id = obj.participantId
     if participant_id is None:
       raise BadRequest('participantId is required')
-    participant_summary_dao = ParticipantSummaryDao()
-    participant = ParticipantDao().get_for_update(session, participant_id)
+    participant_summary_dao = request_scope.get_dao(ParticipantSummaryDao)
+    participant = request_scope.get_dao(ParticipantDao).get_for_update(session, participant_id)
     if not participant:
       raise BadRequest("Can't submit physical measurements for unknown participant %s"
                        % participant_id)
@@ -293,6 +301,7 @@ class PhysicalMeasurementsDao(UpdatableDao):
                        participant_id)
     raise_if_withdrawn(participant_summary)
     participant_summary.lastModified = clock.CLOCK.now()
+    participant_summary.logPosition = LogPosition()
 
     # These fields set on measurement that is cancelled and doesn't have a previous good measurement
     if obj.status and obj.status == PhysicalMeasurementsStatus.CANCELLED and not \
@@ -304,11 +313,7 @@ class PhysicalMeasurementsDao(UpdatableDao):
     # These fields set on any measurement not cancelled
     elif obj.status != PhysicalMeasurementsStatus.CANCELLED:
       # new PM or if a PM was restored, it is complete again.
-      participant_summary.physicalMeasurementsStatus = PhysicalMeasurementsStatus.COMPLETED
-      participant_summary.physicalMeasurementsTime = obj.created
-      participant_summary.physicalMeasurementsFinalizedTime = obj.finalized
-      participant_summary.physicalMeasurementsCreatedSiteId = obj.createdSiteId
-      participant_summary.physicalMeasurementsFinalizedSiteId = obj.finalizedSiteId
+      self.set_participant_summary_fields(obj, participant_summary)
 
     elif obj.status and obj.status == PhysicalMeasurementsStatus.CANCELLED and \
        self.has_uncancelled_pm(session, participant):
@@ -324,6 +329,15 @@ class PhysicalMeasurementsDao(UpdatableDao):
 
     return participant_summary
 
+  @staticmethod
+  def set_participant_summary_fields(obj, participant_summary):
+    """Sets the summary fields for a completed physical measurement."""
+    participant_summary.physicalMeasurementsStatus = PhysicalMeasurementsStatus.COMPLETED
+    participant_summary.physicalMeasurementsTime = obj.created
+    participant_summary.physicalMeasurementsFinalizedTime = obj.finalized
+    participant_summary.physicalMeasurementsCreatedSiteId = obj.createdSiteId
+    participant_summary.physicalMeasurementsFinalizedSiteId = obj.finalizedSiteId
+
   def get_latest_pm(self, session, participant):
     return session.query(PhysicalMeasurements).filter_by(participantId=participant.participantId).\
                         filter(PhysicalMeasurements.finalized != None).order_by(
@@ -402,6 +416,7 @@ class PhysicalMeasurementsDao(UpdatableDao):
       measurement.finalizedUsername = author
       measurement.finalized = clock.CLOCK.now()
 
+    measurement.logPosition = LogPosition()
     logging.info('%s %s physical measuremnt %s.', author, resource['status'],
                  measurement.physicalMeasurementsId)
     payload = self.add_root_fields_to_resource(measurement)
@@ -552,7 +567,7 @@ class PhysicalMeasurementsDao(UpdatableDao):
       logging.warn("Invalid location: %s" % location_value)
       return None
     google_group = location_value[len(_LOCATION_PREFIX):]
-    site = SiteDao().get_by_google_group(google_group)
+    site = request_scope.get_dao(SiteDao).get_by_google_group(google_group)
     if not site:
       logging.warn("Unknown site: %s" % google_group)
       return None
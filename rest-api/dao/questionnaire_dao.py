@@ -1,15 +1,23 @@
 import clock
+import collections
 import json
+import threading
 
 import fhirclient.models.questionnaire
+from sqlalchemy import and_
 from sqlalchemy.orm import subqueryload
 from werkzeug.exceptions import BadRequest
 
+from dao import history_writer
 from dao.base_dao import BaseDao, UpdatableDao
 from code_constants import PPI_EXTRA_SYSTEM
 from model.code import CodeType
 from model.questionnaire import Questionnaire, QuestionnaireHistory, QuestionnaireConcept
 from model.questionnaire import QuestionnaireQuestion
+import singletons
+
+# Maximum number of questionnaire versions kept in memory by QuestionnaireHistoryDao.get_version.
+QUESTIONNAIRE_VERSION_CACHE_SIZE = 200
 
 
 class QuestionnaireDao(UpdatableDao):
@@ -36,23 +44,18 @@ class QuestionnaireDao(UpdatableDao):
                 .options(subqueryload(Questionnaire.questions))
                 .first())
 
-  def _make_history(self, questionnaire, concepts, questions):
-    history = QuestionnaireHistory()
-    history.fromdict(questionnaire.asdict(), allow_pk=True)
+  def _add_history(self, session, questionnaire, concepts, questions):
+    """Queues the questionnaire_history row for the questionnaire's current version, along with
+    copies of its concepts and questions for that version."""
+    history_writer.add_row(session, QuestionnaireHistory, questionnaire)
+    version_values = {'questionnaireId': questionnaire.questionnaireId,
+                      'questionnaireVersion': questionnaire.version}
     for concept in concepts:
-      new_concept = QuestionnaireConcept()
-      new_concept.fromdict(concept.asdict())
-      new_concept.questionnaireId = questionnaire.questionnaireId
-      new_concept.questionnaireVersion = questionnaire.version
-      history.concepts.append(new_concept)
+      history_writer.add_row(session, QuestionnaireConcept, concept,
+                             exclude=('questionnaireConceptId',), **version_values)
     for question in questions:
-      new_question = QuestionnaireQuestion()
-      new_question.fromdict(question.asdict())
-      new_question.questionnaireId = questionnaire.questionnaireId
-      new_question.questionnaireVersion = questionnaire.version
-      history.questions.append(new_question)
-
-    return history
+      history_writer.add_row(session, QuestionnaireQuestion, question,
+                             exclude=('questionnaireQuestionId',), **version_values)
 
   def insert_with_session(self, session, questionnaire):
     questionnaire.created = clock.CLOCK.now()
@@ -77,9 +80,7 @@ class QuestionnaireDao(UpdatableDao):
     resource_json['version'] = str(questionnaire.version)
     questionnaire.resource = json.dumps(resource_json)
 
-    history = self._make_history(questionnaire, concepts, questions)
-    history.questionnaireId = questionnaire.questionnaireId
-    QuestionnaireHistoryDao().insert_with_session(session, history)
+    self._add_history(session, questionnaire, concepts, questions)
     return questionnaire
 
   def _do_update(self, session, obj, existing_obj):
@@ -95,10 +96,7 @@ class QuestionnaireDao(UpdatableDao):
 
   def update_with_session(self, session, questionnaire):
     super(QuestionnaireDao, self).update_with_session(session, questionnaire)
-    QuestionnaireHistoryDao().insert_with_session(session,
-                                                  self._make_history(questionnaire,
-                                                                     questionnaire.concepts,
-                                                                     questionnaire.questions))
+    self._add_history(session, questionnaire, questionnaire.concepts, questionnaire.questions)
 
   @classmethod
   def from_client_json(cls,
@@ -219,6 +217,90 @@ class QuestionnaireHistoryDao(BaseDao):
     with self.session() as session:
       return self.get_with_children_with_session(session, questionnaireIdAndVersion)
 
+  def get_version(self, questionnaire_id, version):
+    """Returns a QuestionnaireVersion for the specified questionnaire version, or None if it
+    doesn't exist.
+
+    Questionnaire versions never change once written, so these are kept in a per-instance cache of
+    the most recently used QUESTIONNAIRE_VERSION_CACHE_SIZE versions.
+    """
+    cache = _get_questionnaire_version_cache()
+    key = (questionnaire_id, version)
+    questionnaire_version = cache.get(key)
+    if questionnaire_version is None:
+      history = self.get_with_children([questionnaire_id, version])
+      if history is None:
+        return None
+      questionnaire_version = QuestionnaireVersion(history)
+      cache.put(key, questionnaire_version)
+    return questionnaire_version
+
+  def load_current_versions(self):
+    """Loads the current version of each questionnaire into the cache used by get_version, in one
+    query. Returns the number of versions loaded."""
+    with self.session() as session:
+      histories = (session.query(QuestionnaireHistory)
+                   .join(Questionnaire,
+                         and_(Questionnaire.questionnaireId == QuestionnaireHistory.questionnaireId,
+                              Questionnaire.version == QuestionnaireHistory.version))
+                   .options(subqueryload(QuestionnaireHistory.concepts),
+                            subqueryload(QuestionnaireHistory.questions))
+                   .order_by(Questionnaire.lastModified.desc())
+                   .limit(QUESTIONNAIRE_VERSION_CACHE_SIZE)
+                   .all())
+    cache = _get_questionnaire_version_cache()
+    for history in histories:
+      cache.put((history.questionnaireId, history.version), QuestionnaireVersion(history))
+    return len(histories)
+
+
+def _get_questionnaire_version_cache():
+  return singletons.get(singletons.QUESTIONNAIRE_VERSION_CACHE_INDEX, _QuestionnaireVersionCache,
+                        max_size=QUESTIONNAIRE_VERSION_CACHE_SIZE)
+
+
+class QuestionnaireVersion(object):
+  """A questionnaire version (a detached QuestionnaireHistory, with its concepts and questions)
+  along with lookups used when parsing and storing questionnaire responses.
+
+  Instances are shared between requests and threads, so must not be modified.
+  """
+  def __init__(self, history):
+    self.history = history
+    self.questionnaireId = history.questionnaireId
+    self.version = history.version
+    self.status = history.status
+    self.questions = tuple(history.questions)
+    self.concepts = tuple(history.concepts)
+    self.link_id_to_question = {question.linkId: question for question in self.questions}
+    self.question_id_to_question = {question.questionnaireQuestionId: question
+                                    for question in self.questions}
+    self.question_id_to_code_id = {question.questionnaireQuestionId: question.codeId
+                                   for question in self.questions}
+    self.concept_code_ids = tuple(concept.codeId for concept in self.concepts)
+
+
+class _QuestionnaireVersionCache(object):
+  """A least-recently-used cache of QuestionnaireVersions, keyed by (questionnaire ID, version)."""
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is not None:
+        self._entries[key] = entry
+      return entry
+
+  def put(self, key, entry):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = entry
+      while len(self._entries) > self._max_size:
+        self._entries.popitem(last=False)
+
 
 class QuestionnaireConceptDao(BaseDao):
 
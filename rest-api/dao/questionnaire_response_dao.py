@@ -1,13 +1,22 @@
 import clock
+import collections
 import config
 import json
 import logging
 import os
+import threading
 
-from cloudstorage import cloudstorage_api
+import cloud_storage_files
 import fhirclient.models.questionnaireresponse
-from sqlalchemy.orm import subqueryload
-from werkzeug.exceptions import BadRequest
+import singletons
+from google.appengine.ext import deferred
+from sqlalchemy import event
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import Session, subqueryload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient
+from sqlalchemy.orm.util import identity_key
+from werkzeug.exceptions import BadRequest, HTTPException, InternalServerError
 
 from code_constants import PPI_SYSTEM, RACE_QUESTION_CODE, CONSENT_FOR_STUDY_ENROLLMENT_MODULE, \
   DVEHR_SHARING_QUESTION_CODE, CONSENT_FOR_DVEHR_MODULE, DVEHRSHARING_CONSENT_CODE_NOT_SURE, \
@@ -16,15 +25,18 @@ from code_constants import EHR_CONSENT_QUESTION_CODE, CONSENT_PERMISSION_YES_COD
 from code_constants import CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_MODULE, PPI_EXTRA_SYSTEM
 from code_constants import CABOR_SIGNATURE_QUESTION_CODE, DVEHRSHARING_CONSENT_CODE_YES
 from config_api import is_config_admin
+from dao import request_scope
 from dao.base_dao import BaseDao
 from dao.code_dao import CodeDao
+from dao.id_reservation_dao import IdReservationDao, get_reserved_id
 from dao.participant_dao import ParticipantDao, raise_if_withdrawn
 from dao.participant_summary_dao import ParticipantSummaryDao
-from dao.questionnaire_dao import QuestionnaireHistoryDao, QuestionnaireQuestionDao
+from dao.questionnaire_dao import QuestionnaireHistoryDao
 from field_mappings import FieldType, QUESTION_CODE_TO_FIELD, QUESTIONNAIRE_MODULE_CODE_TO_FIELD
 from model.code import CodeType
-from model.questionnaire import QuestionnaireQuestion
+from model.log_position import LogPosition
 from model.questionnaire_response import QuestionnaireResponse, QuestionnaireResponseAnswer
+from model.questionnaire_response import QuestionnaireResponseCurrentAnswer
 from participant_enums import QuestionnaireStatus, get_race, QuestionnaireDefinitionStatus
 
 _QUESTIONNAIRE_PREFIX = 'Questionnaire/'
@@ -37,14 +49,24 @@ _SIGNED_CONSENT_EXTENSION = (
 
 _LANGUAGE_EXTENSION = 'http://hl7.org/fhir/StructureDefinition/iso21090-ST-language'
 
+_DEFAULT_CONSENT_PDF_CACHE_TTL_SECONDS = 3600
+# Key in session.info for (participant ID, paths) of consent PDFs to check once the session commits.
+_CONSENT_PDF_CHECKS_KEY = 'consent_pdf_checks'
+
+def _get_column_values(obj):
+  if obj is None:
+    return None
+  return {prop.key: getattr(obj, prop.key) for prop in obj.__mapper__.column_attrs}
+
+
 def count_completed_baseline_ppi_modules(participant_summary):
-  baseline_ppi_module_fields = config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS, [])
+  baseline_ppi_module_fields = config.get_snapshot().baseline_ppi_questionnaire_fields
   return sum(1 for field in baseline_ppi_module_fields
              if getattr(participant_summary, field) == QuestionnaireStatus.SUBMITTED)
 
 
 def count_completed_ppi_modules(participant_summary):
-  ppi_module_fields = config.getSettingList(config.PPI_QUESTIONNAIRE_FIELDS, [])
+  ppi_module_fields = config.get_snapshot().ppi_questionnaire_fields
   return sum(1 for field in ppi_module_fields
              if getattr(participant_summary, field) == QuestionnaireStatus.SUBMITTED)
 
@@ -52,7 +74,8 @@ def count_completed_ppi_modules(participant_summary):
 class QuestionnaireResponseDao(BaseDao):
 
   def __init__(self):
-    super(QuestionnaireResponseDao, self).__init__(QuestionnaireResponse)
+    super(QuestionnaireResponseDao, self).__init__(QuestionnaireResponse,
+                                                   reserved_id_source=get_reserved_id)
 
   def get_id(self, obj):
     return obj.questionnaireResponseId
@@ -60,7 +83,7 @@ class QuestionnaireResponseDao(BaseDao):
   def get_with_session(self, session, obj_id, **kwargs):
     result = super(QuestionnaireResponseDao, self).get_with_session(session, obj_id, **kwargs)
     if result:
-      ParticipantDao().validate_participant_reference(session, result)
+      request_scope.get_dao(ParticipantDao).validate_participant_reference(session, result)
     return result
 
   def get_with_children(self, questionnaire_response_id):
@@ -69,47 +92,22 @@ class QuestionnaireResponseDao(BaseDao):
           .options(subqueryload(QuestionnaireResponse.answers))
       result = query.get(questionnaire_response_id)
       if result:
-        ParticipantDao().validate_participant_reference(session, result)
+        request_scope.get_dao(ParticipantDao).validate_participant_reference(session, result)
       return result
 
-  def _validate_model(self, session, obj):  # pylint: disable=unused-argument
-    _validate_consent_pdfs(json.loads(obj.resource))
+  def _validate_model(self, session, obj):
     if not obj.questionnaireId:
       raise BadRequest('QuestionnaireResponse.questionnaireId is required.')
     if not obj.questionnaireVersion:
       raise BadRequest('QuestionnaireResponse.questionnaireVersion is required.')
+    _validate_consent_pdfs(json.loads(obj.resource), obj.participantId, session)
     if not obj.answers:
       logging.error(
           'QuestionnaireResponse model has no answers. This is harmless but probably an error.')
 
   def insert_with_session(self, session, questionnaire_response):
-    questionnaire_history = (
-        QuestionnaireHistoryDao().
-        get_with_children_with_session(session, [questionnaire_response.questionnaireId,
-                                                 questionnaire_response.questionnaireVersion]))
-    if not questionnaire_history:
-      raise BadRequest('Questionnaire with ID %s, version %s is not found' %
-                       (questionnaire_response.questionnaireId,
-                        questionnaire_response.questionnaireVersion))
-    q_question_ids = set([
-        question.questionnaireQuestionId for question in questionnaire_history.questions])
-    for answer in questionnaire_response.answers:
-      if answer.questionId not in q_question_ids:
-        raise BadRequest('Questionnaire response contains question ID %s not in questionnaire.' %
-                         answer.questionId)
-
-    questionnaire_response.created = clock.CLOCK.now()
-
-    # Put the ID into the resource.
-    resource_json = json.loads(questionnaire_response.resource)
-    resource_json['id'] = str(questionnaire_response.questionnaireResponseId)
-    questionnaire_response.resource = json.dumps(resource_json)
-
-    question_ids = [answer.questionId for answer in questionnaire_response.answers]
-    questions = QuestionnaireQuestionDao().get_all_with_session(session, question_ids)
-    code_ids = [question.codeId for question in questions]
-    current_answers = (QuestionnaireResponseAnswerDao().
-        get_current_answers_for_concepts(session, questionnaire_response.participantId, code_ids))
+    questionnaire_history, questions, code_ids, resource_json = self._prepare_insert(
+        questionnaire_response)
 
     # IMPORTANT: update the participant summary first to grab an exclusive lock on the participant
     # row. If you insetad do this after the insert of the questionnaire response, MySQL will get a
@@ -120,14 +118,53 @@ class QuestionnaireResponseDao(BaseDao):
     self._update_participant_summary(
         session, questionnaire_response, code_ids, questions, questionnaire_history, resource_json)
 
+    self._finish_insert(session, questionnaire_response, questionnaire_history)
+    return questionnaire_response
+
+  def _prepare_insert(self, questionnaire_response):
+    """Checks the response against its questionnaire version and puts its ID into the resource.
+    Returns the questionnaire version, the questions answered, their code IDs and the resource
+    JSON."""
+    questionnaire_history, questions, code_ids = self.get_questions_answered(
+        questionnaire_response)
+    questionnaire_response.created = clock.CLOCK.now()
+
+    # Put the ID into the resource.
+    resource_json = json.loads(questionnaire_response.resource)
+    resource_json['id'] = str(questionnaire_response.questionnaireResponseId)
+    questionnaire_response.resource = json.dumps(resource_json)
+    return questionnaire_history, questions, code_ids, resource_json
+
+  @staticmethod
+  def get_questions_answered(questionnaire_response):
+    """Returns the questionnaire version a response is for, the questions it answers and their
+    code IDs."""
+    questionnaire_history = QuestionnaireHistoryDao().get_version(
+        questionnaire_response.questionnaireId, questionnaire_response.questionnaireVersion)
+    if not questionnaire_history:
+      raise BadRequest('Questionnaire with ID %s, version %s is not found' %
+                       (questionnaire_response.questionnaireId,
+                        questionnaire_response.questionnaireVersion))
+    for answer in questionnaire_response.answers:
+      if answer.questionId not in questionnaire_history.question_id_to_question:
+        raise BadRequest('Questionnaire response contains question ID %s not in questionnaire.' %
+                         answer.questionId)
+
+    question_ids = set(answer.questionId for answer in questionnaire_response.answers)
+    questions = [questionnaire_history.question_id_to_question[question_id]
+                 for question_id in question_ids]
+    code_ids = [questionnaire_history.question_id_to_code_id[question_id]
+                for question_id in question_ids]
+    return questionnaire_history, questions, code_ids
+
+  def _finish_insert(self, session, questionnaire_response, questionnaire_history):
     super(QuestionnaireResponseDao, self).insert_with_session(session, questionnaire_response)
+    # Assign IDs to the answers.
+    session.flush()
     # Mark existing answers for the questions in this response given previously by this participant
     # as ended.
-    for answer in current_answers:
-      answer.endTime = questionnaire_response.created
-      session.merge(answer)
-
-    return questionnaire_response
+    QuestionnaireResponseAnswerDao().set_current_answers(
+        session, questionnaire_response, questionnaire_history.question_id_to_code_id)
 
   def _get_field_value(self, field_type, answer):
     if field_type == FieldType.CODE:
@@ -156,18 +193,30 @@ class QuestionnaireResponseDao(BaseDao):
     questionnaire can be submitted, and it must include first and last name and e-mail address.
     """
 
-    # Block on other threads modifying the participant or participant summary.
-    participant = ParticipantDao().get_for_update(session, questionnaire_response.participantId)
+    participant = self._get_participant_for_update(session, questionnaire_response.participantId)
+    participant_summary, something_changed = self._apply_to_participant_summary(
+        participant, participant.participantSummary, questionnaire_response, code_ids, questions,
+        questionnaire_history, resource_json)
+    if something_changed:
+      self._write_participant_summary(session, participant_summary)
 
+  @staticmethod
+  def _get_participant_for_update(session, participant_id):
+    # Block on other threads modifying the participant or participant summary.
+    participant = request_scope.get_dao(ParticipantDao).get_for_update(session, participant_id)
     if participant is None:
-      raise BadRequest('Participant with ID %d is not found.' %
-                        questionnaire_response.participantId)
-
-    participant_summary = participant.participantSummary
+      raise BadRequest('Participant with ID %d is not found.' % participant_id)
+    return participant
 
-    code_ids.extend([concept.codeId for concept in questionnaire_history.concepts])
+  def _apply_to_participant_summary(
+      self, participant, participant_summary, questionnaire_response, code_ids, questions,
+      questionnaire_history, resource_json):
+    """Sets participant summary fields from the response, creating the summary if
+    participant_summary is None. Returns the summary and whether anything changed (in which case
+    it needs writing)."""
+    code_ids.extend(questionnaire_history.concept_code_ids)
 
-    code_dao = CodeDao()
+    code_dao = request_scope.get_dao(CodeDao)
 
     something_changed = False
     # If no participant summary exists, make sure this is the study enrollment consent.
@@ -280,23 +329,117 @@ class QuestionnaireResponseDao(BaseDao):
         raise BadRequest(
           'Email address (%s), or phone number (%s) required for consenting.'
           % tuple(['present' if part else 'missing' for part in email_phone]))
-      ParticipantSummaryDao().update_enrollment_status(participant_summary)
-      participant_summary.lastModified = clock.CLOCK.now()
-      session.merge(participant_summary)
+    return participant_summary, something_changed
+
+  @staticmethod
+  def _write_participant_summary(session, participant_summary):
+    request_scope.get_dao(ParticipantSummaryDao).update_enrollment_status(participant_summary)
+    participant_summary.lastModified = clock.CLOCK.now()
+    participant_summary.logPosition = LogPosition()
+    session.merge(participant_summary)
 
   def insert(self, obj):
     if obj.questionnaireResponseId:
       return super(QuestionnaireResponseDao, self).insert(obj)
     return self._insert_with_random_id(obj, ['questionnaireResponseId'])
 
+  def insert_bundle(self, questionnaire_responses):
+    """Inserts many questionnaire responses, possibly for different participants.
+
+    Responses are grouped by participant. Each participant's responses are inserted in one
+    transaction, in the order given, and their participant is locked once. Each response's answers
+    are applied to the participant summary in memory, and the summary is written once at the end.
+    A response that is rejected doesn't affect the others, and a database error only fails the
+    responses for that participant.
+
+    Returns a list with, for each response, the inserted response or the HTTPException that kept
+    it from being inserted.
+    """
+    results = [None] * len(questionnaire_responses)
+    by_participant = collections.OrderedDict()
+    for i, questionnaire_response in enumerate(questionnaire_responses):
+      by_participant.setdefault(questionnaire_response.participantId, []).append(
+          (i, questionnaire_response))
+    response_ids = IdReservationDao().reserve_ids(QuestionnaireResponse, 'questionnaireResponseId',
+                                                  len(questionnaire_responses))
+    for questionnaire_response, response_id in zip(questionnaire_responses, response_ids):
+      questionnaire_response.questionnaireResponseId = response_id
+    for participant_id, entries in by_participant.iteritems():
+      try:
+        self._insert_participant_responses(participant_id, entries, results)
+      except IntegrityError as e:
+        # E.g. a response ID taken by an insert that didn't reserve it. Insert this participant's
+        # responses one at a time instead. (Caught before DBAPIError, its base class.)
+        logging.warning('Inserting %d responses for P%d failed (%s); inserting one at a time.',
+                        len(entries), participant_id, e.message)
+        for i, questionnaire_response in entries:
+          if isinstance(results[i], HTTPException):
+            continue
+          _reset_for_insert(questionnaire_response)
+          try:
+            results[i] = self.insert(questionnaire_response)
+          except HTTPException as error:
+            results[i] = error
+          except DBAPIError as error:
+            logging.error('Inserting response %d of the bundle failed.', i, exc_info=True)
+            results[i] = InternalServerError('Storing the response failed: %s' % error.orig)
+      except DBAPIError as e:
+        # E.g. a deadlock or dropped connection. Nothing for this participant was committed, but
+        # other participants' responses may have been, so report the error on these entries only.
+        logging.error('Inserting %d responses for P%d failed.', len(entries), participant_id,
+                      exc_info=True)
+        error = InternalServerError('Storing the response failed: %s' % e.orig)
+        for i, _ in entries:
+          if not isinstance(results[i], HTTPException):
+            results[i] = error
+    return results
+
+  def _insert_participant_responses(self, participant_id, entries, results):
+    """Inserts one participant's (index, response) pairs in one transaction, setting results."""
+    with self.session() as session:
+      try:
+        participant = self._get_participant_for_update(session, participant_id)
+      except BadRequest as e:
+        for i, _ in entries:
+          results[i] = e
+        return
+      participant_summary = participant.participantSummary
+      summary_changed = False
+      for i, questionnaire_response in entries:
+        saved_values = _get_column_values(participant_summary)
+        try:
+          questionnaire_history, questions, code_ids, resource_json = self._prepare_insert(
+              questionnaire_response)
+          participant_summary, changed = self._apply_to_participant_summary(
+              participant, participant_summary, questionnaire_response, code_ids, questions,
+              questionnaire_history, resource_json)
+          self._finish_insert(session, questionnaire_response, questionnaire_history)
+        except HTTPException as e:
+          # Undo whatever this response changed on the summary.
+          if saved_values is None:
+            participant_summary = None
+          else:
+            for key, value in saved_values.iteritems():
+              setattr(participant_summary, key, value)
+          results[i] = e
+          continue
+        summary_changed = summary_changed or changed
+        results[i] = questionnaire_response
+      if summary_changed:
+        self._write_participant_summary(session, participant_summary)
+
   def from_client_json(self, resource_json, participant_id=None, client_id=None):
     #pylint: disable=unused-argument
     # Parse the questionnaire response, but preserve the original response when persisting
     fhir_qr = fhirclient.models.questionnaireresponse.QuestionnaireResponse(resource_json)
-    patient_id = fhir_qr.subject.reference
+    patient_id = fhir_qr.subject.reference if fhir_qr.subject else None
     if patient_id != 'Patient/P{}'.format(participant_id):
       msg = "Questionnaire response subject reference does not match participant_id %r"
       raise BadRequest(msg % participant_id)
+    if not fhir_qr.questionnaire or not fhir_qr.questionnaire.reference:
+      raise BadRequest('Questionnaire response has no questionnaire reference')
+    if not fhir_qr.group:
+      raise BadRequest('Questionnaire response has no group')
     questionnaire = self._get_questionnaire(fhir_qr.questionnaire, resource_json)
     if questionnaire.status == QuestionnaireDefinitionStatus.INVALID:
       raise BadRequest("Submitted questionnaire that is marked as invalid: questionnaire ID %s" %
@@ -312,7 +455,7 @@ class QuestionnaireResponseDao(BaseDao):
       logging.error(
           'No answers from QuestionnaireResponse JSON. This is harmless but probably an error.')
     # Get or insert codes, and retrieve their database IDs.
-    code_id_map = CodeDao().get_or_add_codes(code_map,
+    code_id_map = request_scope.get_dao(CodeDao).get_or_add_codes(code_map,
                                              add_codes_if_missing=_add_codes_if_missing(client_id))
 
     # Now add the child answers, using the IDs in code_id_map
@@ -337,7 +480,7 @@ class QuestionnaireResponseDao(BaseDao):
       try:
         questionnaire_id = int(questionnaire_ref_parts[0])
         version = int(questionnaire_ref_parts[1])
-        q = QuestionnaireHistoryDao().get_with_children((questionnaire_id, version))
+        q = QuestionnaireHistoryDao().get_version(questionnaire_id, version)
         if not q:
           raise BadRequest('Questionnaire with id %d, version %d is not found' %
                            (questionnaire_id, version))
@@ -349,7 +492,8 @@ class QuestionnaireResponseDao(BaseDao):
       try:
         questionnaire_id = int(questionnaire_reference)
         from dao.questionnaire_dao import QuestionnaireDao
-        q = QuestionnaireDao().get_with_children(questionnaire_id)
+        version = QuestionnaireDao().get_version(questionnaire_id)
+        q = QuestionnaireHistoryDao().get_version(questionnaire_id, version) if version else None
         if not q:
           raise BadRequest('Questionnaire with id %d is not found' % questionnaire_id)
         # Mutate the questionnaire reference to include the version.
@@ -366,10 +510,7 @@ class QuestionnaireResponseDao(BaseDao):
     """
     code_map = {}
     answers = []
-    link_id_to_question = {}
-    if q.questions:
-      link_id_to_question = {question.linkId: question for question in q.questions}
-    cls._populate_codes_and_answers(group, code_map, answers, link_id_to_question,
+    cls._populate_codes_and_answers(group, code_map, answers, q.link_id_to_question,
                                                       q.questionnaireId)
     return (code_map, answers)
 
@@ -439,6 +580,17 @@ class QuestionnaireResponseDao(BaseDao):
       qr.answers.append(answer)
 
 
+def _reset_for_insert(questionnaire_response):
+  """Detaches a response (and its answers) flushed in a transaction that was rolled back, and
+  clears the IDs assigned then, so that it can be inserted again from scratch."""
+  make_transient(questionnaire_response)
+  questionnaire_response.questionnaireResponseId = None
+  for answer in questionnaire_response.answers:
+    make_transient(answer)
+    answer.questionnaireResponseAnswerId = None
+    answer.questionnaireResponseId = None
+
+
 def _add_codes_if_missing(client_id):
   """Don't add missing codes for questionnaire responses submitted by the config admin
   (our command line tools.)
@@ -448,11 +600,17 @@ def _add_codes_if_missing(client_id):
   return not is_config_admin(client_id)
 
 
-def _validate_consent_pdfs(resource):
-  """Checks for any consent-form-signed-pdf extensions and validates their PDFs in GCS."""
+def _validate_consent_pdfs(resource, participant_id=None, session=None):
+  """Checks for any consent-form-signed-pdf extensions and validates their PDFs in GCS.
+
+  PDFs recently found to exist aren't checked again. If config.CONSENT_PDF_DEFERRED_CHECK is set,
+  the others are checked in a background task instead of before the response is stored; with a
+  session, the task is only started once the session commits.
+  """
   if resource.get('resourceType') != 'QuestionnaireResponse':
     raise ValueError('Expected QuestionnaireResponse for "resourceType" in %r.' % resource)
   consent_bucket = config.getSetting(config.CONSENT_PDF_BUCKET)
+  paths = []
   for extension in resource.get('extension', []):
     if extension['url'] != _SIGNED_CONSENT_EXTENSION:
       continue
@@ -463,7 +621,84 @@ def _validate_consent_pdfs(resource):
     # Treat the value as a bucket-relative path, allowing a leading slash or not.
     if not local_pdf_path.startswith('/'):
       local_pdf_path = '/' + local_pdf_path
-    _raise_if_gcloud_file_missing('/%s%s' % (consent_bucket, local_pdf_path))
+    path = '/%s%s' % (consent_bucket, local_pdf_path)
+    if path not in paths:
+      paths.append(path)
+
+  cache = singletons.get(singletons.CONSENT_PDF_CACHE_INDEX, cloud_storage_files.ExistingFileCache)
+  unchecked_paths = [pdf_path for pdf_path in paths if not cache.contains(pdf_path)]
+  if not unchecked_paths:
+    return
+  if config.getSetting(config.CONSENT_PDF_DEFERRED_CHECK, False):
+    if session is None:
+      deferred.defer(_check_consent_pdfs_in_background, participant_id, unchecked_paths)
+    else:
+      session.info.setdefault(_CONSENT_PDF_CHECKS_KEY, []).append((participant_id,
+                                                                   unchecked_paths))
+    return
+  errors = _check_consent_pdfs(unchecked_paths)
+  for path in unchecked_paths:
+    if path in errors:
+      raise errors[path]
+
+
+def _check_consent_pdfs(paths):
+  """Checks that the PDFs exist in GCS, checking several at once, and caches the ones that do.
+  Returns the exception raised for each path that failed the check."""
+  cache = singletons.get(singletons.CONSENT_PDF_CACHE_INDEX, cloud_storage_files.ExistingFileCache)
+  cache_ttl_seconds = config.getSetting(config.CONSENT_PDF_CACHE_TTL_SECONDS,
+                                        _DEFAULT_CONSENT_PDF_CACHE_TTL_SECONDS)
+  errors = {}
+
+  def check(path):
+    try:
+      _raise_if_gcloud_file_missing(path)
+    except Exception as e:  # pylint: disable=broad-except
+      errors[path] = e
+      return
+    if cache_ttl_seconds:
+      cache.add(path, cache_ttl_seconds)
+
+  if len(paths) == 1:
+    check(paths[0])
+  else:
+    threads = [threading.Thread(target=check, args=(path,)) for path in paths]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+  return errors
+
+
+@event.listens_for(Session, 'after_commit')
+def _defer_consent_pdf_checks(session):
+  for participant_id, paths in session.info.pop(_CONSENT_PDF_CHECKS_KEY, []):
+    try:
+      deferred.defer(_check_consent_pdfs_in_background, participant_id, paths)
+    except Exception:  # pylint: disable=broad-except
+      # The response is already stored, so don't fail the request.
+      logging.error('Failed to start consent PDF check for participant %s: %s', participant_id,
+                    paths, exc_info=True)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _drop_consent_pdf_checks(session, previous_transaction):
+  #pylint: disable=unused-argument
+  session.info.pop(_CONSENT_PDF_CHECKS_KEY, None)
+
+
+def _check_consent_pdfs_in_background(participant_id, paths):
+  """Logs an error for each of a stored response's consent PDFs that doesn't exist."""
+  errors = _check_consent_pdfs(paths)
+  for path in paths:
+    error = errors.get(path)
+    if isinstance(error, BadRequest):
+      logging.error('Signed consent PDF for participant %s is missing: %s', participant_id,
+                    error.description)
+  for path in paths:
+    if path in errors and not isinstance(errors[path], BadRequest):
+      # Failed to check (e.g. GCS is unavailable); let the task be retried.
+      raise errors[path]
 
 
 def _raise_if_gcloud_file_missing(path):
@@ -474,11 +709,10 @@ def _raise_if_gcloud_file_missing(path):
   Raises:
     BadRequest if the path does not reference a file.
   """
-  try:
-    gcs_stat = cloudstorage_api.stat(path)
-  except cloudstorage_api.errors.NotFoundError as e:
-    raise BadRequest('Google Cloud Storage file %r not found. %s.' % (path, e))
-  if gcs_stat.is_dir:
+  file_type = cloud_storage_files.get_files().get_type(path)
+  if file_type is None:
+    raise BadRequest('Google Cloud Storage file %r not found.' % path)
+  if file_type == cloud_storage_files.DIRECTORY:
     raise BadRequest('Google Cloud Storage path %r references a directory, expected a file.' % path)
 
 
@@ -495,9 +729,41 @@ class QuestionnaireResponseAnswerDao(BaseDao):
     code IDs."""
     if not code_ids:
       return []
-    return (session.query(QuestionnaireResponseAnswer).join(QuestionnaireResponse)
-        .join(QuestionnaireQuestion)
-        .filter(QuestionnaireResponse.participantId == participant_id)
-        .filter(QuestionnaireResponseAnswer.endTime == None)
-        .filter(QuestionnaireQuestion.codeId.in_(code_ids))
+    return (session.query(QuestionnaireResponseAnswer)
+        .join(QuestionnaireResponseCurrentAnswer,
+              QuestionnaireResponseCurrentAnswer.questionnaireResponseAnswerId ==
+              QuestionnaireResponseAnswer.questionnaireResponseAnswerId)
+        .filter(QuestionnaireResponseCurrentAnswer.participantId == participant_id)
+        .filter(QuestionnaireResponseCurrentAnswer.questionCodeId.in_(code_ids))
         .all())
+
+  @staticmethod
+  def set_current_answers(session, questionnaire_response, question_id_to_code_id):
+    """Makes an inserted response's answers the participant's current answers for their
+    questions' codes, setting endTime on the answers they replace."""
+    participant_id = questionnaire_response.participantId
+    new_rows = [{'participant_id': participant_id,
+                 'question_code_id': question_id_to_code_id[answer.questionId],
+                 'questionnaire_response_answer_id': answer.questionnaireResponseAnswerId}
+                for answer in questionnaire_response.answers]
+    code_ids = set(row['question_code_id'] for row in new_rows)
+    if not code_ids:
+      return
+    current_answers = (session.query(QuestionnaireResponseCurrentAnswer)
+                       .filter(QuestionnaireResponseCurrentAnswer.participantId == participant_id)
+                       .filter(QuestionnaireResponseCurrentAnswer.questionCodeId.in_(code_ids)))
+    replaced_answer_ids = [current_answer.questionnaireResponseAnswerId
+                           for current_answer in current_answers]
+    if replaced_answer_ids:
+      end_time = questionnaire_response.created
+      (session.query(QuestionnaireResponseAnswer)
+       .filter(QuestionnaireResponseAnswer.questionnaireResponseAnswerId.in_(replaced_answer_ids))
+       .update({QuestionnaireResponseAnswer.endTime: end_time}, synchronize_session=False))
+      # Superseded answers are only in the session if an earlier response in the same bundle
+      # inserted them; update those in memory without another query.
+      for answer_id in replaced_answer_ids:
+        answer = session.identity_map.get(identity_key(QuestionnaireResponseAnswer, answer_id))
+        if answer is not None:
+          set_committed_value(answer, 'endTime', end_time)
+      current_answers.delete(synchronize_session=False)
+    session.execute(QuestionnaireResponseCurrentAnswer.__table__.insert(), new_rows)
@@ -0,0 +1,61 @@
+"""State shared by DAOs for the duration of a request.
+
+While a request is being handled (between start_request and end_request), get_dao returns one
+shared instance of each DAO class, instead of each caller building its own (along with the child
+DAOs it builds). DAOs also record here lookups that they answered from a session's identity map
+instead of running a query; the counts are logged with each request and totalled per endpoint.
+
+Outside of a request (e.g. in tools and offline jobs that don't use the request hooks), get_dao
+simply builds a new DAO.
+"""
+import collections
+import threading
+
+_request_state = threading.local()
+
+# Total queries saved, by endpoint and then by kind of lookup, for this instance.
+_saved_queries_by_endpoint = collections.defaultdict(collections.Counter)
+_saved_queries_lock = threading.Lock()
+
+
+def start_request():
+  _request_state.daos = {}
+  _request_state.saved_queries = collections.Counter()
+
+
+def end_request(endpoint):
+  """Ends the current request scope, adding its counts to the totals for the endpoint. Returns
+  the number of queries saved during the request, by kind, or None if no request was started."""
+  saved_queries = getattr(_request_state, 'saved_queries', None)
+  _request_state.daos = None
+  _request_state.saved_queries = None
+  if saved_queries is None:
+    return None
+  if saved_queries:
+    with _saved_queries_lock:
+      _saved_queries_by_endpoint[endpoint or 'unknown'].update(saved_queries)
+  return saved_queries
+
+
+def get_dao(dao_class):
+  """Returns the DAO of the given class for the current request, or a new one outside of one."""
+  daos = getattr(_request_state, 'daos', None)
+  if daos is None:
+    return dao_class()
+  dao = daos.get(dao_class)
+  if dao is None:
+    dao = daos[dao_class] = dao_class()
+  return dao
+
+
+def record_saved_query(kind):
+  """Records that a lookup of the given kind (e.g. 'participant') didn't need a query."""
+  saved_queries = getattr(_request_state, 'saved_queries', None)
+  if saved_queries is not None:
+    saved_queries[kind] += 1
+
+
+def get_saved_query_counts():
+  """Returns the number of queries saved on this instance, by endpoint and kind of lookup."""
+  with _saved_queries_lock:
+    return {endpoint: dict(counts) for endpoint, counts in _saved_queries_by_endpoint.iteritems()}
@@ -1,5 +1,6 @@
 import clock
-from dao.cache_all_dao import CacheAllDao
+from dao.cache_all_dao import CacheAllDao, CACHE_TTL_SECONDS
+from dao.database_utils import insert_log_position
 from model.site import Site
 from singletons import SITE_CACHE_INDEX
 from dao.base_dao import FhirMixin, FhirProperty
@@ -42,7 +43,8 @@ class _FhirSite(FhirMixin, BackboneElement):
 class SiteDao(CacheAllDao):
   def __init__(self):
     super(SiteDao, self).__init__(Site, cache_index=SITE_CACHE_INDEX,
-                                  cache_ttl_seconds=600, index_field_keys=['googleGroup'])
+                                  cache_ttl_seconds=CACHE_TTL_SECONDS,
+                                  index_field_keys=['googleGroup'])
 
   def _validate_update(self, session, obj, existing_obj):
     # Sites aren't versioned; suppress the normal check here.
@@ -116,7 +118,8 @@ class SiteDao(CacheAllDao):
             UPDATE participant_summary
             SET hpo_id = :hpo_id,
                 organization_id = :org_id,
-                last_modified = :now
+                last_modified = :now,
+                log_position_id = :log_position_id
             WHERE site_id = :site_id
             """
 
@@ -129,7 +132,8 @@ class SiteDao(CacheAllDao):
             """
 
       params = {'site_id': existing_obj.siteId, 'provider_link': provider_link, 'org_id':
-                new_org_id, 'hpo_id': new_hpo_id, 'now': clock.CLOCK.now()}
+                new_org_id, 'hpo_id': new_hpo_id, 'now': clock.CLOCK.now(),
+                'log_position_id': insert_log_position(session)}
 
       session.execute(participant_sql, params)
       session.execute(participant_summary_sql, params)
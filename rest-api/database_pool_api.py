@@ -0,0 +1,22 @@
+"""Admin API reporting database connection pool statistics.
+
+Statistics are kept per App Engine instance, since each instance has its own pools. The response
+also includes, under lockErrorsByDao, the deadlocks and lock wait timeouts that transactions run
+by each DAO have hit, and the retries after them.
+"""
+
+from flask.ext.restful import Resource
+
+from config_api import auth_required_config_admin
+from dao import database_factory
+from model import database
+
+
+class DatabasePoolApi(Resource):
+  """Api handler for retrieving connection pool statistics for this instance's databases."""
+  method_decorators = [auth_required_config_admin]
+
+  def get(self):
+    stats = database_factory.get_pool_stats()
+    stats['lockErrorsByDao'] = database.get_lock_error_stats()
+    return stats
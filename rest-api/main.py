@@ -2,11 +2,15 @@
 
 This defines the APIs and the handlers for the APIs. All responses are JSON.
 """
+import json
 import logging
 
 import app_util
+import cache_stats_api
 import config_api
+import database_pool_api
 import version_api
+import warmup
 from api.awardee_api import AwardeeApi
 from api.biobank_order_api import BiobankOrderApi
 from api.check_ppi_data_api import check_ppi_data
@@ -15,13 +19,13 @@ from api.import_codebook_api import import_codebook
 from api.metric_sets_api import MetricSetsApi
 from api.metrics_api import MetricsApi
 from api.metrics_fields_api import MetricsFieldsApi
-from api.participant_api import ParticipantApi
+from api.participant_api import ParticipantApi, ParticipantBatchApi
 from api.participant_counts_over_time_api import ParticipantCountsOverTimeApi
 from api.participant_summary_api import ParticipantSummaryApi
 from api.physical_measurements_api import PhysicalMeasurementsApi, sync_physical_measurements
 from api.questionnaire_api import QuestionnaireApi
-from api.questionnaire_response_api import QuestionnaireResponseApi
-from config import get_config, get_db_config
+from api.questionnaire_response_api import QuestionnaireResponseApi, \
+  QuestionnaireResponseBundleApi
 from flask import Flask, got_request_exception
 from flask_restful import Api
 from model.utils import ParticipantIdConverter
@@ -36,10 +40,10 @@ app.url_map.converters['participant_id'] = ParticipantIdConverter
 
 
 def _warmup():
-  # Load configurations into the cache.
-  get_config()
-  get_db_config()
-  return '{ "success": "true" }'
+  # Load configurations and reference data into the caches.
+  result = warmup.warm_up()
+  result['success'] = 'true'
+  return json.dumps(result)
 
 def _log_request_exception(sender, exception, **extra):  # pylint: disable=unused-argument
   """Logs HTTPExceptions.
@@ -68,6 +72,11 @@ api.add_resource(ParticipantApi,
                  endpoint='participant',
                  methods=['GET', 'POST', 'PUT'])
 
+api.add_resource(ParticipantBatchApi,
+                 PREFIX + 'Participant/$batch',
+                 endpoint='participant.batch',
+                 methods=['POST'])
+
 api.add_resource(ParticipantSummaryApi,
                  PREFIX + 'Participant/<participant_id:p_id>/Summary',
                  PREFIX + 'ParticipantSummary',
@@ -113,6 +122,11 @@ api.add_resource(QuestionnaireResponseApi,
                  endpoint='participant.questionnaire_response',
                  methods=['POST', 'GET'])
 
+api.add_resource(QuestionnaireResponseBundleApi,
+                 PREFIX + 'QuestionnaireResponse',
+                 endpoint='questionnaire_response.bundle',
+                 methods=['POST'])
+
 api.add_resource(BiobankOrderApi,
                  PREFIX + 'Participant/<participant_id:p_id>/BiobankOrder/<string:bo_id>',
                  PREFIX + 'Participant/<participant_id:p_id>/BiobankOrder',
@@ -133,6 +147,18 @@ api.add_resource(config_api.ConfigApi,
                  endpoint='config',
                  methods=['GET', 'POST', 'PUT'])
 
+# Connection pool statistics API for admin use.
+api.add_resource(database_pool_api.DatabasePoolApi,
+                 PREFIX + 'DatabasePools',
+                 endpoint='database_pools',
+                 methods=['GET'])
+
+# In-memory cache statistics API for admin use.
+api.add_resource(cache_stats_api.CacheStatsApi,
+                 PREFIX + 'CacheStats',
+                 endpoint='cache_stats',
+                 methods=['GET'])
+
 # Version API for prober and release management use.
 api.add_resource(version_api.VersionApi,
                  '/',
@@ -171,5 +197,6 @@ app.add_url_rule('/_ah/warmup',
                  methods='GET')
 
 app.after_request(app_util.add_headers)
+app.after_request(app_util.log_query_stats)
 app.before_request(app_util.request_logging)
 app.register_error_handler(DBAPIError, app_util.handle_database_disconnect)
@@ -0,0 +1,13 @@
+from model.base import Base
+from sqlalchemy import Column, Integer, String
+
+class CacheGeneration(Base):
+  """A counter incremented whenever a table cached in memory by CacheAllDao is written.
+
+  Servers compare the generation with the one they last saw to find out cheaply whether another
+  server has changed the table, and refresh their caches if so.
+  """
+  __tablename__ = 'cache_generation'
+  # The name of the cached table.
+  name = Column('name', String(80), primary_key=True)
+  generation = Column('generation', Integer, nullable=False)
@@ -1,7 +1,7 @@
 from protorpc import messages
 from model.base import Base
 from model.utils import Enum, UTCDateTime
-from sqlalchemy import Column, Integer, String, UnicodeText, Boolean, UniqueConstraint
+from sqlalchemy import Column, Integer, String, UnicodeText, Boolean, UniqueConstraint, Index
 from sqlalchemy import ForeignKey
 from sqlalchemy.orm import backref, relationship
 from sqlalchemy.ext.declarative import declared_attr
@@ -66,6 +66,8 @@ class Code(_CodeBase, Base):
   Questions have modules for parents, and answers have questions for parents.
   """
   __tablename__ = 'code'
+  # Set on every insert and update, so that caches can fetch only the codes that changed.
+  lastModified = Column('last_modified', UTCDateTime)
 
   @declared_attr
   def children(cls):
@@ -80,6 +82,7 @@ class Code(_CodeBase, Base):
 
   __table_args__ = (
     UniqueConstraint('system', 'value'),
+    Index('code_last_modified', 'last_modified'),
   )
 
 class CodeHistory(_CodeBase, Base):
@@ -1,20 +1,32 @@
+import bisect
+import collections
 from contextlib import contextmanager
+import heapq
+import logging
+import random
+import threading
+import time
 
 import backoff
-from sqlalchemy import create_engine
-from sqlalchemy.exc import DBAPIError
+from MySQLdb.cursors import CursorUseResultMixIn
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import DBAPIError, TimeoutError
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 from model.base import Base, MetricsBase
 # All tables in the schema should be imported below here.
 # pylint: disable=unused-import
 from model.participant import Participant, ParticipantHistory
 from model.participant_summary import ParticipantSummary
+from model.participant_summary_rebuild import ParticipantSummaryRebuildShard
 from model.biobank_stored_sample import BiobankStoredSample
 from model.biobank_order import BiobankOrder, BiobankOrderIdentifier, BiobankOrderedSample
+from model.cache_generation import CacheGeneration
 from model.code import CodeBook, Code, CodeHistory
 from model.calendar import Calendar
 from model.hpo import HPO
+from model.id_reservation import IdReservation
 from model.log_position import LogPosition
 from model.measurements import PhysicalMeasurements, Measurement
 from model.metric_set import AggregateMetrics, MetricSet
@@ -23,9 +35,34 @@ from model.organization import Organization
 from model.questionnaire import Questionnaire, QuestionnaireHistory, QuestionnaireQuestion
 from model.questionnaire import QuestionnaireConcept
 from model.questionnaire_response import QuestionnaireResponse, QuestionnaireResponseAnswer
+from model.questionnaire_response import QuestionnaireResponseCurrentAnswer
 from model.site import Site
 
 RETRY_CONNECTION_LIMIT = 10
+# Number of statements listed in a QueryStats summary.
+MAX_SLOWEST_STATEMENTS = 3
+# Statements are truncated to this length in logs.
+MAX_LOGGED_STATEMENT_LENGTH = 500
+# Upper bounds (in milliseconds) of the buckets in the connection checkout wait histogram.
+CHECKOUT_WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+# MySQL errors for a transaction rolled back to break a deadlock, and for a statement that gave up
+# waiting for a row lock.
+MYSQL_DEADLOCK_ERROR = 1213
+MYSQL_LOCK_WAIT_TIMEOUT_ERROR = 1205
+# Times autoretry runs a transaction that keeps failing with one of the errors above.
+LOCK_ERROR_ATTEMPT_LIMIT = 4
+# Upper bound (in seconds) of the random delay before retrying after a lock error; it doubles
+# with each further attempt.
+LOCK_ERROR_RETRY_DELAY_SECONDS = 0.1
+
+# LockErrorStats counter names, by MySQL error.
+_LOCK_ERROR_COUNTERS = {
+    MYSQL_DEADLOCK_ERROR: 'deadlocks',
+    MYSQL_LOCK_WAIT_TIMEOUT_ERROR: 'lockWaitTimeouts',
+}
+
+# QueryStats for the request being handled on the current thread, if any.
+_query_stats = threading.local()
 
 
 class Database(object):
@@ -37,7 +74,17 @@ class Database(object):
     # parameter (which defaults to 8 hours) to ensure that we don't attempt to use idle database
     # connections after this period. (See DA-237.) To change the db wait_timeout (seconds), run:
     # gcloud --project <proj> sql instances patch rdrmaindb --database-flags wait_timeout=28800
-    self._engine = create_engine(url, pool_pre_ping=True, pool_recycle=3600, **kwargs)
+    kwargs.setdefault('pool_recycle', 3600)
+    if url.drivername != 'sqlite':
+      kwargs.setdefault('poolclass', _InstrumentedQueuePool)
+    self._engine = create_engine(url, pool_pre_ping=True, **kwargs)
+    self._pool_stats = PoolStats()
+    if isinstance(self._engine.pool, _InstrumentedQueuePool):
+      self._engine.pool.stats = self._pool_stats
+    event.listen(self._engine, 'checkout', self._pool_stats.record_checkout)
+    event.listen(self._engine, 'invalidate', self._pool_stats.record_invalidation)
+    event.listen(self._engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(self._engine, 'after_cursor_execute', _after_cursor_execute)
     self.db_type = url.drivername
     if self.db_type == 'sqlite':
       self._engine.execute('PRAGMA foreign_keys = ON;')
@@ -49,6 +96,18 @@ class Database(object):
   def get_engine(self):
     return self._engine
 
+  def get_pool_stats(self):
+    """Returns a JSON dict of statistics for this database's connection pool."""
+    result = self._pool_stats.to_json()
+    pool = self._engine.pool
+    result['status'] = pool.status()
+    if isinstance(pool, QueuePool):
+      result['size'] = pool.size()
+      result['checkedIn'] = pool.checkedin()
+      result['checkedOut'] = pool.checkedout()
+      result['overflow'] = pool.overflow()
+    return result
+
   def create_schema(self):
     Base.metadata.create_all(self._engine)
 
@@ -59,28 +118,297 @@ class Database(object):
     return self._Session()
 
   @contextmanager
-  def session(self):
+  def session(self, name=None):
+    """Yields a session, which is committed at the end (or rolled back on an exception).
+
+    Deadlocks and lock wait timeouts are counted in the lock error stats under name (normally the
+    DAO's class name).
+    """
     sess = self.make_session()
     try:
       yield sess
       sess.commit()
-    except Exception:
+    except Exception as e:
       sess.rollback()
+      if isinstance(e, DBAPIError):
+        self._record_lock_error(e, name)
       raise
     finally:
       sess.close()
 
+  def _record_lock_error(self, error, name):
+    code = get_lock_error_code(error)
+    # A session nested in another sees the same error again as it propagates; count it once.
+    if code is None or getattr(error, 'lock_error_recorded', False):
+      return
+    error.lock_error_recorded = True
+    _lock_error_stats.record(name, _LOCK_ERROR_COUNTERS[code])
+    logging.warning('Transaction for %s failed: %s', name or 'unknown', error.orig)
+    if code == MYSQL_DEADLOCK_ERROR and _should_log_innodb_status():
+      self.log_innodb_status()
+
+  def log_innodb_status(self):
+    """Logs the latest deadlock reported by SHOW ENGINE INNODB STATUS (on MySQL)."""
+    if self._engine.dialect.name != 'mysql':
+      return
+    try:
+      status = self._engine.execute('SHOW ENGINE INNODB STATUS').fetchone()[2]
+    except Exception:  # pylint: disable=broad-except
+      # E.g. the database user doesn't have the PROCESS privilege.
+      logging.warning('Failed to get InnoDB status.', exc_info=True)
+      return
+    start = status.find('LATEST DETECTED DEADLOCK')
+    if start < 0:
+      logging.warning('InnoDB status has no deadlock:\n%s', status)
+      return
+    end = status.find('\nTRANSACTIONS\n', start)
+    logging.warning('InnoDB status:\n%s', status[start:end] if end >= 0 else status[start:])
+
   # TODO: at the time of writing, a PR went in to backoff that adds a `max_time` parameter.  This
   # will be part of backoff 1.5 (we are on backoff 1.4).  When it releases, use it to prevent
   # ludicriously long retry periods.
+  def autoretry(self, func, name=None):
+    """Runs a function of the db session and attempts to commit.  If we encounter a dropped
+    connection, we retry the operation.  The retries are spaced out using exponential backoff with
+    full jitter.
+
+    If the transaction fails with a deadlock or lock wait timeout, the whole transaction is run
+    again in a new session (so func must be safe to repeat), up to LOCK_ERROR_ATTEMPT_LIMIT
+    attempts in all, after a random delay that doubles in range with each attempt. Retries are
+    counted in the lock error stats under name. All other errors are propagated.
+    """
+    attempt = 1
+    while True:
+      try:
+        return self._autoretry_connection(func, name)
+      except DBAPIError as e:
+        if get_lock_error_code(e) is None or attempt >= LOCK_ERROR_ATTEMPT_LIMIT:
+          raise
+      _lock_error_stats.record(name, 'retries')
+      time.sleep(random.uniform(0, LOCK_ERROR_RETRY_DELAY_SECONDS * 2 ** (attempt - 1)))
+      attempt += 1
+
   @backoff.on_exception(backoff.expo,
                         DBAPIError,
                         max_tries=RETRY_CONNECTION_LIMIT,
                         giveup=lambda err: not getattr(err, 'connection_invalidated', False))
-  def autoretry(self, func):
-    """Runs a function of the db session and attempts to commit.  If we encounter a dropped
-    connection, we retry the operation.  The retries are spaced out using exponential backoff with
-    full jitter.  All other errors are propagated.
-    """
-    with self.session() as session:
+  def _autoretry_connection(self, func, name):
+    with self.session(name=name) as session:
       return func(session)
+
+
+class PoolStats(object):
+  """Counts connection checkouts from a Database's pool (and how long they waited for a
+  connection), timeouts, and invalidated connections, including those that failed pre-ping."""
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.checkouts = 0
+    self.timeouts = 0
+    self.invalidations = 0
+    self.total_wait_ms = 0.0
+    self.max_wait_ms = 0.0
+    # Counts of waits up to each of CHECKOUT_WAIT_BUCKETS_MS, then of longer waits.
+    self.wait_histogram = [0] * (len(CHECKOUT_WAIT_BUCKETS_MS) + 1)
+
+  # pylint: disable=unused-argument
+  def record_checkout(self, dbapi_connection, connection_record, connection_proxy):
+    with self._lock:
+      self.checkouts += 1
+
+  def record_wait(self, wait_ms):
+    bucket = bisect.bisect_left(CHECKOUT_WAIT_BUCKETS_MS, wait_ms)
+    with self._lock:
+      self.total_wait_ms += wait_ms
+      self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+      self.wait_histogram[bucket] += 1
+
+  def record_timeout(self):
+    with self._lock:
+      self.timeouts += 1
+
+  # pylint: disable=unused-argument
+  def record_invalidation(self, dbapi_connection, connection_record, exception):
+    with self._lock:
+      self.invalidations += 1
+
+  def to_json(self):
+    with self._lock:
+      histogram = dict(('<=%dms' % bound, count)
+                       for bound, count in zip(CHECKOUT_WAIT_BUCKETS_MS, self.wait_histogram))
+      histogram['>%dms' % CHECKOUT_WAIT_BUCKETS_MS[-1]] = self.wait_histogram[-1]
+      return {
+          'checkouts': self.checkouts,
+          'timeouts': self.timeouts,
+          'invalidations': self.invalidations,
+          'totalWaitMs': self.total_wait_ms,
+          'maxWaitMs': self.max_wait_ms,
+          'waitHistogram': histogram,
+      }
+
+
+class LockErrorStats(object):
+  """Counts deadlocks, lock wait timeouts and the autoretry retries after them, by the name of
+  the DAO (or other caller) whose transaction hit them."""
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._counts = collections.defaultdict(collections.Counter)
+
+  def record(self, name, counter):
+    with self._lock:
+      self._counts[name or 'unknown'][counter] += 1
+
+  def to_json(self):
+    with self._lock:
+      return {name: dict(counts) for name, counts in self._counts.iteritems()}
+
+
+_lock_error_stats = LockErrorStats()
+
+
+def get_lock_error_stats():
+  """Returns this instance's deadlock, lock wait timeout and retry counts, by DAO name."""
+  return _lock_error_stats.to_json()
+
+
+def get_lock_error_code(error):
+  """Returns MYSQL_DEADLOCK_ERROR or MYSQL_LOCK_WAIT_TIMEOUT_ERROR if a DBAPIError is one of
+  those, otherwise None."""
+  args = getattr(error.orig, 'args', None)
+  if args and args[0] in _LOCK_ERROR_COUNTERS:
+    return args[0]
+  return None
+
+
+def _should_log_innodb_status():
+  # Only import "config" on demand, as database_factory does.
+  import config
+  try:
+    return config.getSetting(config.LOG_INNODB_STATUS_ON_DEADLOCK, False)
+  except Exception:  # pylint: disable=broad-except
+    # E.g. in tools that run without access to the config store.
+    return False
+
+
+class _InstrumentedQueuePool(QueuePool):
+  """A QueuePool which records how long each checkout waits for a connection in stats."""
+  stats = None
+
+  def _do_get(self):
+    start_time = time.time()
+    try:
+      connection_record = super(_InstrumentedQueuePool, self)._do_get()
+    except TimeoutError:
+      if self.stats:
+        self.stats.record_timeout()
+      raise
+    if self.stats:
+      self.stats.record_wait((time.time() - start_time) * 1000)
+    return connection_record
+
+  def recreate(self):
+    pool = super(_InstrumentedQueuePool, self).recreate()
+    pool.stats = self.stats
+    return pool
+
+
+class QueryStats(object):
+  """Counts and times the SQL statements run on one thread, normally while handling a request.
+
+  Statements taking at least slow_query_threshold_ms (if set) are logged with their parameters and,
+  on MySQL, their EXPLAIN plan. Statements whose results stream through a server-side cursor are
+  timed only until their first row, and aren't EXPLAINed (their connection is still busy).
+  """
+  def __init__(self, slow_query_threshold_ms=None):
+    self.slow_query_threshold_ms = slow_query_threshold_ms
+    self.statement_count = 0
+    self.total_time_ms = 0.0
+    # Heap of (time_ms, statement) for the slowest statements.
+    self._slowest = []
+
+  def record(self, time_ms, statement):
+    self.statement_count += 1
+    self.total_time_ms += time_ms
+    if len(self._slowest) < MAX_SLOWEST_STATEMENTS:
+      heapq.heappush(self._slowest, (time_ms, statement))
+    elif time_ms > self._slowest[0][0]:
+      heapq.heapreplace(self._slowest, (time_ms, statement))
+
+  def get_slowest(self):
+    """Returns (time_ms, statement) for the slowest statements, slowest first. Long statements
+    are truncated."""
+    return [(time_ms, _truncate(statement))
+            for time_ms, statement in sorted(self._slowest, reverse=True)]
+
+  def summary(self):
+    return '%d statements in %.1fms' % (self.statement_count, self.total_time_ms)
+
+
+def start_query_stats(slow_query_threshold_ms=None):
+  """Starts collecting QueryStats for SQL statements run on the current thread."""
+  _query_stats.current = QueryStats(slow_query_threshold_ms)
+  return _query_stats.current
+
+
+def get_query_stats():
+  return getattr(_query_stats, 'current', None)
+
+
+def stop_query_stats():
+  """Stops collecting QueryStats on the current thread, and returns those collected."""
+  stats = get_query_stats()
+  _query_stats.current = None
+  return stats
+
+
+def _truncate(statement):
+  statement = ' '.join(statement.split())
+  if len(statement) > MAX_LOGGED_STATEMENT_LENGTH:
+    return statement[:MAX_LOGGED_STATEMENT_LENGTH] + '...'
+  return statement
+
+
+# pylint: disable=unused-argument
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  conn.info['query_start_time'] = time.time()
+
+
+# pylint: disable=unused-argument
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+  stats = get_query_stats()
+  if stats is None:
+    return
+  time_ms = (time.time() - conn.info['query_start_time']) * 1000
+  stats.record(time_ms, statement)
+  if stats.slow_query_threshold_ms is not None and time_ms >= stats.slow_query_threshold_ms:
+    logging.warning('Slow query (%.1fms%s): %s\nParameters: %.500r\nEXPLAIN: %s', time_ms,
+                    ' to first row' if _is_streaming(cursor, context) else '',
+                    _truncate(statement), parameters,
+                    _explain(conn, cursor, statement, parameters, context, executemany))
+
+
+def _is_streaming(cursor, context):
+  """Whether a statement's results are read from the server as they're fetched (with a server-side
+  cursor), in which case they are still unread when it finishes executing, and its time is only
+  the time to the first row."""
+  return (isinstance(cursor, CursorUseResultMixIn)
+          or (context is not None and bool(context.execution_options.get('stream_results'))))
+
+
+def _explain(conn, cursor, statement, parameters, context, executemany):
+  """Returns the EXPLAIN rows for a (MySQL SELECT) statement, or None."""
+  if (conn.dialect.name != 'mysql' or executemany
+      or not statement.lstrip()[:6].upper() == 'SELECT'
+      # Results from server-side cursors are still being read, so the connection is busy.
+      or _is_streaming(cursor, context)):
+    return None
+  try:
+    # Use the DBAPI connection directly, so that the EXPLAIN isn't itself recorded.
+    explain_cursor = conn.connection.cursor()
+    try:
+      explain_cursor.execute('EXPLAIN ' + statement, parameters)
+      return explain_cursor.fetchall()
+    finally:
+      explain_cursor.close()
+  except Exception:  # pylint: disable=broad-except
+    logging.warning('Failed to EXPLAIN slow query.', exc_info=True)
+    return None
@@ -1,7 +1,7 @@
 from model.site_enums import ObsoleteStatus
 from participant_enums import OrganizationType
 from model.base import Base
-from model.utils import Enum
+from model.utils import Enum, UTCDateTime
 from sqlalchemy import Column, Integer, String, UniqueConstraint
 from sqlalchemy.orm import relationship
 
@@ -16,6 +16,8 @@ class HPO(Base):
   organizations = relationship('Organization', cascade='all, delete-orphan',
                                order_by='Organization.externalId')
   isObsolete = Column('is_obsolete', Enum(ObsoleteStatus))
+  # Set on every insert and update, so that caches can fetch only the HPOs that changed.
+  lastModified = Column('last_modified', UTCDateTime)
 
   __table_args__ = (
     UniqueConstraint('name'),
@@ -0,0 +1,18 @@
+from model.base import Base
+from model.utils import UTCDateTime
+from sqlalchemy import Column, Index, Integer, String
+
+class IdReservation(Base):
+  """A random ID reserved by a server for a future insert.
+
+  Servers pick random IDs that aren't used yet in the table they are for and insert them here
+  before handing them out; the primary key keeps two servers from reserving the same ID. Rows are
+  deleted a day after they're reserved (see IdReservationDao), by when the ID is normally used.
+  """
+  __tablename__ = 'id_reservation'
+  # The table and column the ID is for, e.g. "participant.participant_id".
+  idSpace = Column('id_space', String(80), primary_key=True, autoincrement=False)
+  reservedId = Column('reserved_id', Integer, primary_key=True, autoincrement=False)
+  reserved = Column('reserved', UTCDateTime, nullable=False)
+
+Index('id_reservation_space_reserved', IdReservation.idSpace, IdReservation.reserved)
@@ -1,4 +1,6 @@
+import clock
 from model.base import Base
+from model.utils import UTCDateTime
 from sqlalchemy import Column, Integer
 
 class LogPosition(Base):
@@ -13,6 +15,12 @@ class LogPosition(Base):
   (foreign key to log_position_id below). Whenever they are created or updated, the associated DAO
   must overwrite the model's logPosition with a new LogPosition() which, when the object is
   committed, will increment the global log.
+
+  Positions are allocated when a transaction flushes, not when it commits, so a transaction can
+  commit a lower position after another has committed a higher one. Syncs therefore only return
+  positions allocated (at created) long enough ago for their transactions to have committed.
   """
   __tablename__ = 'log_position'
   logPositionId = Column('log_position_id', Integer, primary_key=True)
+  # Null for positions allocated before this was added.
+  created = Column('created', UTCDateTime, default=clock.CLOCK.now)
@@ -1,6 +1,6 @@
 from model.base import Base
 from model.site_enums import ObsoleteStatus
-from model.utils import Enum
+from model.utils import Enum, UTCDateTime
 from sqlalchemy import Column, Integer, String, ForeignKey
 from sqlalchemy.orm import relationship
 
@@ -18,3 +18,5 @@ class Organization(Base):
   # Sites belonging to this organization.
   sites = relationship('Site', cascade='all, delete-orphan', order_by='Site.googleGroup')
   isObsolete = Column('is_obsolete', Enum(ObsoleteStatus))
+  # Set on every insert and update, so that caches can fetch only the organizations that changed.
+  lastModified = Column('last_modified', UTCDateTime)
@@ -39,6 +39,9 @@ class ParticipantSummary(Base):
                          primary_key=True, autoincrement=False)
   biobankId = Column('biobank_id', Integer, nullable=False)
   lastModified = Column('last_modified', UTCDateTime)
+  # Incremented whenever the summary is written, for duplicate-free syncs; see LogPosition.
+  logPositionId = Column('log_position_id', Integer, ForeignKey('log_position.log_position_id'))
+  logPosition = relationship('LogPosition')
   # PTC string fields will generally be limited to 255 chars; set our field lengths accordingly to
   # ensure that long values can be inserted.
   firstName = Column('first_name', String(255), nullable=False)
@@ -295,3 +298,5 @@ Index('participant_summary_hpo_withdrawal_status_time', ParticipantSummary.hpoId
       ParticipantSummary.withdrawalStatus, ParticipantSummary.withdrawalTime)
 Index('participant_summary_last_modified', ParticipantSummary.hpoId,
       ParticipantSummary.lastModified)
+Index('participant_summary_hpo_log_position', ParticipantSummary.hpoId,
+      ParticipantSummary.logPositionId)
@@ -0,0 +1,29 @@
+from model.base import Base
+from model.utils import UTCDateTime
+from sqlalchemy import Boolean, Column, Integer, String, Text
+
+class ParticipantSummaryRebuildShard(Base):
+  """Progress of one shard of a job rebuilding (or verifying) participant summaries.
+
+  Each job splits the participant ID space into ranges (shards) that are processed in parallel, a
+  batch of participants at a time; nextId records where to resume a shard.
+  """
+  __tablename__ = 'participant_summary_rebuild_shard'
+  jobId = Column('job_id', String(40), primary_key=True)
+  shard = Column('shard', Integer, primary_key=True, autoincrement=False)
+  startId = Column('start_id', Integer, nullable=False)
+  endId = Column('end_id', Integer, nullable=False)
+  # The lowest participant ID not processed yet.
+  nextId = Column('next_id', Integer, nullable=False)
+  batchSize = Column('batch_size', Integer, nullable=False)
+  # If true, differences are recorded but summaries are left unchanged.
+  dryRun = Column('dry_run', Boolean, nullable=False)
+  checked = Column('checked', Integer, nullable=False, default=0)
+  changed = Column('changed', Integer, nullable=False, default=0)
+  skipped = Column('skipped', Integer, nullable=False, default=0)
+  errors = Column('errors', Integer, nullable=False, default=0)
+  started = Column('started', UTCDateTime, nullable=False)
+  updated = Column('updated', UTCDateTime, nullable=False)
+  finished = Column('finished', UTCDateTime)
+  # JSON list of the first differences found (and errors), for inspection.
+  diffs = Column('diffs', Text)
@@ -61,3 +61,23 @@ class QuestionnaireResponseAnswer(Base):
   valueDate = Column('value_date', Date)
   valueDateTime = Column('value_datetime', UTCDateTime)
   valueUri = Column('value_uri', String(1024))
+
+
+class QuestionnaireResponseCurrentAnswer(Base):
+  """The current answers each participant has given to questions with each concept code.
+
+  Maintained alongside QuestionnaireResponseAnswer.endTime when responses are inserted: a row
+  exists for each answer that doesn't have endTime set. Finding the answers a new response
+  replaces (and "latest answer" queries) can use this instead of joining responses, answers and
+  questions.
+  """
+  __tablename__ = 'questionnaire_response_current_answer'
+  participantId = Column('participant_id', Integer, ForeignKey('participant.participant_id'),
+                         primary_key=True, autoincrement=False)
+  questionCodeId = Column('question_code_id', Integer, ForeignKey('code.code_id'),
+                          primary_key=True, autoincrement=False)
+  questionnaireResponseAnswerId = Column(
+      'questionnaire_response_answer_id', Integer,
+      ForeignKey('questionnaire_response_answer.questionnaire_response_answer_id',
+                 ondelete='CASCADE'),
+      primary_key=True, autoincrement=False)
@@ -1,7 +1,7 @@
 from model.base import Base
 from sqlalchemy import Column, Integer, String, Date, Float, ForeignKey, UnicodeText
 from site_enums import SiteStatus, EnrollingStatus, DigitalSchedulingStatus, ObsoleteStatus
-from model.utils import Enum
+from model.utils import Enum, UTCDateTime
 
 class Site(Base):
   __tablename__ = 'site'
@@ -37,3 +37,5 @@ class Site(Base):
   adminEmails = Column('admin_emails', String(4096))
   link = Column('link', String(255))
   isObsolete = Column('is_obsolete', Enum(ObsoleteStatus))
+  # Set on every insert and update, so that caches can fetch only the sites that changed.
+  lastModified = Column('last_modified', UTCDateTime)
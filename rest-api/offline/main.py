@@ -14,6 +14,7 @@ from google.appengine.api import app_identity
 from offline import biobank_samples_pipeline
 from offline.base_pipeline import send_failure_alert
 from offline.metrics_export import MetricsExport
+from offline import participant_summary_rebuild
 from offline.public_metrics_export import PublicMetricsExport, LIVE_METRIC_SET_ID
 from offline.sa_key_remove import delete_service_account_keys
 from offline.table_exporter import TableExporter
@@ -133,6 +134,39 @@ def delete_old_keys():
   return '{"success": "true"}'
 
 
+def _get_int_param(resource_json, name, default, max_value):
+  value = resource_json.get(name, default)
+  if type(value) is not int or not 0 < value <= max_value:
+    raise BadRequest('%s must be between 1 and %d' % (name, max_value))
+  return value
+
+
+@app_util.auth_required(EXPORTER)
+def start_participant_summary_rebuild():
+  resource_json = json.loads(request.get_data() or '{}')
+  # Verify only, unless a rebuild is explicitly requested.
+  dry_run = resource_json.get('dryRun') is not False
+  num_shards = _get_int_param(resource_json, 'shards',
+                              participant_summary_rebuild.DEFAULT_NUM_SHARDS,
+                              participant_summary_rebuild.MAX_NUM_SHARDS)
+  batch_size = _get_int_param(resource_json, 'batchSize',
+                              participant_summary_rebuild.DEFAULT_BATCH_SIZE,
+                              participant_summary_rebuild.MAX_BATCH_SIZE)
+  job_id = participant_summary_rebuild.start_job(dry_run, num_shards, batch_size)
+  return json.dumps({'jobId': job_id, 'dryRun': dry_run})
+
+
+@app_util.auth_required(EXPORTER)
+def get_participant_summary_rebuild(job_id):
+  return json.dumps(participant_summary_rebuild.get_job_status(job_id))
+
+
+@app_util.auth_required(EXPORTER)
+def resume_participant_summary_rebuild(job_id):
+  return json.dumps({'jobId': job_id,
+                     'shardsRestarted': participant_summary_rebuild.resume_job(job_id)})
+
+
 def _build_pipeline_app():
   """Configure and return the app with non-resource pipeline-triggering endpoints."""
   offline_app = Flask(__name__)
@@ -167,6 +201,24 @@ def _build_pipeline_app():
     view_func=delete_old_keys,
     methods=['GET'])
 
+  offline_app.add_url_rule(
+      PREFIX + 'ParticipantSummaryRebuild',
+      endpoint='participant_summary_rebuild',
+      view_func=start_participant_summary_rebuild,
+      methods=['POST'])
+
+  offline_app.add_url_rule(
+      PREFIX + 'ParticipantSummaryRebuild/<job_id>',
+      endpoint='participant_summary_rebuild_status',
+      view_func=get_participant_summary_rebuild,
+      methods=['GET'])
+
+  offline_app.add_url_rule(
+      PREFIX + 'ParticipantSummaryRebuild/<job_id>/Resume',
+      endpoint='participant_summary_rebuild_resume',
+      view_func=resume_participant_summary_rebuild,
+      methods=['POST'])
+
   offline_app.after_request(app_util.add_headers)
   offline_app.before_request(app_util.request_logging)
   offline_app.register_error_handler(DBAPIError, app_util.handle_database_disconnect)
@@ -79,7 +79,7 @@ def _consent_for_study_enrollment_and_ehr(summary):
   return UNSET
 
 def _get_baseline_ppi_module_fields():
-  return config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS, [])
+  return config.get_snapshot().baseline_ppi_questionnaire_fields
 
 def _num_completed_baseline_ppi_modules(summary):
   baseline_ppi_module_fields = _get_baseline_ppi_module_fields()
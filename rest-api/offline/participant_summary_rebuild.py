@@ -0,0 +1,369 @@
+"""Rebuilds or verifies participant summaries from the data they are derived from.
+
+Summary fields are normally updated as questionnaire responses, physical measurements and
+biobank orders are submitted, and as biobank samples are imported. After a fix to that logic, this
+job recomputes each summary by replaying the participant's data through the same DAO code, in the
+order it was submitted, and writes any differences (or, in a dry run, just records them).
+
+The participant ID space is split into ranges (shards) which are processed in parallel, each by a
+chain of deferred tasks handling a batch of participants at a time. Progress is checkpointed in
+participant_summary_rebuild_shard, so a job can be resumed if a chain of tasks stops.
+"""
+import collections
+import datetime
+import json
+import logging
+
+from google.appengine.ext import deferred
+from protorpc import messages
+from sqlalchemy import func
+from sqlalchemy.orm import subqueryload
+from werkzeug.exceptions import BadRequest, NotFound
+
+import clock
+from dao import database_factory
+from dao.biobank_order_dao import BiobankOrderDao
+from dao.participant_summary_dao import ParticipantSummaryDao
+from dao.participant_summary_rebuild_dao import ParticipantSummaryRebuildShardDao
+from dao.physical_measurements_dao import PhysicalMeasurementsDao
+from dao.questionnaire_response_dao import QuestionnaireResponseDao
+from model.biobank_order import BiobankOrder
+from model.log_position import LogPosition
+from model.measurements import PhysicalMeasurements
+from model.participant import Participant
+from model.participant_summary import ParticipantSummary
+from model.questionnaire_response import QuestionnaireResponse
+from model.utils import to_client_participant_id
+from participant_enums import PhysicalMeasurementsStatus, WithdrawalStatus
+
+DEFAULT_NUM_SHARDS = 10
+DEFAULT_BATCH_SIZE = 100
+MAX_NUM_SHARDS = 100
+MAX_BATCH_SIZE = 1000
+# Maximum number of differences (and errors) stored for each shard.
+MAX_STORED_DIFFS = 50
+# Shards that haven't made progress for this long are restarted when a job is resumed.
+_STALLED_SHARD_SECONDS = 600
+
+# Fields that aren't rebuilt in memory. Sample fields are recomputed from biobank_stored_sample
+# by ParticipantSummaryDao.update_from_biobank_stored_samples_with_session instead.
+_NOT_REBUILT_FIELDS = frozenset(['participantId', 'lastModified', 'logPositionId'])
+_SAMPLE_FIELD_PREFIX = 'sampleStatus'
+_SAMPLE_COUNT_FIELDS = frozenset(['numBaselineSamplesArrived', 'samplesToIsolateDNA'])
+
+_ReplayEvent = collections.namedtuple('_ReplayEvent', ['created', 'kind', 'obj'])
+
+
+class _BatchResult(object):
+  def __init__(self):
+    self.checked = 0
+    self.changed = 0
+    self.skipped = 0
+    self.errors = 0
+    self.diffs = []
+
+  def add_diff(self, diff):
+    if len(self.diffs) < MAX_STORED_DIFFS:
+      self.diffs.append(diff)
+
+
+def start_job(dry_run=True, num_shards=DEFAULT_NUM_SHARDS, batch_size=DEFAULT_BATCH_SIZE):
+  """Splits the participants with summaries into num_shards ID ranges, and starts a chain of
+  tasks for each. Returns the new job's ID."""
+  with database_factory.get_database().session() as session:
+    min_id, max_id = session.query(func.min(ParticipantSummary.participantId),
+                                   func.max(ParticipantSummary.participantId)).one()
+  job_id = clock.CLOCK.now().strftime('%Y%m%d-%H%M%S-%f')
+  id_ranges = []
+  if min_id is not None:
+    shard_size = (max_id - min_id) / num_shards + 1
+    for start_id in range(min_id, max_id + 1, shard_size):
+      id_ranges.append((start_id, min(start_id + shard_size - 1, max_id)))
+  shards = ParticipantSummaryRebuildShardDao().create_job(job_id, id_ranges, batch_size, dry_run)
+  for shard in shards:
+    deferred.defer(_rebuild_next_batch, job_id, shard.shard)
+  logging.info('Started participant summary %s job %s with %d shards.',
+               'verify' if dry_run else 'rebuild', job_id, len(shards))
+  return job_id
+
+
+def resume_job(job_id):
+  """Restarts the shards of a job that haven't finished or made progress recently, e.g. after
+  their tasks ran out of retries. Returns the number of shards restarted."""
+  shards = _get_job_shards(job_id)
+  stalled_time = clock.CLOCK.now() - datetime.timedelta(seconds=_STALLED_SHARD_SECONDS)
+  restarted = 0
+  for shard in shards:
+    if shard.finished is None and shard.updated <= stalled_time:
+      deferred.defer(_rebuild_next_batch, job_id, shard.shard)
+      restarted += 1
+  logging.info('Restarted %d shards of participant summary job %s.', restarted, job_id)
+  return restarted
+
+
+def get_job_status(job_id):
+  """Returns counts and throughput for a job, in total and for each shard."""
+  shards = _get_job_shards(job_id)
+  totals = collections.Counter()
+  shard_statuses = []
+  for shard in shards:
+    counts = {'checked': shard.checked, 'changed': shard.changed, 'skipped': shard.skipped,
+              'errors': shard.errors}
+    totals.update(counts)
+    shard_status = dict(counts, shard=shard.shard, startId=shard.startId, endId=shard.endId,
+                        nextId=shard.nextId, finished=shard.finished is not None,
+                        diffs=json.loads(shard.diffs) if shard.diffs else [])
+    shard_statuses.append(shard_status)
+  started = min(shard.started for shard in shards)
+  unfinished = [shard for shard in shards if shard.finished is None]
+  end_time = clock.CLOCK.now() if unfinished else max(shard.finished for shard in shards)
+  elapsed_seconds = (end_time - started).total_seconds()
+  return dict(totals,
+              jobId=job_id,
+              dryRun=shards[0].dryRun,
+              shardsFinished=len(shards) - len(unfinished),
+              numShards=len(shards),
+              elapsedSeconds=int(elapsed_seconds),
+              participantsPerSecond=(round(totals['checked'] / elapsed_seconds, 2)
+                                     if elapsed_seconds else None),
+              shards=shard_statuses)
+
+
+def _get_job_shards(job_id):
+  shards = ParticipantSummaryRebuildShardDao().get_job_shards(job_id)
+  if not shards:
+    raise NotFound('Participant summary job %s not found.' % job_id)
+  return shards
+
+
+def _rebuild_next_batch(job_id, shard_number):
+  """Processes the next batch of participants in a shard, then defers processing the one after.
+
+  The shard's checkpoint is updated in the same transaction as the summaries, so a retried or
+  duplicate task picks up where the last successful one left off.
+  """
+  shard_dao = ParticipantSummaryRebuildShardDao()
+  with shard_dao.session() as session:
+    shard = shard_dao.get_with_session(session, [job_id, shard_number], for_update=True)
+    if shard is None or shard.finished is not None:
+      return
+    participant_ids = [row.participantId for row in
+                       session.query(ParticipantSummary.participantId)
+                       .filter(ParticipantSummary.participantId >= shard.nextId)
+                       .filter(ParticipantSummary.participantId <= shard.endId)
+                       .order_by(ParticipantSummary.participantId)
+                       .limit(shard.batchSize)]
+    result = _BatchResult()
+    if participant_ids:
+      next_id = shard.nextId
+      result = rebuild_participant_summaries(session, participant_ids, shard.dryRun)
+      if shard.dryRun:
+        # Undo the rebuild, then lock the shard again to record progress (unless a duplicate task
+        # got there first).
+        session.rollback()
+        shard = shard_dao.get_with_session(session, [job_id, shard_number], for_update=True)
+        if shard.nextId != next_id:
+          return
+    _record_progress(shard, participant_ids, result)
+    finished = shard.finished is not None
+  if finished:
+    logging.info('Finished shard %d of participant summary job %s.', shard_number, job_id)
+  else:
+    deferred.defer(_rebuild_next_batch, job_id, shard_number)
+
+
+def _record_progress(shard, participant_ids, result):
+  now = clock.CLOCK.now()
+  shard.checked += result.checked
+  shard.changed += result.changed
+  shard.skipped += result.skipped
+  shard.errors += result.errors
+  shard.updated = now
+  if result.diffs:
+    diffs = json.loads(shard.diffs) if shard.diffs else []
+    shard.diffs = json.dumps((diffs + result.diffs)[:MAX_STORED_DIFFS])
+  if len(participant_ids) < shard.batchSize:
+    shard.nextId = shard.endId + 1
+    shard.finished = now
+  else:
+    shard.nextId = participant_ids[-1] + 1
+
+
+def rebuild_participant_summaries(session, participant_ids, dry_run):
+  """Rebuilds the summaries for the given participants (sorted by ID) in the session, and
+  returns a _BatchResult with the differences found.
+
+  The participants are locked for the rest of the transaction. If dry_run is set, the caller must
+  roll back the session afterwards.
+  """
+  result = _BatchResult()
+  participants = (session.query(Participant)
+                  .filter(Participant.participantId.in_(participant_ids))
+                  .order_by(Participant.participantId)
+                  .with_for_update()
+                  .all())
+  summaries = {summary.participantId: summary for summary in
+               session.query(ParticipantSummary)
+               .filter(ParticipantSummary.participantId.in_(participant_ids))
+               .with_for_update()}
+  original_values = {participant_id: _get_field_values(summary)
+                     for participant_id, summary in summaries.iteritems()}
+  events = _load_replay_events(session, participant_ids)
+  replayer = _Replayer(session)
+
+  for participant in participants:
+    summary = summaries.get(participant.participantId)
+    if summary is None or participant.withdrawalStatus == WithdrawalStatus.NO_USE:
+      result.skipped += 1
+      continue
+    result.checked += 1
+    try:
+      rebuilt = replayer.replay(participant, summary, events[participant.participantId])
+    except BadRequest as e:
+      result.errors += 1
+      result.add_diff({'participantId': to_client_participant_id(participant.participantId),
+                       'error': e.description})
+      continue
+    _copy_rebuilt_fields(rebuilt, summary)
+
+  session.flush()
+  # Sample fields (and the enrollment status that depends on them) come from stored samples.
+  ParticipantSummaryDao().update_from_biobank_stored_samples_with_session(
+      session, participant_id_range=(participant_ids[0], participant_ids[-1]))
+  session.expire_all()
+
+  now = clock.CLOCK.now()
+  for summary in (session.query(ParticipantSummary)
+                  .filter(ParticipantSummary.participantId.in_(original_values.keys()))):
+    original = original_values[summary.participantId]
+    changes = {field: [_to_json_value(value), _to_json_value(getattr(summary, field))]
+               for field, value in original.iteritems()
+               if field not in _NOT_REBUILT_FIELDS and getattr(summary, field) != value}
+    if not changes:
+      continue
+    result.changed += 1
+    result.add_diff({'participantId': to_client_participant_id(summary.participantId),
+                     'changes': changes})
+    if not dry_run:
+      summary.lastModified = now
+      summary.logPosition = LogPosition()
+  return result
+
+
+def _load_replay_events(session, participant_ids):
+  """Returns the responses, measurements and (non-cancelled) orders for the participants as
+  _ReplayEvents in the order they were submitted, by participant ID."""
+  events = collections.defaultdict(list)
+  responses = (session.query(QuestionnaireResponse)
+               .options(subqueryload(QuestionnaireResponse.answers))
+               .filter(QuestionnaireResponse.participantId.in_(participant_ids)))
+  for response in responses:
+    events[response.participantId].append(_ReplayEvent(response.created, 'response', response))
+  measurements = (session.query(PhysicalMeasurements)
+                  .filter(PhysicalMeasurements.participantId.in_(participant_ids)))
+  for measurement in measurements:
+    events[measurement.participantId].append(
+        _ReplayEvent(measurement.created, 'measurements', measurement))
+  orders = (BiobankOrderDao.get_non_cancelled_orders_query(session)
+            .options(subqueryload(BiobankOrder.samples))
+            .filter(BiobankOrder.participantId.in_(participant_ids)))
+  for order in orders:
+    events[order.participantId].append(_ReplayEvent(order.created, 'order', order))
+  for participant_events in events.itervalues():
+    participant_events.sort(key=lambda event: event.created)
+  return events
+
+
+class _Replayer(object):
+  """Builds new summaries from participants' data, using the same code as when it was
+  submitted."""
+  def __init__(self, session):
+    self._session = session
+    self._response_dao = QuestionnaireResponseDao()
+    self._measurements_dao = PhysicalMeasurementsDao()
+    self._order_dao = BiobankOrderDao()
+    self._summary_dao = ParticipantSummaryDao()
+
+  def replay(self, participant, existing_summary, events):
+    """Returns a new summary for the participant, built by applying each event in turn. Raises
+    BadRequest if an event would have been rejected."""
+    summary = None
+    for event in events:
+      if event.kind == 'response':
+        is_new = summary is None
+        summary = self._apply_response(participant, summary, event.obj)
+        if is_new:
+          _copy_sample_fields(existing_summary, summary)
+      elif summary is None:
+        raise BadRequest('%s for participant %s submitted before consent' %
+                         (event.kind, participant.participantId))
+      elif event.kind == 'measurements':
+        self._measurements_dao.set_participant_summary_fields(event.obj, summary)
+      else:
+        self._order_dao.set_participant_summary_fields(event.obj, summary)
+      self._summary_dao.update_enrollment_status(summary)
+
+    if summary is None:
+      raise BadRequest('No consent found for participant %s' % participant.participantId)
+    if any(event.obj.status == PhysicalMeasurementsStatus.CANCELLED for event in events
+           if event.kind == 'measurements'):
+      self._apply_cancelled_measurements(participant, summary)
+      self._summary_dao.update_enrollment_status(summary)
+    summary.withdrawalTime = participant.withdrawalTime
+    summary.suspensionTime = participant.suspensionTime
+    return summary
+
+  def _apply_response(self, participant, summary, response):
+    # pylint: disable=protected-access
+    questionnaire_history, questions, code_ids = self._response_dao.get_questions_answered(
+        response)
+    summary, _ = self._response_dao._apply_to_participant_summary(
+        participant, summary, response, code_ids, questions, questionnaire_history,
+        json.loads(response.resource))
+    return summary
+
+  def _apply_cancelled_measurements(self, participant, summary):
+    """Applies cancellations, as PhysicalMeasurementsDao does when they are submitted."""
+    if self._measurements_dao.has_uncancelled_pm(self._session, participant):
+      latest = self._measurements_dao.get_latest_pm(self._session, participant)
+      self._measurements_dao.set_participant_summary_fields(latest, summary)
+    else:
+      summary.physicalMeasurementsStatus = PhysicalMeasurementsStatus.CANCELLED
+      summary.physicalMeasurementsTime = None
+
+
+def _is_sample_field(field):
+  return field.startswith(_SAMPLE_FIELD_PREFIX) or field in _SAMPLE_COUNT_FIELDS
+
+
+def _get_field_values(summary):
+  return {prop.key: getattr(summary, prop.key)
+          for prop in ParticipantSummary.__mapper__.column_attrs}
+
+
+def _copy_sample_fields(source, target):
+  for prop in ParticipantSummary.__mapper__.column_attrs:
+    if _is_sample_field(prop.key):
+      setattr(target, prop.key, getattr(source, prop.key))
+
+
+def _copy_rebuilt_fields(rebuilt, summary):
+  """Copies rebuilt fields onto the stored summary. Fields left unset on the rebuilt summary get
+  their column defaults, as they would have on insert."""
+  for prop in ParticipantSummary.__mapper__.column_attrs:
+    if prop.key in _NOT_REBUILT_FIELDS or _is_sample_field(prop.key):
+      continue
+    value = getattr(rebuilt, prop.key)
+    default = prop.columns[0].default
+    if value is None and default is not None and default.is_scalar:
+      value = default.arg
+    if getattr(summary, prop.key) != value:
+      setattr(summary, prop.key, value)
+
+
+def _to_json_value(value):
+  if isinstance(value, messages.Enum):
+    return str(value)
+  if isinstance(value, (datetime.date, datetime.datetime)):
+    return value.isoformat()
+  return value
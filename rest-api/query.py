@@ -31,7 +31,8 @@ class OrderBy(object):
 
 class Query(object):
   def __init__(self, field_filters, order_by, max_results, pagination_token, a_id=None,
-               always_return_token=False, include_total=False, offset=False):
+               always_return_token=False, include_total=False, offset=False,
+               estimate_total=False, elements=None):
     self.field_filters = field_filters
     self.order_by = order_by
     self.offset = offset
@@ -40,6 +41,10 @@ class Query(object):
     self.ancestor_id = a_id
     self.always_return_token = always_return_token
     self.include_total = include_total
+    # If set with include_total, large totals may be estimated from index statistics.
+    self.estimate_total = estimate_total
+    # If set, only these elements are selected, and results are rows rather than model objects.
+    self.elements = elements
 
 class Results(object):
   def __init__(self, items, pagination_token=None, more_available=False, total=None):
@@ -47,3 +52,11 @@ class Results(object):
     self.pagination_token = pagination_token
     self.more_available = more_available
     self.total = total
+
+class StreamingResults(Results):
+  """Results whose items are a generator, for streaming very large pages.
+
+  pagination_token and more_available are only populated once items has been fully consumed.
+  """
+  def __init__(self):
+    super(StreamingResults, self).__init__(None)
@@ -1,7 +1,10 @@
+import logging
 import threading
+import time
 from clock import CLOCK
 from datetime import timedelta
 
+# Guards singletons_map and the per-index bookkeeping below; never held while constructing.
 singletons_lock = threading.RLock()
 singletons_map = {}
 
@@ -14,10 +17,86 @@ GENERIC_SQL_DATABASE_INDEX = 5
 MAIN_CONFIG_INDEX = 6
 DB_CONFIG_INDEX = 7
 BACKUP_SQL_DATABASE_INDEX = 8
+SERVER_CURSOR_SQL_DATABASE_INDEX = 9
+READ_REPLICA_STATUS_INDEX = 10
+TOTAL_CACHE_INDEX = 11
+QUESTIONNAIRE_VERSION_CACHE_INDEX = 12
+ID_RESERVATION_POOL_INDEX = 13
+CONSENT_PDF_CACHE_INDEX = 14
+
+_INDEX_NAMES = {
+  CODE_CACHE_INDEX: 'code',
+  HPO_CACHE_INDEX: 'hpo',
+  SITE_CACHE_INDEX: 'site',
+  SQL_DATABASE_INDEX: 'sqlDatabase',
+  ORGANIZATION_CACHE_INDEX: 'organization',
+  GENERIC_SQL_DATABASE_INDEX: 'genericSqlDatabase',
+  MAIN_CONFIG_INDEX: 'mainConfig',
+  DB_CONFIG_INDEX: 'dbConfig',
+  BACKUP_SQL_DATABASE_INDEX: 'backupSqlDatabase',
+  SERVER_CURSOR_SQL_DATABASE_INDEX: 'serverCursorSqlDatabase',
+  READ_REPLICA_STATUS_INDEX: 'readReplicaStatus',
+  TOTAL_CACHE_INDEX: 'total',
+  QUESTIONNAIRE_VERSION_CACHE_INDEX: 'questionnaireVersion',
+  ID_RESERVATION_POOL_INDEX: 'idReservationPool',
+  CONSENT_PDF_CACHE_INDEX: 'consentPdf',
+}
+
+# Per-index locks held while constructing a value, so that a slow constructor for one index
+# doesn't block gets for the others.
+_index_locks = {}
+# Incremented by invalidate(), so that a refresh started before invalidation is discarded.
+_generations = {}
+_stats = {}
+
+
+class _IndexStats(object):
+  """Counters for a single index."""
+  def __init__(self):
+    self.hits = 0
+    self.stale_hits = 0
+    self.misses = 0
+    self.rebuilds = 0
+    self.rebuild_errors = 0
+    self.total_rebuild_ms = 0
+    self.max_rebuild_ms = 0
+
+  def record_rebuild(self, elapsed_ms):
+    self.rebuilds += 1
+    self.total_rebuild_ms += elapsed_ms
+    self.max_rebuild_ms = max(self.max_rebuild_ms, elapsed_ms)
+
+  def to_json(self):
+    return {
+      'hits': self.hits,
+      'staleHits': self.stale_hits,
+      'misses': self.misses,
+      'rebuilds': self.rebuilds,
+      'rebuildErrors': self.rebuild_errors,
+      'meanRebuildMs': self.total_rebuild_ms / self.rebuilds if self.rebuilds else None,
+      'maxRebuildMs': self.max_rebuild_ms,
+    }
+
 
 def reset_for_tests():
   with singletons_lock:
     singletons_map.clear()
+    _generations.clear()
+    _stats.clear()
+
+def _get_stats(cache_index):
+  stats = _stats.get(cache_index)
+  if stats is None:
+    with singletons_lock:
+      stats = _stats.setdefault(cache_index, _IndexStats())
+  return stats
+
+def _get_index_lock(cache_index):
+  lock = _index_locks.get(cache_index)
+  if lock is None:
+    with singletons_lock:
+      lock = _index_locks.setdefault(cache_index, threading.Lock())
+  return lock
 
 def _get(cache_index):
   existing_pair = singletons_map.get(cache_index)
@@ -25,27 +104,83 @@ def _get(cache_index):
     return existing_pair[0]
   return None
 
+def _construct(cache_index, constructor, cache_ttl_seconds, kwargs):
+  """Builds a new value and stores it, unless the index was invalidated in the meantime."""
+  generation = _generations.get(cache_index, 0)
+  start_time = time.time()
+  try:
+    new_instance = constructor(**kwargs)
+  except Exception:
+    _get_stats(cache_index).rebuild_errors += 1
+    raise
+  _get_stats(cache_index).record_rebuild(int((time.time() - start_time) * 1000))
+  expiration_time = None
+  if cache_ttl_seconds is not None:
+    expiration_time = CLOCK.now() + timedelta(seconds=cache_ttl_seconds)
+  with singletons_lock:
+    if _generations.get(cache_index, 0) == generation:
+      singletons_map[cache_index] = (new_instance, expiration_time)
+  return new_instance
+
+def _refresh(cache_index, constructor, cache_ttl_seconds, kwargs):
+  """Rebuilds an expired value, unless another thread is already rebuilding it. Returns the new
+  value, or None if this thread didn't rebuild it."""
+  lock = _get_index_lock(cache_index)
+  if not lock.acquire(False):
+    return None
+  try:
+    # Another thread may have finished rebuilding it just before we got the lock.
+    fresh = _get(cache_index)
+    if fresh is not None:
+      return fresh
+    return _construct(cache_index, constructor, cache_ttl_seconds, kwargs)
+  except Exception:  # pylint: disable=broad-except
+    # Keep serving the stale value; the next get after expiry will try again.
+    logging.warning('Refreshing singleton %s failed.', _INDEX_NAMES.get(cache_index, cache_index),
+                    exc_info=True)
+    return None
+  finally:
+    lock.release()
+
 def get(cache_index, constructor, cache_ttl_seconds=None, **kwargs):
   """Get a cache with a specified index from the list above. If not initialized, use
-  constructor to initialize it; if cache_ttl_seconds is set, reload it after that period."""
-  # First try without a lock
-  result = _get(cache_index)
-  if result:
-    return result
+  constructor to initialize it; if cache_ttl_seconds is set, reload it after that period.
 
-  # Then grab the lock and try again
-  with singletons_lock:
-    result = _get(cache_index)
-    if result:
-      return result
-    else:
-      new_instance = constructor(**kwargs)
-      expiration_time = None
-      if cache_ttl_seconds is not None:
-        expiration_time = CLOCK.now() + timedelta(seconds=cache_ttl_seconds)
-      singletons_map[cache_index] = (new_instance, expiration_time)
-      return new_instance
+  Once the TTL has passed, the first caller to see the expired value reloads it, while other
+  threads are still given the expired value until it's done. (Request threads can't outlive their
+  requests on App Engine, so there is no background reload.)
+  """
+  stats = _get_stats(cache_index)
+  existing_pair = singletons_map.get(cache_index)
+  if existing_pair:
+    if existing_pair[1] is None or existing_pair[1] >= CLOCK.now():
+      stats.hits += 1
+      return existing_pair[0]
+    stats.stale_hits += 1
+    fresh = _refresh(cache_index, constructor, cache_ttl_seconds, kwargs)
+    return existing_pair[0] if fresh is None else fresh
+
+  # Nothing to serve yet; construct it, unless another thread got there first.
+  with _get_index_lock(cache_index):
+    existing_pair = singletons_map.get(cache_index)
+    if existing_pair:
+      stats.hits += 1
+      return existing_pair[0]
+    stats.misses += 1
+    return _construct(cache_index, constructor, cache_ttl_seconds, kwargs)
+
+def get_existing(cache_index):
+  """Returns the object for the index if it has been constructed (and hasn't expired), or None."""
+  return _get(cache_index)
 
 def invalidate(cache_index):
   with singletons_lock:
     singletons_map[cache_index] = None
+    _generations[cache_index] = _generations.get(cache_index, 0) + 1
+
+def get_stats():
+  """Returns hit, miss and rebuild counters for each index used on this instance."""
+  with singletons_lock:
+    stats = dict(_stats)
+  return {_INDEX_NAMES.get(cache_index, str(cache_index)): index_stats.to_json()
+          for cache_index, index_stats in stats.iteritems()}
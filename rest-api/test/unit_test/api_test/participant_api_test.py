@@ -1,9 +1,12 @@
 import datetime
 import httplib
+import mock
 
 from clock import FakeClock
+from dao.participant_dao import ParticipantDao
 from test.unit_test.unit_test_util import FlaskTestBase
 from participant_enums import WithdrawalStatus, SuspensionStatus
+from sqlalchemy.exc import OperationalError
 
 TIME_1 = datetime.datetime(2018, 1, 1)
 TIME_2 = datetime.datetime(2018, 1, 3)
@@ -71,6 +74,63 @@ class ParticipantApiTest(FlaskTestBase):
 
 
 
+  def test_batch_insert(self):
+    existing = self.send_post('Participant', self.participant_2)
+    bad_provider_link = {'primary': True, 'organization': {'reference': 'Organization/NOPE'}}
+    bundle = {
+      'resourceType': 'Bundle',
+      'type': 'batch',
+      'entry': [
+        {'resource': self.participant},
+        {'resource': self.participant_2},
+        {'resource': {'providerLink': [bad_provider_link]}},
+        {'resource': {'externalId': 678}},
+        {},
+      ]
+    }
+    response = self.send_post('Participant/$batch', bundle)
+    self.assertEquals('batch-response', response['type'])
+    entries = response['entry']
+    self.assertEquals(['200', '200', '400', '200', '400'],
+                      [entry['response']['status'] for entry in entries])
+    # Created participants are returned as by POST Participant, and can be read back.
+    for entry in (entries[0], entries[3]):
+      participant_id = entry['resource']['participantId']
+      self.assertEquals(entry['resource'], self.send_get('Participant/%s' % participant_id))
+    self.assertNotEquals(entries[0]['resource']['participantId'],
+                         entries[3]['resource']['participantId'])
+    # An existing external ID resolves to the existing participant.
+    self.assertEquals(existing, entries[1]['resource'])
+    self.assertIn('NOPE', entries[2]['response']['outcome']['issue'][0]['diagnostics'])
+
+  def test_batch_insert_chunk_fails(self):
+    insert_new = ParticipantDao._insert_new
+    chunk_sizes = []
+    def fail_second_chunk(dao, new, results):
+      chunk_sizes.append(len(new))
+      if len(chunk_sizes) == 2:
+        raise OperationalError('INSERT INTO participant', {}, Exception(2013, 'Lost connection'))
+      return insert_new(dao, new, results)
+    bundle = {
+      'resourceType': 'Bundle',
+      'type': 'batch',
+      'entry': [{'resource': self.participant} for _ in range(5)],
+    }
+    with mock.patch('dao.participant_dao.BATCH_INSERT_CHUNK_SIZE', 2), \
+         mock.patch.object(ParticipantDao, '_insert_new', fail_second_chunk):
+      response = self.send_post('Participant/$batch', bundle)
+    self.assertEquals([2, 2, 1], chunk_sizes)
+    entries = response['entry']
+    self.assertEquals(['200', '200', '500', '500', '200'],
+                      [entry['response']['status'] for entry in entries])
+    # Participants in the chunks that were committed are still returned, and can be read back.
+    for entry in (entries[0], entries[1], entries[4]):
+      participant_id = entry['resource']['participantId']
+      self.assertEquals(entry['resource'], self.send_get('Participant/%s' % participant_id))
+
+  def test_batch_insert_not_a_bundle(self):
+    self.send_post('Participant/$batch', self.participant, expected_status=httplib.BAD_REQUEST)
+
   def test_update_no_ifmatch_specified(self):
     response = self.send_post('Participant', self.participant)
 
@@ -119,6 +179,15 @@ class ParticipantApiTest(FlaskTestBase):
     response['suspensionTime'] = update_response['lastModified']
     self.assertJsonResponseMatches(response, update_response)
 
+  def test_get_if_none_match(self):
+    response = self.send_post('Participant', self.participant)
+    path = 'Participant/%s' % response['participantId']
+    self.send_get(path, headers={'If-None-Match': 'W/"1"'}, expected_status=httplib.NOT_MODIFIED)
+    response['providerLink'] = [self.provider_link_2]
+    self.send_put(path, response, headers={'If-Match': 'W/"1"'})
+    self.send_get(path, headers={'If-None-Match': 'W/"1"'},
+                  expected_response_headers={'ETag': 'W/"2"'})
+
   def test_change_pairing_awardee_and_site(self):
     participant = self.send_post('Participant', self.participant)
     participant['providerLink'] = [ self.provider_link_2]
@@ -1,7 +1,10 @@
 import datetime
 import httplib
+import json
 import threading
 
+import mock
+
 import main
 from clock import FakeClock
 from code_constants import (PPI_SYSTEM, RACE_WHITE_CODE, CONSENT_PERMISSION_YES_CODE,
@@ -9,6 +12,7 @@ from code_constants import (PPI_SYSTEM, RACE_WHITE_CODE, CONSENT_PERMISSION_YES_
                             DVEHRSHARING_CONSENT_CODE_NO, DVEHRSHARING_CONSENT_CODE_NOT_SURE,
                             CONSENT_PERMISSION_NO_CODE)
 from concepts import Concept
+from dao import database_factory
 from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
 from dao.participant_summary_dao import ParticipantSummaryDao
 from model.biobank_stored_sample import BiobankStoredSample
@@ -230,6 +234,18 @@ class ParticipantSummaryApiTest(FlaskTestBase):
       url = 'Participant/%s/QuestionnaireResponse' % participant_id
       return self.send_post(url, request_data=response_data)
 
+  def test_read_replica_routing_by_api(self):
+    participant = self.send_post('Participant', {})
+    participant_id = participant['participantId']
+    self.send_consent(participant_id)
+    with mock.patch('dao.database_factory.read_replica_routing',
+                    wraps=database_factory.read_replica_routing) as mock_routing:
+      # Participant is an UpdatableApi, whose versions must not be stale, so it opts out.
+      self.send_get('Participant/%s' % participant_id)
+      self.assertFalse(mock_routing.called)
+      self.send_get('Participant/%s/Summary' % participant_id)
+      self.assertTrue(mock_routing.called)
+
   def test_pairing_summary(self):
     participant = self.send_post('Participant', {"providerLink": [self.provider_link]})
     participant_id = participant['participantId']
@@ -675,6 +691,110 @@ class ParticipantSummaryApiTest(FlaskTestBase):
     self.assertEqual(response2['total'], response['total'])
     self.assertEqual(response2['total'], num_participants)
 
+  def test_get_summary_list_as_ndjson(self):
+    num_participants = 5
+    participant_ids = []
+    for _ in range(num_participants):
+      participant = self.send_post('Participant', {"providerLink": [self.provider_link]})
+      participant_ids.append(participant['participantId'])
+      with FakeClock(TIME_1):
+        self.send_consent(participant['participantId'])
+
+    response = self._app.get(main.PREFIX + 'ParticipantSummary?_format=ndjson&_count=3')
+    self.assertEquals(httplib.OK, response.status_code, response.data)
+    self.assertTrue(response.headers['Content-Type'].startswith('application/x-ndjson'))
+    lines = [json.loads(line) for line in response.data.splitlines()]
+    self.assertEquals(4, len(lines))
+    self.assertEquals('next', lines[3]['link'][0]['relation'])
+    next_url = lines[3]['link'][0]['url']
+
+    response = self._app.get(main.PREFIX + next_url[next_url.find('ParticipantSummary'):])
+    self.assertEquals(httplib.OK, response.status_code, response.data)
+    next_lines = [json.loads(line) for line in response.data.splitlines()]
+    self.assertEquals(2, len(next_lines))
+    self.assertItemsEqual(participant_ids,
+                          [summary['participantId'] for summary in lines[:3] + next_lines])
+
+    # The page cap is higher for streamed results, but totals aren't supported.
+    self.send_get('ParticipantSummary?_count=20000', expected_status=httplib.BAD_REQUEST)
+    response = self._app.get(main.PREFIX + 'ParticipantSummary?_format=ndjson&_count=20000')
+    self.assertEquals(httplib.OK, response.status_code, response.data)
+    self.assertEquals(num_participants, len(response.data.splitlines()))
+    self.send_get('ParticipantSummary?_format=ndjson&_includeTotal=true',
+                  expected_status=httplib.BAD_REQUEST)
+
+  def test_get_summary_if_none_match(self):
+    participant = self.send_post('Participant', {"providerLink": [self.provider_link]})
+    participant_id = participant['participantId']
+    self.send_consent(participant_id)
+    path = main.PREFIX + 'Participant/%s/Summary' % participant_id
+    response = self._app.get(path)
+    self.assertEquals(httplib.OK, response.status_code, response.data)
+    etag = response.headers['ETag']
+    self.assertFalse(etag.startswith('W/'))
+
+    response = self._app.get(path, headers={'If-None-Match': etag})
+    self.assertEquals(httplib.NOT_MODIFIED, response.status_code)
+    self.assertEquals('', response.data)
+
+    # Any write to the summary changes its ETag.
+    self.send_consent(participant_id)
+    response = self._app.get(path, headers={'If-None-Match': etag})
+    self.assertEquals(httplib.OK, response.status_code, response.data)
+    self.assertNotEquals(etag, response.headers['ETag'])
+
+  def test_get_summary_list_with_elements(self):
+    participant_ids = []
+    for _ in range(3):
+      participant = self.send_post('Participant', {"providerLink": [self.provider_link]})
+      participant_ids.append(participant['participantId'])
+      with FakeClock(TIME_1):
+        self.send_consent(participant['participantId'])
+    full_response = self.send_get('ParticipantSummary?_sort=participantId')
+    elements = ['awardee', 'firstName', 'consentForStudyEnrollment', 'ageRange']
+
+    response = self.send_get('ParticipantSummary?_elements=%s&_sort=participantId&_count=2'
+                             % ','.join(elements))
+    next_url = response['link'][0]['url']
+    next_response = self.send_get(next_url[next_url.find('ParticipantSummary'):])
+    resources = [entry['resource'] for entry in response['entry'] + next_response['entry']]
+    self.assertEquals(sorted(participant_ids),
+                      [resource['participantId'] for resource in resources])
+    for resource, full_entry in zip(resources, full_response['entry']):
+      expected = {key: full_entry['resource'][key] for key in elements + ['participantId']}
+      self.assertEquals(expected, resource)
+
+    self.send_get('ParticipantSummary?_elements=firstName,notAField',
+                  expected_status=httplib.BAD_REQUEST)
+
+  def test_log_position_sync(self):
+    def setup_participants(count):
+      participant_ids = []
+      for _ in range(count):
+        participant = self.send_post('Participant', {"providerLink": [self.provider_link]})
+        participant_ids.append(participant['participantId'])
+        # Every participant is written with the same time; syncs must not rely on it.
+        with FakeClock(TIME_1):
+          self.send_consent(participant['participantId'])
+      return participant_ids
+
+    first_batch = setup_participants(3)
+    response = self.send_get('ParticipantSummary?_sync=true&_count=2&awardee=PITT')
+    self.assertEquals('next', response['link'][0]['relation'])
+    next_url = response['link'][0]['url']
+    next_response = self.send_get(next_url[next_url.find('ParticipantSummary'):])
+    self.assertEquals('sync', next_response['link'][0]['relation'])
+    self.assertEquals(first_batch, [entry['resource']['participantId']
+                                    for entry in response['entry'] + next_response['entry']])
+
+    # Syncing again returns only summaries written since the last sync, with no duplicates.
+    sync_url = next_response['link'][0]['url']
+    sync_url = sync_url[sync_url.find('ParticipantSummary'):]
+    self.assertEquals([], self.send_get(sync_url)['entry'])
+    second_batch = setup_participants(2)
+    self.assertEquals(second_batch, [entry['resource']['participantId']
+                                     for entry in self.send_get(sync_url)['entry']])
+
   def test_get_summary_list_returns_offset_results(self):
     num_participants = 10
     SqlTestBase.setup_codes([PMI_SKIP_CODE], code_type=CodeType.ANSWER)
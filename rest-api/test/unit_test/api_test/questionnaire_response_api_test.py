@@ -51,6 +51,49 @@ class QuestionnaireResponseApiTest(FlaskTestBase):
     resource = gen_response(participant_id, questionnaire_id, string_answers=string_answers)
     self.send_post(url, resource, expected_status=httplib.BAD_REQUEST)
 
+  def test_insert_bundle(self):
+    participant_id = self.create_participant()
+    participant_id_2 = self.create_participant()
+    consent_questionnaire_id = self.create_questionnaire('study_consent.json')
+    questionnaire_id = self.create_questionnaire('questionnaire1.json')
+    consent = gen_response(participant_id, consent_questionnaire_id,
+                           string_answers=[('firstName', 'Alex'), ('lastName', 'Smith'),
+                                           ('email', 'alex@example.com')])
+    answers = [['nameOfChild', 'Cathy Jones']]
+    no_subject = gen_response(participant_id, questionnaire_id, string_answers=answers)
+    del no_subject['subject']
+    # Fails FHIR validation.
+    malformed = gen_response(participant_id, questionnaire_id, string_answers=answers)
+    malformed['group'] = 'not a group'
+    no_questionnaire = gen_response(participant_id, questionnaire_id, string_answers=answers)
+    del no_questionnaire['questionnaire']
+    bundle = {
+      'resourceType': 'Bundle',
+      'type': 'transaction',
+      'entry': [
+        {'resource': consent},
+        {'resource': gen_response(participant_id, questionnaire_id, string_answers=answers)},
+        # The second participant hasn't consented.
+        {'resource': gen_response(participant_id_2, questionnaire_id, string_answers=answers)},
+        {'resource': no_subject},
+        {'resource': malformed},
+        {'resource': no_questionnaire},
+      ]
+    }
+    response = self.send_post('QuestionnaireResponse', bundle)
+    self.assertEquals('transaction-response', response['type'])
+    entries = response['entry']
+    self.assertEquals(['200', '200', '400', '400', '400', '400'],
+                      [entry['response']['status'] for entry in entries])
+    response_id = entries[1]['resource']['id']
+    self.assertEquals(entries[1]['resource'],
+                      self.send_get(_questionnaire_response_url(participant_id) + '/' +
+                                    response_id))
+    summary = self.send_get('Participant/%s/Summary' % participant_id)
+    self.assertEquals('SUBMITTED', summary['consentForStudyEnrollment'])
+    self.assertEquals('Alex', summary['firstName'])
+    self.send_get('Participant/%s/Summary' % participant_id_2, expected_status=httplib.NOT_FOUND)
+
   def test_insert(self):
     participant_id = self.create_participant()
     questionnaire_id = self.create_questionnaire('questionnaire1.json')
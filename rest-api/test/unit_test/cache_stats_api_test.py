@@ -0,0 +1,16 @@
+import httplib
+
+from test.unit_test.unit_test_util import FlaskTestBase
+
+
+class CacheStatsApiTest(FlaskTestBase):
+
+  def test_get_cache_stats(self):
+    self.send_get('Participant/P1', expected_status=httplib.NOT_FOUND)
+    stats = self.send_get('CacheStats')
+    self.assertGreater(stats['mainConfig']['hits'] + stats['mainConfig']['misses'], 0)
+    self.assertEquals(0, stats['mainConfig']['rebuildErrors'])
+
+  def test_get_cache_stats_requires_config_admin(self):
+    self.set_auth_user('not_an_admin@example.com')
+    self.send_get('CacheStats', expected_status=httplib.FORBIDDEN)
@@ -80,3 +80,23 @@ class TestConfig(FlaskTestBase):
   def test_POST_does_not_validate_random_config(self):
     rando_config = {'not_required': 'not a list'}
     self.send_post('Config/rando_config', request_data=rando_config)
+
+  def test_snapshot(self):
+    config.insert_config(config.DNA_SAMPLE_TEST_CODES, ['1ED04', '1SAL'])
+    snapshot = config.get_snapshot()
+    self.assertIs(snapshot, config.get_snapshot())
+    self.assertEquals(('1ED04', '1SAL'), snapshot.dna_sample_test_codes)
+    builds = []
+    builder = lambda s: builds.append(1) or len(s.dna_sample_test_codes)
+    self.assertEquals(2, snapshot.get_derived('count', builder))
+    self.assertEquals(2, snapshot.get_derived('count', builder))
+    self.assertEquals(1, len(builds))
+
+    # Storing the config or overriding a setting replaces the snapshot.
+    config.insert_config(config.DNA_SAMPLE_TEST_CODES, ['1ED04'])
+    new_snapshot = config.get_snapshot()
+    self.assertIsNot(snapshot, new_snapshot)
+    self.assertEquals(('1ED04',), new_snapshot.dna_sample_test_codes)
+    self.assertEquals(('1ED04', '1SAL'), snapshot.dna_sample_test_codes)
+    config.override_setting(config.DNA_SAMPLE_TEST_CODES, ['1SAL'])
+    self.assertEquals(('1SAL',), config.get_snapshot().dna_sample_test_codes)
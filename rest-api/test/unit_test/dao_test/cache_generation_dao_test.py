@@ -0,0 +1,36 @@
+import mock
+
+from dao.cache_generation_dao import CacheGenerationDao
+from unit_test_util import SqlTestBase
+
+
+class CacheGenerationDaoTest(SqlTestBase):
+  def setUp(self):
+    super(CacheGenerationDaoTest, self).setUp()
+    self.dao = CacheGenerationDao()
+
+  def test_increment_once_per_transaction(self):
+    with self.dao.session() as session:
+      self.dao.increment_with_session(session, 'code')
+      self.dao.increment_with_session(session, 'code')
+    self.assertEquals(1, self.dao.get_generation('code'))
+    self.assertEquals(0, self.dao.get_generation('hpo'))
+
+  def test_increment_again_after_rollback(self):
+    session = self.database.make_session()
+    self.dao.increment_with_session(session, 'code')
+    session.rollback()
+    # The retried transaction must increment the generation again.
+    self.dao.increment_with_session(session, 'code')
+    session.commit()
+    self.dao.increment_with_session(session, 'code')
+    session.commit()
+    session.close()
+    self.assertEquals(2, self.dao.get_generation('code'))
+
+  def test_increment_without_row_logs_error(self):
+    with mock.patch('dao.cache_generation_dao.logging') as mock_logging:
+      with self.dao.session() as session:
+        self.dao.increment_with_session(session, 'not_cached')
+    self.assertEquals(1, mock_logging.error.call_count)
+    self.assertEquals(0, self.dao.get_generation('not_cached'))
@@ -2,6 +2,7 @@ import datetime
 
 from clock import FakeClock
 from unit_test_util import SqlTestBase
+from dao.cache_generation_dao import CacheGenerationDao
 from dao.code_dao import CodeDao, CodeBookDao, CodeHistoryDao
 from model.code import Code, CodeBook, CodeHistory, CodeType
 from werkzeug.exceptions import BadRequest
@@ -31,7 +32,7 @@ class CodeDaoTest(SqlTestBase):
       self.code_dao.insert(code)
 
     expected_code = Code(codeId=1, system="a", value="b", display=u"c", topic=u"d",
-                         codeType=CodeType.MODULE, mapped=True, created=TIME)
+                         codeType=CodeType.MODULE, mapped=True, created=TIME, lastModified=TIME)
     self.assertEquals(expected_code.asdict(), self.code_dao.get(1).asdict())
 
     expected_code_history = CodeHistory(codeHistoryId=1, codeId=1, system="a", value="b",
@@ -53,7 +54,8 @@ class CodeDaoTest(SqlTestBase):
       self.code_dao.insert(code_1)
 
     expected_code = Code(codeBookId=1, codeId=1, system="a", value="b", display=u"c", topic=u"d",
-                         codeType=CodeType.MODULE, mapped=True, created=TIME_2)
+                         codeType=CodeType.MODULE, mapped=True, created=TIME_2,
+                         lastModified=TIME_2)
     self.assertEquals(expected_code.asdict(), self.code_dao.get(1).asdict())
 
     expected_code_history = CodeHistory(codeBookId=1, codeHistoryId=1, codeId=1, system="a",
@@ -67,7 +69,8 @@ class CodeDaoTest(SqlTestBase):
       self.code_dao.insert(code_2)
 
     expected_code_2 = Code(codeBookId=1, codeId=2, system="x", value="y", display=u"z", topic=u"q",
-                           codeType=CodeType.QUESTION, mapped=False, created=TIME_3, parentId=1)
+                           codeType=CodeType.QUESTION, mapped=False, created=TIME_3, parentId=1,
+                           lastModified=TIME_3)
     self.assertEquals(expected_code_2.asdict(), self.code_dao.get(2).asdict())
 
   def test_insert_second_codebook_same_system(self):
@@ -159,7 +162,8 @@ class CodeDaoTest(SqlTestBase):
       self.code_dao.update(new_code_1)
 
     expected_code = Code(codeBookId=2, codeId=1, system="x", value="b", display=u"c", topic=u"d",
-                         codeType=CodeType.MODULE, mapped=True, created=TIME_2)
+                         codeType=CodeType.MODULE, mapped=True, created=TIME_2,
+                         lastModified=TIME_4)
     self.assertEquals(expected_code.asdict(), self.code_dao.get(1).asdict())
 
     expected_code_history = CodeHistory(codeBookId=1, codeHistoryId=1, codeId=1, system="a",
@@ -193,7 +197,7 @@ class CodeDaoTest(SqlTestBase):
 
     expectedModule1 = Code(codeBookId=1, codeId=1, system=system, value="m1", shortValue="m1",
                            display=u"d7", topic=u"mt1", codeType=CodeType.MODULE, mapped=True,
-                           created=TIME)
+                           created=TIME, lastModified=TIME)
     self.assertEquals(expectedModule1.asdict(), self.code_dao.get(1).asdict())
 
     expectedModuleHistory1 = CodeHistory(codeHistoryId=1, codeBookId=1, codeId=1, system=system,
@@ -204,19 +208,60 @@ class CodeDaoTest(SqlTestBase):
 
     expectedTopic1 = Code(codeBookId=1, codeId=2, system=system, value="t1", shortValue="t1",
                           display=u"d6", topic=u"t1", codeType=CodeType.TOPIC, mapped=True,
-                          created=TIME, parentId=1)
+                          created=TIME, lastModified=TIME, parentId=1)
     self.assertEquals(expectedTopic1.asdict(), self.code_dao.get(2).asdict())
 
     expectedQuestion1 = Code(codeBookId=1, codeId=3, system=system, value="q1", shortValue="q1",
                              display=u"d4", topic=u"t1", codeType=CodeType.QUESTION, mapped=True,
-                             created=TIME, parentId=2)
+                             created=TIME, lastModified=TIME, parentId=2)
     self.assertEquals(expectedQuestion1.asdict(), self.code_dao.get(3).asdict())
 
     expectedAnswer1 = Code(codeBookId=1, codeId=4, system=system, value="c1", shortValue="c1",
                            display=u"d1", topic=u"t1", codeType=CodeType.ANSWER, mapped=True,
-                           created=TIME, parentId=3)
+                           created=TIME, lastModified=TIME, parentId=3)
     self.assertEquals(expectedAnswer1.asdict(), self.code_dao.get(4).asdict())
 
+  def test_cache_delta_refresh(self):
+    with FakeClock(TIME):
+      self.code_dao.insert(Code(system="a", value="m", display=u"m", topic=u"t",
+                                codeType=CodeType.MODULE, mapped=True))
+      self.code_dao.insert(Code(system="a", value="q", display=u"q", topic=u"t",
+                                codeType=CodeType.QUESTION, mapped=True, parentId=1))
+      # Local writes are visible immediately, and linked to their parents.
+      question = self.code_dao.get_code("a", "q")
+      self.assertEquals(self.code_dao.get(1), question.parent)
+      self.assertEquals([question], self.code_dao.get(1).children)
+
+    # Simulate an update made by another server.
+    with self.code_dao.session() as session:
+      module = session.query(Code).get(1)
+      module.display = u"new m"
+      module.lastModified = TIME_2
+    with FakeClock(TIME + datetime.timedelta(seconds=60)):
+      self.assertEquals(u"m", self.code_dao.get(1).display)
+    with FakeClock(TIME_2):
+      new_module = self.code_dao.get(1)
+      self.assertEquals(u"new m", new_module.display)
+      self.assertEquals(new_module, self.code_dao.get_code("a", "q").parent)
+      self.assertEquals(["q"], [child.value for child in new_module.children])
+
+  def test_cache_refresh_on_generation_change(self):
+    with FakeClock(TIME):
+      self.code_dao.insert(Code(system="a", value="m", display=u"m", topic=u"t",
+                                codeType=CodeType.MODULE, mapped=True))
+      self.assertEquals(u"m", self.code_dao.get(1).display)
+
+    # Simulate an update made by another server, which increments the generation.
+    with self.code_dao.session() as session:
+      module = session.query(Code).get(1)
+      module.display = u"new m"
+      module.lastModified = TIME
+      CacheGenerationDao().increment_with_session(session, 'code')
+    with FakeClock(TIME + datetime.timedelta(seconds=1)):
+      self.assertEquals(u"m", self.code_dao.get(1).display)
+    with FakeClock(TIME + datetime.timedelta(seconds=10)):
+      self.assertEquals(u"new m", self.code_dao.get(1).display)
+
 def _make_concept(concept_topic, concept_type, code, display, child_concepts=None):
   concept = { 'property': [{ 'code': 'concept-topic', 'valueCode': concept_topic },
                            { 'code': 'concept-type', 'valueCode': concept_type } ],
@@ -0,0 +1,65 @@
+import datetime
+
+import config
+from clock import FakeClock
+from dao import id_reservation_dao
+from dao.id_reservation_dao import IdReservationDao
+from dao.participant_dao import ParticipantDao
+from model.participant import Participant
+from unit_test_util import SqlTestBase, random_ids
+
+TIME_1 = datetime.datetime(2018, 12, 1)
+
+
+class IdReservationDaoTest(SqlTestBase):
+  def setUp(self):
+    super(IdReservationDaoTest, self).setUp()
+    self.dao = IdReservationDao()
+    self.participant_dao = ParticipantDao()
+    with random_ids([1, 2]):
+      self.participant_dao.insert(Participant())
+
+  def test_get_id_space(self):
+    self.assertEquals('participant.participant_id',
+                      id_reservation_dao.get_id_space(Participant, 'participantId'))
+
+  def test_reserve_ids_skips_used_and_reserved_ids(self):
+    # 1 is already a participant ID.
+    with random_ids([1, 3, 4]):
+      self.assertEquals([3, 4],
+                        sorted(self.dao.reserve_ids(Participant, 'participantId', 2)))
+    # 3 is already reserved.
+    with random_ids([3, 5]):
+      self.assertEquals([5], self.dao.reserve_ids(Participant, 'participantId', 1))
+    # Biobank IDs are a separate space.
+    with random_ids([3]):
+      self.assertEquals([3], self.dao.reserve_ids(Participant, 'biobankId', 1))
+
+  def test_insert_with_reserved_ids(self):
+    config.override_setting(config.RANDOM_ID_POOL_SIZE, [4])
+    self.addCleanup(config.override_setting, config.RANDOM_ID_POOL_SIZE, None)
+    # The first insert fills the empty pools, and takes its IDs from them.
+    first = self.participant_dao.insert(Participant())
+    reserved_ids = {reservation.reservedId
+                    for reservation in self.dao.get_all()
+                    if reservation.idSpace == 'participant.participant_id'}
+    self.assertIn(first.participantId, reserved_ids)
+    self.assertEquals(4, len(reserved_ids))
+    # Later inserts use the pool, until fewer than half are left.
+    second = self.participant_dao.insert(Participant())
+    self.assertIn(second.participantId, reserved_ids - {first.participantId})
+    self.assertEquals(4, len([reservation for reservation in self.dao.get_all()
+                              if reservation.idSpace == 'participant.participant_id']))
+
+  def test_reserve_ids_deletes_expired_reservations(self):
+    with FakeClock(TIME_1):
+      with random_ids([3, 4]):
+        self.dao.reserve_ids(Participant, 'participantId', 1)
+        self.dao.reserve_ids(Participant, 'biobankId', 1)
+    with FakeClock(TIME_1 + id_reservation_dao.RESERVATION_EXPIRY + datetime.timedelta(seconds=1)):
+      with random_ids([5]):
+        self.dao.reserve_ids(Participant, 'participantId', 1)
+    # Only the expired reservation in the same ID space is deleted.
+    self.assertEquals([('participant.biobank_id', 4), ('participant.participant_id', 5)],
+                      sorted((reservation.idSpace, reservation.reservedId)
+                             for reservation in self.dao.get_all()))
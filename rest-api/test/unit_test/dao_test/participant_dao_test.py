@@ -1,5 +1,6 @@
 import datetime
 
+from dao import request_scope
 from dao.base_dao import MAX_INSERT_ATTEMPTS
 from dao.hpo_dao import HPODao
 from dao.participant_dao import ParticipantDao, ParticipantHistoryDao
@@ -50,6 +51,33 @@ class ParticipantDaoTest(SqlTestBase):
         participantId=1, biobankId=2, lastModified=time, signUpTime=time)
     self.assertEquals(expected_ph.asdict(), ph.asdict())
 
+  def test_insert_rolled_back_adds_no_history(self):
+    with self.assertRaises(ValueError):
+      with self.dao.session() as session:
+        self.dao.insert_with_session(session, Participant(participantId=1, biobankId=2))
+        raise ValueError('Roll back')
+    self.assertIsNone(self.participant_history_dao.get([1, 1]))
+    # Nothing is left queued for the next insert.
+    with random_ids([3, 4]):
+      self.dao.insert(Participant())
+    self.assertIsNone(self.participant_history_dao.get([1, 1]))
+    self.assertIsNotNone(self.participant_history_dao.get([3, 1]))
+
+  def test_get_for_update_reuses_locked_participant(self):
+    with random_ids([1, 2]):
+      self.dao.insert(Participant())
+    request_scope.start_request()
+    try:
+      with self.dao.session() as session:
+        participant = self.dao.get_for_update(session, 1)
+        self.assertIs(participant, self.dao.get_for_update(session, 1))
+        self.assertIsNone(self.dao.get_for_update(session, 2))
+      with self.dao.session() as session:
+        self.assertIsNot(participant, self.dao.get_for_update(session, 1))
+    finally:
+      saved_queries = request_scope.end_request('test')
+    self.assertEquals({'participant': 1}, dict(saved_queries))
+
   def test_insert_with_external_id(self):
     p = Participant(externalId=3)
     time = datetime.datetime(2016, 1, 1)
@@ -170,8 +198,8 @@ class ParticipantDaoTest(SqlTestBase):
     ps = self.participant_summary_dao.get(1)
     expected_ps = self._participant_summary_with_defaults(
         participantId=1, biobankId=2, signUpTime=time, hpoId=PITT_HPO_ID,
-        lastModified=time2, firstName=summary.firstName, lastName=summary.lastName,
-      email=summary.email)
+        lastModified=time2, logPositionId=1, firstName=summary.firstName,
+        lastName=summary.lastName, email=summary.email)
     self.assertEquals(expected_ps.asdict(), ps.asdict())
 
     p2_last_modified = p2.lastModified
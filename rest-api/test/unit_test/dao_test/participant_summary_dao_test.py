@@ -3,16 +3,25 @@ import json
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 import time
 import config
+import mock
+from clock import FakeClock
+import singletons
+from dao import base_dao
+from dao import database_factory
 from dao.base_dao import json_serial
 from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.database_utils import insert_log_position
 from dao.participant_dao import ParticipantDao
 from dao.participant_summary_dao import ParticipantSummaryDao
 from model.biobank_stored_sample import BiobankStoredSample
+from model.log_position import LogPosition
 from model.participant import Participant
 from model.participant_summary import ParticipantSummary
 from participant_enums import EnrollmentStatus, PhysicalMeasurementsStatus, SampleStatus, \
-  QuestionnaireStatus
+  QuestionnaireStatus, WithdrawalStatus, SuspensionStatus, WithdrawalReason, UNSET_HPO_ID
 from query import Query, Operator, FieldFilter, OrderBy
+from sqlalchemy.dialects import mysql
+from sqlalchemy.exc import OperationalError
 from unit_test_util import NdbTestBase, PITT_HPO_ID
 
 
@@ -59,6 +68,77 @@ class ParticipantSummaryDaoTest(NdbTestBase):
     results = self.dao.query(query)
     self.assertEqual(results.total, num_participants)
 
+  def test_query_total_is_cached(self):
+    query = Query([], None, 1, None, include_total=True)
+    for i in range(3):
+      self._insert(Participant(participantId=i, biobankId=i))
+    results = self.dao.query(query)
+    self.assertEqual(3, results.total)
+    # Later pages reuse the total rather than counting again.
+    next_page_query = Query([], None, 1, results.pagination_token, include_total=True)
+    with mock.patch.object(ParticipantSummaryDao, '_compute_total') as mock_compute_total:
+      self.assertEqual(3, self.dao.query(next_page_query).total)
+      self.assertFalse(mock_compute_total.called)
+    # Writing a participant summary invalidates cached totals.
+    self._insert(Participant(participantId=3, biobankId=3))
+    self.assertEqual(4, self.dao.query(query).total)
+    # Deleting one does too.
+    with self.dao.session() as session:
+      session.execute('DELETE FROM participant_summary WHERE participant_id IN (0, 1)')
+    self.assertEqual(2, self.dao.query(query).total)
+    # Estimated totals fall back to an exact count when they are small.
+    query.estimate_total = True
+    self.assertEqual(2, self.dao.query(query).total)
+
+  def test_query_total_invalidated_by_late_commit_of_lower_log_position(self):
+    query = Query([FieldFilter('hpoId', Operator.EQUALS, UNSET_HPO_ID)], None, 1, None,
+                  include_total=True)
+    self._insert(Participant(participantId=1, biobankId=1))
+    self._insert(Participant(participantId=2, biobankId=2))
+    # A long transaction allocates a log position for participant 1's summary when it flushes...
+    with self.dao.session() as session:
+      late_position_id = insert_log_position(session)
+    # ...then another transaction writes participant 2's summary with a higher position and commits.
+    with self.dao.session() as session:
+      session.query(ParticipantSummary).get(2).logPosition = LogPosition()
+    self.assertEqual(2, self.dao.query(query).total)
+
+    # The first transaction commits, pairing participant 1 with an HPO. The highest log position
+    # doesn't change, but the cached total must not be reused.
+    with self.dao.session() as session:
+      summary = session.query(ParticipantSummary).get(1)
+      summary.logPositionId = late_position_id
+      summary.hpoId = PITT_HPO_ID
+    self.assertEqual(1, self.dao.query(query).total)
+
+  def test_query_total_not_cached_without_high_water_mark(self):
+    query = Query([], None, 1, None, include_total=True)
+    for i in range(3):
+      self._insert(Participant(participantId=i, biobankId=i))
+    with mock.patch.object(ParticipantSummaryDao, '_get_write_high_water_mark',
+                           return_value=None):
+      self.assertEqual(3, self.dao.query(query).total)
+      with self.dao.session() as session:
+        session.execute('DELETE FROM participant_summary WHERE participant_id IN (0, 1)')
+      self.assertEqual(1, self.dao.query(query).total)
+
+  def test_query_total_cache_key_includes_withdrawal_cutoff(self):
+    withdrawal_time = datetime.datetime(2018, 3, 8, 23, 59)
+    self._insert(Participant(participantId=1, biobankId=1), first_name='Bob')
+    # Withdraw without a new log position, so that cached totals aren't invalidated by the write.
+    with self.dao.session() as session:
+      session.execute('UPDATE participant_summary SET withdrawal_status = :status, '
+                      'withdrawal_time = :time WHERE participant_id = 1',
+                      {'status': int(WithdrawalStatus.NO_USE), 'time': withdrawal_time})
+    # Filtering on a field that's cleared for withdrawn participants hides those who withdrew
+    # before the visibility cutoff, which moves past the withdrawal here (well within the TTL).
+    query = Query([FieldFilter('firstName', Operator.EQUALS, 'Bob')], None, 1, None,
+                  include_total=True)
+    with FakeClock(datetime.datetime(2018, 3, 10, 23, 58)):
+      self.assertEqual(1, self.dao.query(query).total)
+    with FakeClock(datetime.datetime(2018, 3, 11, 0, 1)):
+      self.assertEqual(0, self.dao.query(query).total)
+
   def testQuery_noSummaries(self):
     self.assert_no_results(self.no_filter_query)
     self.assert_no_results(self.one_filter_query)
@@ -97,6 +177,22 @@ class ParticipantSummaryDaoTest(NdbTestBase):
     fetched_summary = self.dao.get(participant.participantId)
     self.assertEquals(name, fetched_summary.firstName)
 
+  def test_to_client_json_from_row(self):
+    self._insert(Participant(participantId=1, biobankId=2), 'Alice', 'Smith')
+    participant = self._insert(Participant(participantId=2, biobankId=3), 'Bob', 'Jones')
+    participant.withdrawalStatus = WithdrawalStatus.NO_USE
+    participant.suspensionStatus = SuspensionStatus.NO_CONTACT
+    participant.withdrawalReason = WithdrawalReason.TEST
+    participant.withdrawalReasonJustification = 'test account'
+    self.participant_dao.update(participant)
+    for participant_id in (1, 2):
+      summary = self.dao.get(participant_id)
+      with self.dao.session() as session:
+        row = (session.query(*ParticipantSummaryDao.get_client_json_fields())
+               .filter(ParticipantSummary.participantId == participant_id)
+               .one())
+      self.assertEquals(self.dao.to_client_json(summary), self.dao.to_client_json_from_row(row))
+
   def testQuery_twoSummaries(self):
     participant_1 = Participant(participantId=1, biobankId=2)
     self._insert(participant_1, 'Alice', 'Smith')
@@ -374,6 +470,107 @@ class ParticipantSummaryDaoTest(NdbTestBase):
     self.assertEquals(EnrollmentStatus.MEMBER, summary.enrollmentStatus)
     self.assertEquals(ehr_consent_time, summary.enrollmentStatusMemberTime)
 
+  def test_read_replica_routing(self):
+    config.override_setting(config.READ_REPLICA_MAX_STALENESS_SECONDS, [30])
+    self._insert(Participant(participantId=1, biobankId=2))
+    replica = mock.MagicMock()
+    replica_session = replica.session.return_value.__enter__.return_value
+    replica_result = replica_session.query.return_value.get.return_value
+
+    def get_with_replica(replica_status):
+      singletons.invalidate(singletons.READ_REPLICA_STATUS_INDEX)
+      if isinstance(replica_status, Exception):
+        replica_session.execute.side_effect = replica_status
+      else:
+        replica_session.execute.side_effect = None
+        replica_session.execute.return_value.first.return_value = replica_status
+      # SQLite never routes to a replica, so pretend to be on MySQL.
+      with mock.patch('dao.database_factory.get_db_connection_string',
+                      return_value='mysql+mysqldb://rdr@localhost/rdr'), \
+           mock.patch('dao.database_factory.get_backup_database', return_value=replica):
+        with database_factory.read_replica_routing():
+          self.assertTrue(database_factory.is_read_replica_routing())
+          return self.dao.get(1)
+
+    # Outside of read-only requests, reads go to the primary.
+    self.assertFalse(database_factory.is_read_replica_routing())
+    self.assertEquals(1, self.dao.get(1).participantId)
+    # A replica within the staleness bound serves reads.
+    self.assertIs(replica_result, get_with_replica({'Seconds_Behind_Master': 5}))
+    # A stale, stopped or unreachable replica falls back to the primary.
+    self.assertEquals(1, get_with_replica({'Seconds_Behind_Master': 31}).participantId)
+    self.assertEquals(1, get_with_replica({'Seconds_Behind_Master': None}).participantId)
+    self.assertEquals(1, get_with_replica(OperationalError('SHOW SLAVE STATUS', {},
+                                                           Exception('Unavailable')))
+                      .participantId)
+    self.assertFalse(database_factory.is_read_replica_routing())
+
+  def test_sync_holds_back_log_positions_until_earlier_ones_commit(self):
+    def sync(token, now):
+      with FakeClock(now):
+        results = self.dao.query(Query([FieldFilter('hpoId', Operator.EQUALS, UNSET_HPO_ID)],
+                                       OrderBy('logPositionId', True), 10, token,
+                                       always_return_token=True))
+      return [summary.participantId for summary in results.items], results.pagination_token
+
+    start = datetime.datetime(2018, 12, 1)
+    with FakeClock(start):
+      self._insert(Participant(participantId=1, biobankId=1))
+      self._insert(Participant(participantId=2, biobankId=2))
+    participant_ids, token = sync(None, start + datetime.timedelta(minutes=5))
+    self.assertEquals([1, 2], participant_ids)
+
+    # A long transaction allocates a log position for participant 1's summary when it flushes...
+    write_time = start + datetime.timedelta(hours=1)
+    with FakeClock(write_time):
+      with self.dao.session() as session:
+        late_position_id = insert_log_position(session)
+    # ...then another transaction writes participant 2's summary with a higher position and commits.
+    with FakeClock(write_time + datetime.timedelta(seconds=1)):
+      with self.dao.session() as session:
+        session.query(ParticipantSummary).get(2).logPosition = LogPosition()
+    # Syncing now must not move the token past the uncommitted lower position.
+    self.assertEquals(([], None), sync(token, write_time + datetime.timedelta(seconds=10)))
+
+    # The first transaction commits, after the higher position.
+    with self.dao.session() as session:
+      session.query(ParticipantSummary).get(1).logPositionId = late_position_id
+    holdback = datetime.timedelta(seconds=config.LOG_POSITION_SYNC_HOLDBACK_SECONDS)
+    participant_ids, _ = sync(token, write_time + holdback + datetime.timedelta(seconds=2))
+    self.assertEquals([1, 2], participant_ids)
+
+  def test_order_by_index_warning(self):
+    base_dao._checked_order_by_indexes.clear()
+    with mock.patch('dao.base_dao.logging') as mock_logging:
+      # participant_summary_hpo_log_position covers (hpoId, logPositionId, participantId).
+      self.dao.query(Query([FieldFilter('hpoId', Operator.EQUALS, PITT_HPO_ID)],
+                           OrderBy('logPositionId', True), 2, None))
+      self.assertFalse(mock_logging.warning.called)
+      self.dao.query(self.first_name_order_query)
+      self.assertEquals(1, mock_logging.warning.call_count)
+      # Each sort order is only checked once.
+      self.dao.query(self.first_name_order_query)
+      self.assertEquals(1, mock_logging.warning.call_count)
+
+  def test_row_value_pagination_filter_compiles_for_mysql(self):
+    fields = [ParticipantSummary.lastName, ParticipantSummary.participantId]
+    ascending = base_dao._make_row_value_pagination_filter(fields, ['Smith', 5], False)
+    compiled = ascending.compile(dialect=mysql.dialect())
+    self.assertEquals(
+        '(participant_summary.last_name, participant_summary.participant_id) > (%s, %s)',
+        str(compiled))
+    self.assertEquals(set(['Smith', 5]), set(compiled.params.values()))
+
+    # A descending first field can't use a single row value comparison, so only the
+    # remaining ascending fields are compared as a row.
+    mixed = base_dao._make_row_value_pagination_filter(fields, ['Smith', 5], True)
+    sql = str(mixed.compile(dialect=mysql.dialect()))
+    self.assertIn('participant_summary.last_name < %s', sql)
+    self.assertIn('participant_summary.last_name IS NULL', sql)
+    self.assertIn('participant_summary.last_name = %s', sql)
+    self.assertIn('(participant_summary.participant_id) > (%s)', sql)
+    self.assertNotIn('(participant_summary.last_name, ', sql)
+
 
 def _with_token(query, token):
   return Query(query.field_filters, query.order_by, query.max_results, token)
@@ -84,7 +84,7 @@ class PhysicalMeasurementsDaoTest(SqlTestBase):
         created=TIME_2,
         finalized=TIME_1,
         final=True,
-        logPositionId=1,
+        logPositionId=3,
         createdSiteId=1,
         finalizedSiteId=2)
     self.assertEquals(expected_measurements.asdict(), measurements.asdict())
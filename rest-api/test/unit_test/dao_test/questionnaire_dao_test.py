@@ -88,6 +88,38 @@ class QuestionnaireDaoTest(SqlTestBase):
     self.assertEquals(EXPECTED_QUESTION_1.asdict(), self.questionnaire_question_dao.get(1).asdict())
     self.assertEquals(EXPECTED_QUESTION_2.asdict(), self.questionnaire_question_dao.get(2).asdict())
 
+  def test_get_version(self):
+    self.assertIsNone(self.questionnaire_history_dao.get_version(1, 1))
+    q = Questionnaire(resource=RESOURCE_1)
+    q.concepts.append(self.CONCEPT_1)
+    q.concepts.append(self.CONCEPT_2)
+    q.questions.append(self.QUESTION_1)
+    q.questions.append(self.QUESTION_2)
+    with FakeClock(TIME):
+      self.dao.insert(q)
+
+    questionnaire_version = self.questionnaire_history_dao.get_version(1, 1)
+    self.assertEquals((1, 1), (questionnaire_version.questionnaireId,
+                               questionnaire_version.version))
+    self.assertEquals(EXPECTED_QUESTION_2.asdict(),
+                      questionnaire_version.link_id_to_question['d'].asdict())
+    self.assertEquals({1: 4, 2: 5}, questionnaire_version.question_id_to_code_id)
+    self.assertEquals([1, 2], sorted(questionnaire_version.concept_code_ids))
+    # Versions are cached once loaded.
+    self.assertIs(questionnaire_version, self.questionnaire_history_dao.get_version(1, 1))
+
+  def test_load_current_versions(self):
+    self.assertEquals(0, self.questionnaire_history_dao.load_current_versions())
+    q = Questionnaire(resource=RESOURCE_1)
+    q.questions.append(self.QUESTION_1)
+    with FakeClock(TIME):
+      self.dao.insert(q)
+
+    self.assertEquals(1, self.questionnaire_history_dao.load_current_versions())
+    questionnaire_version = self.questionnaire_history_dao.get_version(1, 1)
+    self.assertEquals(EXPECTED_QUESTION_1.asdict(),
+                      questionnaire_version.link_id_to_question['a'].asdict())
+
   def test_insert(self):
     q = Questionnaire(resource=RESOURCE_1)
     q.concepts.append(self.CONCEPT_1)
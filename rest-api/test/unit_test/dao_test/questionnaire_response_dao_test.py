@@ -1,21 +1,26 @@
 import datetime
 import json
 import mock
+import os
+import shutil
+import tempfile
 
 from testlib import testutil
 from cloudstorage import cloudstorage_api  # stubbed by testbed
+from google.appengine.ext import deferred
 
 from code_constants import (
   PPI_SYSTEM, GENDER_IDENTITY_QUESTION_CODE, THE_BASICS_PPI_MODULE, PMI_SKIP_CODE,
 )
 
+import cloud_storage_files
 import config
 from dao.code_dao import CodeDao
 from dao.participant_dao import ParticipantDao
 from dao.participant_summary_dao import ParticipantSummaryDao
 from dao.questionnaire_dao import QuestionnaireDao
 from dao.questionnaire_response_dao import QuestionnaireResponseDao, QuestionnaireResponseAnswerDao
-from dao.questionnaire_response_dao import _raise_if_gcloud_file_missing
+from dao.questionnaire_response_dao import _raise_if_gcloud_file_missing, _validate_consent_pdfs
 from model.code import Code, CodeType
 from model.participant import Participant
 from model.questionnaire import Questionnaire, QuestionnaireQuestion, QuestionnaireConcept
@@ -24,10 +29,10 @@ from participant_enums import QuestionnaireStatus, WithdrawalStatus
 import test_data
 from test_data import consent_code, first_name_code, last_name_code, email_code, \
   login_phone_number_code
-from unit_test_util import FlaskTestBase, make_questionnaire_response_json
+from unit_test_util import FlaskTestBase, NdbTestBase, make_questionnaire_response_json, random_ids
 from clock import FakeClock
-from werkzeug.exceptions import BadRequest, Forbidden
-from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import BadRequest, Forbidden, InternalServerError
+from sqlalchemy.exc import IntegrityError, OperationalError
 
 TIME = datetime.datetime(2016, 1, 1)
 TIME_2 = datetime.datetime(2016, 1, 2)
@@ -42,6 +47,8 @@ QUESTIONNAIRE_RESPONSE_RESOURCE_2 = '{"resourceType": "QuestionnaireResponse", "
 QUESTIONNAIRE_RESPONSE_RESOURCE_3 = '{"resourceType": "QuestionnaireResponse", "a": "d"}'
 
 _FAKE_BUCKET = 'ptc-uploads-unit-testing'
+_SIGNED_CONSENT_EXTENSION = (
+    'http://terminology.pmi-ops.org/StructureDefinition/consent-form-signed-pdf')
 
 
 def with_id(resource, id_):
@@ -147,6 +154,12 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
   def _names_and_email_answers(self):
     return [self.FN_ANSWER, self.LN_ANSWER, self.EMAIL_ANSWER]
 
+  def _new_names_and_email_answers(self):
+    """Returns new answers (without IDs) with the names and email, for responses after the first."""
+    return [QuestionnaireResponseAnswer(questionId=3, valueString=self.first_name),
+            QuestionnaireResponseAnswer(questionId=4, valueString=self.last_name),
+            QuestionnaireResponseAnswer(questionId=5, valueString=self.email)]
+
   def _names_and_login_phone_number_answers(self):
     return [self.FN_ANSWER, self.LN_ANSWER, self.LOGIN_PHONE_NUMBER_ANSWER]
 
@@ -422,7 +435,7 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
       consentForStudyEnrollment=QuestionnaireStatus.SUBMITTED,
       consentForStudyEnrollmentTime=TIME_2,
       firstName=self.first_name, lastName=self.last_name, email=self.email,
-      lastModified=TIME_2,
+      logPositionId=1, lastModified=TIME_2,
     )
     self.assertEquals(expected_ps.asdict(), self.participant_summary_dao.get(1).asdict())
 
@@ -506,10 +519,70 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
         questionnaireOnTheBasicsTime=TIME_2,
         consentForStudyEnrollment=QuestionnaireStatus.SUBMITTED,
         consentForStudyEnrollmentTime=TIME_2,
-        lastModified=TIME_2,
+        logPositionId=1, lastModified=TIME_2,
         firstName=self.first_name, lastName=self.last_name, email=self.email)
     self.assertEquals(expected_ps.asdict(), self.participant_summary_dao.get(1).asdict())
 
+  def test_insert_bundle_retries_one_at_a_time_after_integrity_error(self):
+    self.insert_codes()
+    with FakeClock(TIME):
+      self.participant_dao.insert(Participant(participantId=1, biobankId=2))
+    self._setup_questionnaire()
+    qr = QuestionnaireResponse(questionnaireResponseId=1, questionnaireId=1, questionnaireVersion=1,
+                               participantId=1, resource=QUESTIONNAIRE_RESPONSE_RESOURCE)
+    qr.answers.extend(self._names_and_email_answers())
+    with FakeClock(TIME_2):
+      self.questionnaire_response_dao.insert(qr)
+
+    bundle = []
+    for _ in range(2):
+      bundle_qr = QuestionnaireResponse(questionnaireId=1, questionnaireVersion=1, participantId=1,
+                                        resource=QUESTIONNAIRE_RESPONSE_RESOURCE)
+      bundle_qr.answers.append(QuestionnaireResponseAnswer(questionId=3,
+                                                           valueString=self.first_name))
+      bundle.append(bundle_qr)
+    # The first reserved ID is already taken, so the participant's transaction fails on insert.
+    with mock.patch('dao.questionnaire_response_dao.IdReservationDao.reserve_ids',
+                    return_value=[1, 2]):
+      with random_ids([3, 4]):
+        with FakeClock(TIME_3):
+          results = self.questionnaire_response_dao.insert_bundle(bundle)
+    self.assertEquals([3, 4], [result.questionnaireResponseId for result in results])
+    for response_id in (3, 4):
+      answers = self.questionnaire_response_dao.get_with_children(response_id).answers
+      self.assertEquals([response_id], [answer.questionnaireResponseId for answer in answers])
+    self.assertEquals(2, len({answer.questionnaireResponseAnswerId
+                              for result in results for answer in result.answers}))
+
+  def test_insert_bundle_reports_database_errors_per_participant(self):
+    self.insert_codes()
+    with FakeClock(TIME):
+      for participant_id in (1, 2):
+        self.participant_dao.insert(Participant(participantId=participant_id,
+                                                biobankId=participant_id + 1))
+    self._setup_questionnaire()
+    bundle = []
+    for participant_id in (1, 2):
+      bundle_qr = QuestionnaireResponse(questionnaireId=1, questionnaireVersion=1,
+                                        participantId=participant_id,
+                                        resource=QUESTIONNAIRE_RESPONSE_RESOURCE)
+      bundle_qr.answers.extend(self._new_names_and_email_answers())
+      bundle.append(bundle_qr)
+    insert_participant_responses = QuestionnaireResponseDao._insert_participant_responses
+    def fail_for_participant_2(dao, participant_id, entries, results):
+      insert_participant_responses(dao, participant_id, entries, results)
+      if participant_id == 2:
+        # Fail as though the participant's transaction had hit a deadlock.
+        raise OperationalError('INSERT INTO questionnaire_response', {},
+                               Exception(1213, 'Deadlock found'))
+    with mock.patch.object(QuestionnaireResponseDao, '_insert_participant_responses',
+                           fail_for_participant_2):
+      with FakeClock(TIME_2):
+        results = self.questionnaire_response_dao.insert_bundle(bundle)
+    self.assertIsInstance(results[0], QuestionnaireResponse)
+    self.assertIsNotNone(self.questionnaire_response_dao.get(results[0].questionnaireResponseId))
+    self.assertIsInstance(results[1], InternalServerError)
+
   def test_insert_qr_three_times(self):
     """Adds three questionnaire responses for the same participant.
 
@@ -555,7 +628,7 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
         questionnaireOnTheBasicsTime=TIME_2,
         consentForStudyEnrollment=QuestionnaireStatus.SUBMITTED,
         consentForStudyEnrollmentTime=TIME_2,
-        lastModified=TIME_2,
+        logPositionId=1, lastModified=TIME_2,
         firstName=self.first_name, lastName=self.last_name, email=self.email)
     self.assertEquals(expected_ps.asdict(), self.participant_summary_dao.get(1).asdict())
 
@@ -596,7 +669,7 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
         numCompletedBaselinePPIModules=1, numCompletedPPIModules=1,
         questionnaireOnTheBasics=QuestionnaireStatus.SUBMITTED,
         questionnaireOnTheBasicsTime=TIME_2,
-        lastModified=TIME_3,
+        logPositionId=2, lastModified=TIME_3,
         consentForStudyEnrollment=QuestionnaireStatus.SUBMITTED,
         consentForStudyEnrollmentTime=TIME_2,
         firstName=self.first_name, lastName=self.last_name, email=self.email)
@@ -638,12 +711,80 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
         questionnaireOnTheBasicsTime=TIME_2,
         consentForStudyEnrollment=QuestionnaireStatus.SUBMITTED,
         consentForStudyEnrollmentTime=TIME_2,
-        lastModified=TIME_4,
+        logPositionId=3, lastModified=TIME_4,
         firstName=self.first_name, lastName=self.last_name, email=self.email)
     # The participant summary should be updated with the new gender identity, but nothing else
     # changes.
     self.assertEquals(expected_ps3.asdict(), self.participant_summary_dao.get(1).asdict())
 
+    # Only the latest answer to questions with the shared concept is current.
+    with self.questionnaire_response_dao.session() as session:
+      current_answers = QuestionnaireResponseAnswerDao().get_current_answers_for_concepts(
+          session, 1, [1, 2])
+      self.assertEquals([2, 7], sorted(answer.questionnaireResponseAnswerId
+                                       for answer in current_answers))
+
+  def _get_current_answer_ids(self, code_id):
+    with self.questionnaire_response_dao.session() as session:
+      return sorted(answer.questionnaireResponseAnswerId for answer in
+                    QuestionnaireResponseAnswerDao().get_current_answers_for_concepts(
+                        session, 1, [code_id]))
+
+  def test_insert_qr_supersedes_all_answers_to_repeated_question(self):
+    self.insert_codes()
+    with FakeClock(TIME):
+      self.participant_dao.insert(Participant(participantId=1, biobankId=2))
+    self._setup_questionnaire()
+    # Question 2 (with code 2) repeats, so both answers to it are current.
+    qr = QuestionnaireResponse(questionnaireResponseId=1, questionnaireId=1, questionnaireVersion=1,
+                               participantId=1, resource=QUESTIONNAIRE_RESPONSE_RESOURCE)
+    for answer_id, value_code_id in ((11, 3), (12, 4)):
+      qr.answers.append(QuestionnaireResponseAnswer(questionnaireResponseAnswerId=answer_id,
+                                                    questionnaireResponseId=1, questionId=2,
+                                                    valueSystem='c', valueCodeId=value_code_id))
+    qr.answers.extend(self._names_and_email_answers())
+    with FakeClock(TIME_2):
+      self.questionnaire_response_dao.insert(qr)
+    self.assertEquals([11, 12], self._get_current_answer_ids(2))
+
+    qr2 = QuestionnaireResponse(questionnaireResponseId=2, questionnaireId=1,
+                                questionnaireVersion=1, participantId=1,
+                                resource=QUESTIONNAIRE_RESPONSE_RESOURCE)
+    qr2.answers.append(QuestionnaireResponseAnswer(questionnaireResponseAnswerId=13,
+                                                   questionnaireResponseId=2, questionId=2,
+                                                   valueSystem='c', valueCodeId=4))
+    with FakeClock(TIME_3):
+      self.questionnaire_response_dao.insert(qr2)
+    self.assertEquals([13], self._get_current_answer_ids(2))
+    for answer_id in (11, 12):
+      self.assertEquals(TIME_3, self.questionnaire_response_answer_dao.get(answer_id).endTime)
+    self.assertIsNone(self.questionnaire_response_answer_dao.get(13).endTime)
+
+  def test_insert_bundle_responses_supersede_each_other(self):
+    self.insert_codes()
+    with FakeClock(TIME):
+      self.participant_dao.insert(Participant(participantId=1, biobankId=2))
+    self._setup_questionnaire()
+    bundle = []
+    for value_code_id in (3, 4):
+      bundle_qr = QuestionnaireResponse(questionnaireId=1, questionnaireVersion=1, participantId=1,
+                                        resource=QUESTIONNAIRE_RESPONSE_RESOURCE)
+      bundle_qr.answers.append(QuestionnaireResponseAnswer(questionId=1, valueSystem='a',
+                                                           valueCodeId=value_code_id))
+      bundle_qr.answers.extend(self._new_names_and_email_answers())
+      bundle.append(bundle_qr)
+    with FakeClock(TIME_2):
+      first, second = self.questionnaire_response_dao.insert_bundle(bundle)
+    first_answer_id = first.answers[0].questionnaireResponseAnswerId
+    second_answer_id = second.answers[0].questionnaireResponseAnswerId
+    # The second response supersedes the first's answers, in the same transaction.
+    self.assertEquals([second_answer_id], self._get_current_answer_ids(1))
+    self.assertEquals(TIME_2,
+                      self.questionnaire_response_answer_dao.get(first_answer_id).endTime)
+    self.assertIsNone(self.questionnaire_response_answer_dao.get(second_answer_id).endTime)
+    # The first response's answers in memory are updated too.
+    self.assertEquals(TIME_2, first.answers[0].endTime)
+
   def _get_questionnaire_response_with_consents(self, *consent_paths):
     self.insert_codes()
     questionnaire = self._setup_questionnaire()
@@ -691,6 +832,79 @@ class QuestionnaireResponseDaoTest(FlaskTestBase):
     self.assertEquals(mock_gcloud_check.call_count, 2)
 
 
+class QuestionnaireResponseDaoConsentPdfTest(NdbTestBase):
+  def setUp(self):
+    super(QuestionnaireResponseDaoConsentPdfTest, self).setUp()
+    config.override_setting(config.CONSENT_PDF_BUCKET, [_FAKE_BUCKET])
+    local_dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, local_dir)
+    self.files = cloud_storage_files.LocalFiles(local_dir)
+    previous_files = cloud_storage_files.set_files(self.files)
+    self.addCleanup(cloud_storage_files.set_files, previous_files)
+
+  def _write_pdf(self, path):
+    local_path = self.files.get_local_path('/%s%s' % (_FAKE_BUCKET, path))
+    if not os.path.isdir(os.path.dirname(local_path)):
+      os.makedirs(os.path.dirname(local_path))
+    with open(local_path, 'w') as local_file:
+      local_file.write('I am a fake PDF in a local bucket.')
+    return local_path
+
+  @staticmethod
+  def _validate(*paths, **kwargs):
+    _validate_consent_pdfs({
+      'resourceType': 'QuestionnaireResponse',
+      'extension': [{'url': _SIGNED_CONSENT_EXTENSION, 'valueString': path}
+                    for path in paths],
+    }, 1, kwargs.get('session'))
+
+  def test_checks_each_pdf(self):
+    self._write_pdf('/Participant/one.pdf')
+    self._write_pdf('/Participant/two.pdf')
+    self._validate('/Participant/one.pdf', 'Participant/two.pdf')
+    with self.assertRaises(BadRequest):
+      self._validate('/Participant/one.pdf', '/Participant/missing.pdf')
+    os.makedirs(self.files.get_local_path('/%s/Participant/dir.pdf' % _FAKE_BUCKET))
+    with self.assertRaises(BadRequest):
+      self._validate('/Participant/dir.pdf')
+
+  def test_caches_existing_pdfs(self):
+    local_path = self._write_pdf('/Participant/one.pdf')
+    with FakeClock(TIME):
+      self._validate('/Participant/one.pdf')
+    os.remove(local_path)
+    with FakeClock(TIME + datetime.timedelta(minutes=30)):
+      self._validate('/Participant/one.pdf')
+    with FakeClock(TIME + datetime.timedelta(hours=2)):
+      with self.assertRaises(BadRequest):
+        self._validate('/Participant/one.pdf')
+
+  @mock.patch('dao.questionnaire_response_dao.logging')
+  def test_deferred_check_logs_missing_pdfs(self, mock_logging):
+    config.override_setting(config.CONSENT_PDF_DEFERRED_CHECK, [True])
+    self._write_pdf('/Participant/one.pdf')
+    self._validate('/Participant/one.pdf', '/Participant/missing.pdf')
+    tasks = self.taskqueue_stub.get_filtered_tasks()
+    self.assertEquals(1, len(tasks))
+    mock_logging.error.assert_not_called()
+    deferred.run(tasks[0].payload)
+    self.assertEquals(1, mock_logging.error.call_count)
+    self.assertIn('/Participant/missing.pdf', mock_logging.error.call_args[0][-1])
+
+  def test_deferred_check_starts_after_commit(self):
+    config.override_setting(config.CONSENT_PDF_DEFERRED_CHECK, [True])
+    with self.assertRaises(BadRequest):
+      with self.database.session() as session:
+        self._validate('/Participant/missing.pdf', session=session)
+        raise BadRequest('Rejected')
+    # Nothing is checked for a response that was rolled back.
+    self.assertEquals([], self.taskqueue_stub.get_filtered_tasks())
+    with self.database.session() as session:
+      self._validate('/Participant/missing.pdf', session=session)
+      self.assertEquals([], self.taskqueue_stub.get_filtered_tasks())
+    self.assertEquals(1, len(self.taskqueue_stub.get_filtered_tasks()))
+
+
 class QuestionnaireResponseDaoCloudCheckTest(testutil.CloudStorageTestBase):
   def test_file_exists(self):
     consent_pdf_path = '/%s/Participant/somefile.pdf' % _FAKE_BUCKET
@@ -0,0 +1,18 @@
+import httplib
+
+from test.unit_test.unit_test_util import FlaskTestBase
+
+
+class DatabasePoolApiTest(FlaskTestBase):
+
+  def test_get_pool_stats(self):
+    self.send_post('Participant', {})
+    stats = self.send_get('DatabasePools')
+    self.assertGreater(stats['primary']['checkouts'], 0)
+    self.assertEquals(0, stats['primary']['timeouts'])
+    self.assertIn('<=1ms', stats['primary']['waitHistogram'])
+    self.assertIn('lockErrorsByDao', stats)
+
+  def test_get_pool_stats_requires_config_admin(self):
+    self.set_auth_user('not_an_admin@example.com')
+    self.send_get('DatabasePools', expected_status=httplib.FORBIDDEN)
@@ -1,11 +1,13 @@
 import datetime
 import isodate
+import mock
 
 from participant_enums import QuestionnaireStatus, OrganizationType
 
 from dateutil.tz import tzutc
 from model.biobank_stored_sample import BiobankStoredSample
 from model.biobank_order import BiobankOrder, BiobankOrderIdentifier, BiobankOrderedSample
+from model import database
 from model.calendar import Calendar
 from model.code import Code, CodeType, CodeBook, CodeHistory
 from model.hpo import HPO
@@ -17,9 +19,15 @@ from model.questionnaire import Questionnaire, QuestionnaireHistory, Questionnai
 from model.questionnaire import QuestionnaireConcept
 from model.questionnaire_response import QuestionnaireResponse, QuestionnaireResponseAnswer
 from model.site import Site
+from MySQLdb.cursors import SSCursor
+from sqlalchemy.exc import OperationalError
 from unit_test_util import SqlTestBase
 
 
+def _make_lock_error(code):
+  return OperationalError('UPDATE participant_summary', {}, Exception(code, 'Lock error'))
+
+
 class DatabaseTest(SqlTestBase):
   def setUp(self):
     super(DatabaseTest, self).setUp(with_data=False)
@@ -192,6 +200,75 @@ class DatabaseTest(SqlTestBase):
     session.add(mb)
     session.commit()
 
+  def test_query_stats(self):
+    session = self.database.make_session()
+    self.assertIsNone(database.get_query_stats())
+    session.query(HPO).all()
+
+    with mock.patch('model.database.logging') as mock_logging:
+      database.start_query_stats(slow_query_threshold_ms=0)
+      session.query(HPO).all()
+      session.query(Site).all()
+      stats = database.stop_query_stats()
+    self.assertEquals(2, stats.statement_count)
+    self.assertEquals(2, mock_logging.warning.call_count)
+    slowest = stats.get_slowest()
+    self.assertEquals(2, len(slowest))
+    self.assertGreaterEqual(slowest[0][0], slowest[1][0])
+    self.assertIsNone(database.get_query_stats())
+    session.close()
+
+  def test_explain_skips_server_side_cursors(self):
+    conn = mock.MagicMock()
+    conn.dialect.name = 'mysql'
+    context = mock.MagicMock()
+    context.execution_options = {}
+    statement = 'SELECT * FROM participant'
+    self.assertIsNone(
+        database._explain(conn, mock.MagicMock(spec=SSCursor), statement, {}, context, False))
+    self.assertIsNone(
+        database._explain(conn, mock.MagicMock(), statement, {}, None, True))
+    conn.connection.cursor.assert_not_called()
+    database._explain(conn, mock.MagicMock(), statement, {}, context, False)
+    conn.connection.cursor.assert_called_once_with()
+
+  def test_autoretry_retries_lock_errors(self):
+    attempts = []
+    def update(session):
+      attempts.append(session)
+      if len(attempts) < 3:
+        raise _make_lock_error(database.MYSQL_DEADLOCK_ERROR)
+      return session.query(HPO).all()
+    with mock.patch('model.database.time.sleep') as mock_sleep:
+      self.assertEquals([], self.database.autoretry(update, name='RetriedDao'))
+    self.assertEquals(3, len(attempts))
+    self.assertEquals(2, mock_sleep.call_count)
+    self.assertEquals({'deadlocks': 2, 'retries': 2},
+                      database.get_lock_error_stats()['RetriedDao'])
+
+  def test_autoretry_gives_up_on_lock_errors(self):
+    attempts = []
+    def update(session):
+      attempts.append(session)
+      raise _make_lock_error(database.MYSQL_LOCK_WAIT_TIMEOUT_ERROR)
+    with mock.patch('model.database.time.sleep'):
+      with self.assertRaises(OperationalError):
+        self.database.autoretry(update, name='TimedOutDao')
+    self.assertEquals(database.LOCK_ERROR_ATTEMPT_LIMIT, len(attempts))
+    self.assertEquals({'lockWaitTimeouts': database.LOCK_ERROR_ATTEMPT_LIMIT,
+                       'retries': database.LOCK_ERROR_ATTEMPT_LIMIT - 1},
+                      database.get_lock_error_stats()['TimedOutDao'])
+
+  def test_autoretry_does_not_retry_other_errors(self):
+    attempts = []
+    def update(session):
+      attempts.append(session)
+      raise OperationalError('UPDATE', {}, Exception(1062, 'Duplicate entry'))
+    with self.assertRaises(OperationalError):
+      self.database.autoretry(update, name='FailedDao')
+    self.assertEquals(1, len(attempts))
+    self.assertNotIn('FailedDao', database.get_lock_error_stats())
+
   def _create_participant(self, session):
     hpo = HPO(hpoId=1, name='UNSET')
     session.add(hpo)
@@ -0,0 +1,58 @@
+from dao.participant_summary_dao import ParticipantSummaryDao
+from model.utils import from_client_participant_id
+from offline import participant_summary_rebuild
+from unit_test_util import FlaskTestBase, run_deferred_tasks
+from werkzeug.exceptions import NotFound
+
+
+class ParticipantSummaryRebuildTest(FlaskTestBase):
+  def setUp(self):
+    super(ParticipantSummaryRebuildTest, self).setUp(use_mysql=True)
+    self.taskqueue = self.taskqueue_stub
+    self.summary_dao = ParticipantSummaryDao()
+
+  def _create_consented_participants(self, count):
+    participant_ids = []
+    for _ in range(count):
+      participant_id = self.create_participant()
+      self.send_consent(participant_id)
+      participant_ids.append(from_client_participant_id(participant_id))
+    return participant_ids
+
+  def _set_first_name(self, participant_id, first_name):
+    with self.summary_dao.session() as session:
+      summary = self.summary_dao.get_with_session(session, participant_id)
+      summary.firstName = first_name
+
+  def _run_job(self, dry_run):
+    job_id = participant_summary_rebuild.start_job(dry_run=dry_run, num_shards=2, batch_size=2)
+    run_deferred_tasks(self)
+    return participant_summary_rebuild.get_job_status(job_id)
+
+  def test_verify_then_rebuild(self):
+    participant_ids = self._create_consented_participants(5)
+    first_name = self.summary_dao.get(participant_ids[2]).firstName
+    self._set_first_name(participant_ids[2], 'Corrupted')
+
+    status = self._run_job(dry_run=True)
+    self.assertEquals(5, status['checked'])
+    self.assertEquals(1, status['changed'])
+    self.assertEquals(0, status['errors'])
+    self.assertEquals(status['numShards'], status['shardsFinished'])
+    diffs = [diff for shard in status['shards'] for diff in shard['diffs']]
+    self.assertEquals([{'participantId': 'P%d' % participant_ids[2],
+                        'changes': {'firstName': ['Corrupted', first_name]}}], diffs)
+    # A dry run leaves the summary as it was.
+    self.assertEquals('Corrupted', self.summary_dao.get(participant_ids[2]).firstName)
+
+    status = self._run_job(dry_run=False)
+    self.assertEquals(1, status['changed'])
+    self.assertEquals(first_name, self.summary_dao.get(participant_ids[2]).firstName)
+
+    status = self._run_job(dry_run=True)
+    self.assertEquals(5, status['checked'])
+    self.assertEquals(0, status['changed'])
+
+  def test_unknown_job(self):
+    with self.assertRaises(NotFound):
+      participant_summary_rebuild.get_job_status('no-such-job')
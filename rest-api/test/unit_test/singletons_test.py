@@ -36,4 +36,42 @@ class SingletonsTest(unittest.TestCase):
 
     with FakeClock(TIME_3):
       self.assertEquals(2, singletons.get(123, SingletonsTest.foo, 86401))
+      self.assertEquals(2, singletons.get(123, SingletonsTest.foo, 86401))
+
+  def test_expired_value_served_while_another_thread_rebuilds(self):
+    with FakeClock(TIME_1):
+      self.assertEquals(1, singletons.get(123, SingletonsTest.foo, 60))
+    with FakeClock(TIME_2):
+      # Holding the index's lock stands in for another thread's rebuild.
+      with singletons._get_index_lock(123):
+        self.assertEquals(1, singletons.get(123, SingletonsTest.foo, 60))
+      self.assertEquals(1, SingletonsTest.foo_count)
+      self.assertEquals(2, singletons.get(123, SingletonsTest.foo, 60))
+
+  def test_invalidate(self):
+    self.assertEquals(1, singletons.get(123, SingletonsTest.foo))
+    singletons.invalidate(123)
+    self.assertEquals(2, singletons.get(123, SingletonsTest.foo))
+
+  def test_refresh_error_keeps_stale_value(self):
+    def fail():
+      raise ValueError('Rebuild failed')
+    with FakeClock(TIME_1):
+      self.assertEquals(1, singletons.get(123, SingletonsTest.foo, 60))
+    with FakeClock(TIME_2):
+      self.assertEquals(1, singletons.get(123, fail, 60))
+      self.assertEquals(1, singletons.get(123, fail, 60))
+
+  def test_stats(self):
+    with FakeClock(TIME_1):
+      singletons.get(123, SingletonsTest.foo, 60)
+      singletons.get(123, SingletonsTest.foo, 60)
+    with FakeClock(TIME_2):
+      singletons.get(123, SingletonsTest.foo, 60)
+    stats = singletons.get_stats()['123']
+    self.assertEquals(1, stats['misses'])
+    self.assertEquals(1, stats['hits'])
+    self.assertEquals(1, stats['staleHits'])
+    self.assertEquals(2, stats['rebuilds'])
+    self.assertEquals(0, stats['rebuildErrors'])
 
@@ -33,6 +33,7 @@ from dao.code_dao import CodeDao
 from dao.hpo_dao import HPODao
 from dao.participant_dao import ParticipantDao
 from dao.site_dao import SiteDao
+from model.cache_generation import CacheGeneration
 from model.code import Code
 from model.hpo import HPO
 from model.site import Site
@@ -204,6 +205,7 @@ class _TestDb(object):
       }
     dao.database_factory.get_database().create_schema()
     dao.database_factory.get_generic_database().create_metrics_schema()
+    self._setup_cache_generations()
     if with_data:
       self._setup_hpos()
     if with_views:
@@ -218,6 +220,13 @@ class _TestDb(object):
     # Reconnecting to in-memory SQLite (because singletons are cleared above)
     # effectively clears the database.
 
+  @staticmethod
+  def _setup_cache_generations():
+    # The migration that creates cache_generation adds a row for each cached table.
+    with dao.database_factory.get_database().session() as session:
+      for name in ('code', 'hpo', 'organization', 'site'):
+        session.add(CacheGeneration(name=name, generation=0))
+
   def _setup_hpos(self, org_dao=None):
     hpo_dao = HPODao()
     hpo_dao.insert(HPO(hpoId=UNSET_HPO_ID, name='UNSET', displayName='Unset',
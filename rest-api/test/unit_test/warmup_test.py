@@ -0,0 +1,17 @@
+import singletons
+import warmup
+from test.unit_test.unit_test_util import NdbTestBase
+
+
+class WarmupTest(NdbTestBase):
+
+  def test_warm_up(self):
+    result = warmup.warm_up()
+    self.assertEquals([], result['failedSteps'])
+    self.assertEquals({'config', 'dbConfig', 'mappers', 'databaseConnection', 'codes', 'hpos',
+                       'organizations', 'sites', 'questionnaireVersions'},
+                      set(result['timingsMs']))
+    for cache_index in (singletons.CODE_CACHE_INDEX, singletons.HPO_CACHE_INDEX,
+                        singletons.ORGANIZATION_CACHE_INDEX, singletons.SITE_CACHE_INDEX,
+                        singletons.QUESTIONNAIRE_VERSION_CACHE_INDEX):
+      self.assertIsNotNone(singletons.get_existing(cache_index))
@@ -0,0 +1,57 @@
+"""Benchmarks keyset pagination of participant summaries.
+
+Pages through participant summaries sorted by the given field and reports the time taken to fetch
+the first page and the last page reached, using row value comparisons for the pagination filter
+and then the equivalent OR of ANDs. Deep pages should take about as long as the first page when an
+index matches the sort order.
+
+Usage:
+  tools/benchmark_pagination.sh [--pages 20] [--page_size 1000] [--sort lastModified]
+"""
+
+import logging
+import time
+
+import config
+from dao import base_dao
+from dao.participant_summary_dao import ParticipantSummaryDao
+from main_util import get_parser, configure_logging
+from query import OrderBy, Query
+
+
+def _page_through(dao, args):
+  """Returns the time taken to fetch each page."""
+  timings = []
+  token = None
+  for _ in range(args.pages):
+    query_def = Query([], OrderBy(args.sort, True), args.page_size, token)
+    start = time.time()
+    results = dao.query(query_def)
+    timings.append(time.time() - start)
+    token = results.pagination_token
+    if not token:
+      break
+  return timings
+
+
+def main(args):
+  config.override_setting(config.BIOBANK_ID_PREFIX, [args.biobank_id_prefix])
+  dao = ParticipantSummaryDao()
+  for row_value_pagination in (True, False):
+    base_dao.ROW_VALUE_PAGINATION = row_value_pagination
+    timings = _page_through(dao, args)
+    logging.info('%-22s page 1: %6.3fs  page %3d: %6.3fs  total: %7.2fs',
+                 'row values' if row_value_pagination else 'OR of ANDs', timings[0],
+                 len(timings), timings[-1], sum(timings))
+
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--pages', help='Maximum number of pages to fetch', type=int, default=20)
+  parser.add_argument('--page_size', help='Number of results per page', type=int, default=1000)
+  parser.add_argument('--sort', help='Participant summary field to sort on',
+                      default='lastModified')
+  parser.add_argument('--biobank_id_prefix', help='Prefix used for client biobank IDs',
+                      default='B')
+  main(parser.parse_args())
@@ -0,0 +1,42 @@
+#!/bin/bash -e
+
+# Benchmarks keyset pagination of participant summaries.
+
+USAGE="tools/benchmark_pagination.sh [--pages <PAGES>] [--page_size <PAGE_SIZE>] [--sort <FIELD>] [--account <ACCOUNT> --project <PROJECT> [--creds_account <ACCOUNT>]]"
+while true; do
+  case "$1" in
+    --account) ACCOUNT=$2; shift 2;;
+    --creds_account) CREDS_ACCOUNT=$2; shift 2;;
+    --project) PROJECT=$2; shift 2;;
+    --pages) ARGS="$ARGS --pages $2"; shift 2;;
+    --page_size) ARGS="$ARGS --page_size $2"; shift 2;;
+    --sort) ARGS="$ARGS --sort $2"; shift 2;;
+    -- ) shift; break ;;
+    * ) break ;;
+  esac
+done
+
+if [ "${PROJECT}" ]
+then
+  if [ -z "${ACCOUNT}" ]
+  then
+    echo "Usage: $USAGE"
+    exit 1
+  fi
+  if [ -z "${CREDS_ACCOUNT}" ]
+  then
+    CREDS_ACCOUNT="${ACCOUNT}"
+  fi
+  source tools/auth_setup.sh
+  run_cloud_sql_proxy
+  set_db_connection_string
+else
+  if [ -z "${DB_CONNECTION_STRING}" ]
+  then
+    source tools/setup_local_vars.sh
+    set_local_db_connection_string
+  fi
+fi
+
+source tools/set_path.sh
+python tools/benchmark_pagination.py $ARGS
@@ -0,0 +1,113 @@
+"""Benchmarks serialization of participant summaries to client JSON.
+
+Loads a page of participant summaries (repeating rows to fill the page if the database has fewer)
+and reports rows per second for the legacy asdict()/format_json_* serializer, the compiled
+serializer on ORM instances, and the compiled serializer on raw result tuples.
+
+Usage:
+  tools/benchmark_participant_summary_json.sh [--rows 10000]
+"""
+
+import itertools
+import logging
+import time
+
+import clock
+import config
+from api_util import format_json_date, format_json_enum, format_json_code, format_json_hpo, \
+  format_json_org, format_json_site
+from code_constants import UNSET
+from dao import database_factory
+from dao import participant_summary_dao
+from dao.participant_summary_dao import ParticipantSummaryDao
+from main_util import get_parser, configure_logging
+from model.participant_summary import ParticipantSummary, WITHDRAWN_PARTICIPANT_FIELDS, \
+  WITHDRAWN_PARTICIPANT_VISIBILITY_TIME, SUSPENDED_PARTICIPANT_FIELDS
+from model.config_utils import to_client_biobank_id
+from model.utils import to_client_participant_id
+from participant_enums import WithdrawalStatus, SuspensionStatus, get_bucketed_age
+
+
+def _legacy_to_client_json(dao, model):
+  """The asdict()/format_json_* implementation that the compiled plan replaced."""
+  result = model.asdict()
+  if (model.withdrawalStatus == WithdrawalStatus.NO_USE and
+      (model.withdrawalTime is None or
+       model.withdrawalTime < clock.CLOCK.now() - WITHDRAWN_PARTICIPANT_VISIBILITY_TIME)):
+    result = {k: result.get(k) for k in WITHDRAWN_PARTICIPANT_FIELDS}
+  elif model.withdrawalStatus != WithdrawalStatus.NO_USE and \
+    model.suspensionStatus == SuspensionStatus.NO_CONTACT:
+    for i in SUSPENDED_PARTICIPANT_FIELDS:
+      result[i] = UNSET
+
+  result['participantId'] = to_client_participant_id(model.participantId)
+  biobank_id = result.get('biobankId')
+  if biobank_id:
+    result['biobankId'] = to_client_biobank_id(biobank_id)
+  date_of_birth = result.get('dateOfBirth')
+  if date_of_birth:
+    result['ageRange'] = get_bucketed_age(date_of_birth, clock.CLOCK.now())
+  else:
+    result['ageRange'] = UNSET
+  if result.get('primaryLanguage') is None:
+    result['primaryLanguage'] = UNSET
+  if 'organizationId' in result:
+    result['organization'] = result['organizationId']
+    del result['organizationId']
+    format_json_org(result, dao.organization_dao, 'organization')
+  format_json_hpo(result, dao.hpo_dao, 'hpoId')
+  result['awardee'] = result['hpoId']
+  for fieldname in participant_summary_dao._DATE_FIELDS:
+    format_json_date(result, fieldname)
+  for fieldname in participant_summary_dao._CODE_FIELDS:
+    format_json_code(result, dao.code_dao, fieldname)
+  for fieldname in participant_summary_dao._ENUM_FIELDS:
+    format_json_enum(result, fieldname)
+  for fieldname in participant_summary_dao._SITE_FIELDS:
+    format_json_site(result, dao.site_dao, fieldname)
+  if (model.withdrawalStatus == WithdrawalStatus.NO_USE or
+      model.suspensionStatus == SuspensionStatus.NO_CONTACT):
+    result['recontactMethod'] = 'NO_CONTACT'
+  return {k: v for k, v in result.iteritems() if v is not None}
+
+
+def _fill(items, num_rows):
+  return list(itertools.islice(itertools.cycle(items), num_rows))
+
+
+def _time(label, fn, items):
+  start = time.time()
+  for item in items:
+    fn(item)
+  elapsed = time.time() - start
+  logging.info('%-30s %8d rows in %6.2fs: %10.0f rows/sec', label, len(items), elapsed,
+               len(items) / elapsed if elapsed else float('inf'))
+
+
+def main(args):
+  # Biobank IDs are prefixed from config, which is normally only available in the app server.
+  config.override_setting(config.BIOBANK_ID_PREFIX, [args.biobank_id_prefix])
+  dao = ParticipantSummaryDao()
+  with database_factory.get_database().session() as session:
+    models = session.query(ParticipantSummary).limit(args.rows).all()
+    rows = session.query(*dao.get_client_json_fields()).limit(args.rows).all()
+  if not models:
+    logging.error('No participant summaries found; nothing to benchmark.')
+    return
+  models = _fill(models, args.rows)
+  rows = _fill(rows, args.rows)
+  # Warm up the code/HPO/site/organization caches so they don't count against the first run.
+  dao.to_client_json(models[0])
+
+  _time('legacy to_client_json', lambda m: _legacy_to_client_json(dao, m), models)
+  _time('compiled to_client_json', dao.to_client_json, models)
+  _time('compiled to_client_json_from_row', dao.to_client_json_from_row, rows)
+
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--rows', help='Number of rows to serialize', type=int, default=10000)
+  parser.add_argument('--biobank_id_prefix', help='Prefix used for client biobank IDs',
+                      default='B')
+  main(parser.parse_args())
@@ -0,0 +1,67 @@
+"""Prepares a new instance to serve requests.
+
+App Engine sends a warmup request to each new instance before routing traffic to it; doing the
+expensive one-time setup here (rather than in the first real request) keeps it out of request
+latency when instances are added under load.
+"""
+import logging
+import time
+
+from sqlalchemy.orm import configure_mappers
+
+from config import get_config, get_db_config
+from dao import database_factory
+from dao.code_dao import CodeDao
+from dao.hpo_dao import HPODao
+from dao.organization_dao import OrganizationDao
+from dao.questionnaire_dao import QuestionnaireHistoryDao
+from dao.site_dao import SiteDao
+
+
+def _open_database_connection():
+  with database_factory.get_database().session() as session:
+    session.execute('SELECT 1')
+
+
+def _load_cache(dao_class):
+  return lambda: len(dao_class().get_all())
+
+
+# Steps run in order; each is a (name, function) pair. Functions may return a count (e.g. of
+# entities loaded) to include in the log.
+_STEPS = [
+  ('config', get_config),
+  ('dbConfig', get_db_config),
+  ('mappers', configure_mappers),
+  ('databaseConnection', _open_database_connection),
+  ('codes', _load_cache(CodeDao)),
+  ('hpos', _load_cache(HPODao)),
+  ('organizations', _load_cache(OrganizationDao)),
+  ('sites', _load_cache(SiteDao)),
+  ('questionnaireVersions', lambda: QuestionnaireHistoryDao().load_current_versions()),
+]
+
+
+def warm_up():
+  """Loads configuration and builds the in-memory caches used when serving requests.
+
+  A step that fails is logged and skipped (the cache is then built by the first request that
+  needs it), so that one failure doesn't keep the instance from starting. Returns a dict with
+  the time each step took in milliseconds, and the steps that failed.
+  """
+  timings_ms = {}
+  failed_steps = []
+  for name, step in _STEPS:
+    start_time = time.time()
+    try:
+      result = step()
+    except Exception:  # pylint: disable=broad-except
+      logging.warning('Warmup step %s failed.', name, exc_info=True)
+      failed_steps.append(name)
+      continue
+    timings_ms[name] = int((time.time() - start_time) * 1000)
+    if isinstance(result, int):
+      logging.info('Warmup step %s loaded %d in %d ms.', name, result, timings_ms[name])
+    else:
+      logging.info('Warmup step %s took %d ms.', name, timings_ms[name])
+  return {'timingsMs': timings_ms, 'failedSteps': failed_steps}